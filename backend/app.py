@@ -3,26 +3,139 @@ import re
 import threading
 import time
 import functools
+import contextlib
+import bisect
+import heapq
+import itertools
+import random
+import hashlib
+import hmac
+import socket
 import concurrent.futures
-import google.generativeai as genai
-from flask import Flask, request, jsonify, make_response, session
+import asyncio
+import difflib
+import importlib
+from collections import OrderedDict, deque
+from flask import Flask, Response, g, request, jsonify, make_response, session, stream_with_context
 from flask_cors import CORS
+from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from PIL import Image
 import uuid
+import io
 import json
+import zipfile
+import zlib
+import base64
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access.
+
+    NumPy and Pillow take about 100 ms to import and only image handling uses
+    them, so they load on the warm-up thread (or the first upload), never at
+    import time. Callbacks passed to on_load() run once the module is imported.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._callbacks = []
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Return the real module, importing it if needed."""
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    module = importlib.import_module(self._name)
+                    for callback in self._callbacks:
+                        callback(module)
+                    self._module = module
+        return self._module
+
+    def on_load(self, callback):
+        with self._lock:
+            if self._module is None:
+                self._callbacks.append(callback)
+                return
+        callback(self._module)
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+Image = LazyModule("PIL.Image")
+np = LazyModule("numpy")
+sqlite3 = LazyModule("sqlite3")
 
 # Load environment variables
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# "gemini" calls the real API; "fake" uses the offline client in fake_model.py
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini").lower()
+GEMINI_MODEL_NAME = "gemini-1.5-flash"
+
+def create_model_client(backend=MODEL_BACKEND):
+    """Create the model client for the given backend.
+
+    Any object with generate_content(parts, stream=..., generation_config=...)
+    returning a response with a `.text` attribute can serve as the client.
+    """
+    if backend == "fake":
+        from fake_model import FakeModelClient
+        print(f"🧪 Using offline fake model client")
+        return FakeModelClient.from_env()
+    
+    import google.generativeai as genai
+    
+    # Check if API key is available
+    if not GEMINI_API_KEY:
+        raise ValueError("❌ ERROR: Missing Gemini API Key in .env file!")
+    
+    # Configure Gemini API
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+class LazyModelClient:
+    """Stands in for the model client and creates it on first use.
+
+    Importing and configuring the SDK takes seconds, so it happens on the
+    warm-up thread (or at the first model call), never at import time.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._client is not None
+
+    def load(self):
+        """Return the real client, creating it if needed."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
 
-# Check if API key is available
-if not GEMINI_API_KEY:
-    raise ValueError("❌ ERROR: Missing Gemini API Key in .env file!")
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
 
-# Configure Gemini API
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-1.5-flash")
+model = LazyModelClient(create_model_client)
+
+def set_model_client(client):
+    """Swap the model client used by every analysis path (e.g. for benchmarks).
+
+    A bare client is wrapped, already loaded, so warm-up and /ready see the
+    same interface as the default lazy client.
+    """
+    global model
+    if not isinstance(client, LazyModelClient):
+        wrapped = LazyModelClient(lambda: client)
+        wrapped.load()
+        model = wrapped
+    else:
+        model = client
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -181,112 +294,1967 @@ Respond with just 'YES' if this is a UI-related image that could be analyzed for
 or 'NO' if this is not a UI-related image (e.g., photograph of a person, landscape, object, etc.).
 """
 
-# Simple in-memory cache for UI detection results
-ui_detection_cache = {}
-# Create a dictionary to store session-specific data
-session_data = {}
+# Single-call prompt covering UI detection and every UX category, used in "combined" mode
+COMBINED_PROMPT = """
+First determine if this image contains a user interface (UI) such as a website or web application, mobile app screen, software dashboard, digital product interface, UI wireframe or mockup, or control panel or settings screen.
+
+If it does, analyze the UI across the following categories:
+- "visual": visual design consistency. Consider color palette, typography, spacing, and alignment.
+- "ux-laws": UX laws and principles such as Fitts's Law, Hick's Law, and Jakob's Law. Do not include gestalt principles.
+- "cognitive": cognitive load. Identify areas that might be overwhelming or confusing for users.
+- "psychological": psychological effects such as color psychology, visual hierarchy, and emotional response.
+- "gestalt": Gestalt principles (proximity, similarity, continuity, closure, etc.).
+
+Format your response as a structured JSON object with the following format:
+{
+  "is_ui": true | false,
+  "categories": {
+    "<category key>": {
+      "issues": [
+        {
+          "title": "Brief issue title",
+          "description": "Detailed explanation of the issue",
+          "severity": "high | medium | low"
+        }
+      ],
+      "recommendations": [
+        {
+          "title": "Brief recommendation title",
+          "description": "Detailed explanation of the recommendation",
+          "type": "improvement | fix | enhancement"
+        }
+      ]
+    }
+  }
+}
+
+Use exactly the category keys listed above and include 3-5 specific, actionable issues and recommendations for each.
+If the image is not a UI (e.g., photograph of a person, landscape, object, etc.), set "is_ui" to false and return an empty "categories" object.
+
+YOU MUST RETURN A VALID JSON OBJECT. DO NOT INCLUDE ANY EXPLANATION TEXT BEFORE OR AFTER THE JSON.
+"""
+
+# "per-category" makes one UI detection call plus one call per category;
+# "combined" asks for everything in a single call and falls back per category
+ANALYSIS_MODE = os.getenv("ANALYSIS_MODE", "per-category").lower()
+
+# Configure Gemini for better JSON output
+GENERATION_CONFIG = {
+    "temperature": 0.2,  # Lower temperature for more consistent responses
+    "top_p": 0.8,
+    "top_k": 40,
+    "max_output_tokens": 2048,
+}
+# The combined response carries five categories, so it needs a larger output budget
+COMBINED_GENERATION_CONFIG = dict(GENERATION_CONFIG, max_output_tokens=8192)
+
+def fingerprint(*parts):
+    """Short, stable digest of the prompts, configs and model name that produce a result."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+# Every cached result is keyed by the fingerprint of whatever produced it, so editing a
+# prompt or generation config only invalidates the results that depended on it.
+# In combined mode one call produces the UI verdict and every category, so its
+# prompt is part of all of them.
+COMBINED_PARTS = (COMBINED_PROMPT, COMBINED_GENERATION_CONFIG) if ANALYSIS_MODE == "combined" else ()
+UI_FINGERPRINT = fingerprint(GEMINI_MODEL_NAME, UI_DETECTION_PROMPT, *COMBINED_PARTS)
+CATEGORY_FINGERPRINTS = {
+    category: fingerprint(GEMINI_MODEL_NAME, prompt, GENERATION_CONFIG, *COMBINED_PARTS)
+    for category, prompt in UX_PROMPTS.items()
+}
+
+# Content-addressed cache settings (entries are keyed by the SHA-256 of the uploaded bytes)
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", 3600))
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", 256))
+
+# Fallback results that should never be cached, so a retry gets a fresh model call
+FALLBACK_TITLES = {"Analysis Formatting Error", "No Analysis Results"}
+
+# Session, job and result stores: "memory" keeps them per process, "sqlite" shares
+# them through a WAL-mode database so any worker on the host can serve any session
+STORE_BACKEND = os.getenv("STORE_BACKEND", "memory").lower()
+STORE_PATH = os.getenv("STORE_PATH", "feed_store.sqlite3")
+SESSION_TTL = int(os.getenv("SESSION_TTL", 3600))
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", 10000))  # Least recently used sessions beyond this are dropped
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", 64 * 1024 * 1024))  # Memory budget for in-process session records
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a fixed time-to-live.
+
+    This is also the in-memory store implementation; maxsize or ttl of None
+    disables the size bound or expiry respectively. With max_bytes, sizeof(value)
+    is summed over entries and least recently used ones are evicted to stay
+    within that budget.
+    """
+
+    def __init__(self, maxsize=None, ttl=None, max_bytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._expiry = []  # Min-heap of (expires_at, sequence, key); may hold superseded entries
+        self._sequence = itertools.count()
+        self._lock = threading.RLock()  # Reentrant so add() can set() under it
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                self.bytes -= size
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            expires_at = time.time() + self.ttl if self.ttl else None
+            size = self.sizeof(value) if self.sizeof else 0
+            previous = self._data.get(key)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._data[key] = (value, expires_at, size)
+            self._data.move_to_end(key)
+            self.bytes += size
+            # Evict least recently used entries beyond the size and byte bounds, never the one just set
+            while len(self._data) > 1 and (
+                    (self.maxsize is not None and len(self._data) > self.maxsize)
+                    or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                _, evicted = self._data.popitem(last=False)
+                self.bytes -= evicted[2]
+                self.evictions += 1
+            if expires_at is not None:
+                heapq.heappush(self._expiry, (expires_at, next(self._sequence), key))
+                # Overwrites leave superseded heap entries behind; rebuild once they dominate
+                if len(self._expiry) > 2 * len(self._data) + 64:
+                    self._expiry = [(entry[1], next(self._sequence), k) for k, entry in self._data.items() if entry[1] is not None]
+                    heapq.heapify(self._expiry)
+
+    def add(self, key, value):
+        """Set key only if it has no unexpired value; returns whether it was set."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[1] is None or entry[1] >= time.time()):
+                return False
+            self.set(key, value)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+
+    def items(self):
+        """Return a snapshot of unexpired (key, value) pairs, least recently used first."""
+        now = time.time()
+        with self._lock:
+            return [(key, value) for key, (value, expires_at, _) in self._data.items()
+                    if expires_at is None or expires_at >= now]
+
+    def expire(self):
+        """Drop expired entries and return how many were removed.
+
+        Expiry times are kept in a min-heap, so this costs O(expired log n)
+        instead of a scan of every entry.
+        """
+        now = time.time()
+        removed = 0
+        with self._lock:
+            while self._expiry and self._expiry[0][0] < now:
+                expires_at, _, key = heapq.heappop(self._expiry)
+                entry = self._data.get(key)
+                # Skip heap entries left behind by an overwrite, delete or eviction
+                if entry is not None and entry[1] == expires_at:
+                    del self._data[key]
+                    self.bytes -= entry[2]
+                    removed += 1
+        return removed
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+def encode_bytes(value):
+    """json.dumps default hook: store bytes (e.g. packed session results) as base64."""
+    if isinstance(value, bytes):
+        return {"$b64": base64.b64encode(value).decode("ascii")}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def decode_bytes(obj):
+    """json.loads object hook undoing encode_bytes."""
+    if len(obj) == 1 and "$b64" in obj:
+        return base64.b64decode(obj["$b64"])
+    return obj
+
+class SQLiteStore:
+    """Key-value store in a shared SQLite database, with the same interface as TTLCache.
+
+    Values are stored as JSON (bytes inside them as base64). The database runs in WAL mode so readers in
+    other worker processes never block on a writer. Each thread uses its own
+    connection.
+    """
+
+    def __init__(self, path, namespace, maxsize=None, ttl=None):
+        self.path = path
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " expires_at REAL, accessed_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS kv_accessed ON kv (namespace, accessed_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS kv_expires ON kv (namespace, expires_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # Stored keys are tagged with their type: "s:" + a string key (such as a client's session
+    # cookie, which may hold anything) or "t:" + a tuple key as a JSON array
+    @staticmethod
+    def _key(key):
+        return "s:" + key if isinstance(key, str) else "t:" + json.dumps(key)
+
+    @staticmethod
+    def _unkey(key):
+        """The key a stored key was written for, or None for an untagged key from an older version."""
+        if key.startswith("s:"):
+            return key[2:]
+        if key.startswith("t:"):
+            return tuple(json.loads(key[2:]))
+        return None
+
+    def get(self, key, default=None):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value, expires_at FROM kv WHERE namespace = ? AND key = ?",
+            (self.namespace, self._key(key))
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] < now):
+            self.misses += 1
+            return default
+        if self.maxsize is not None:
+            conn.execute(
+                "UPDATE kv SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                (now, self.namespace, self._key(key))
+            )
+        self.hits += 1
+        return json.loads(row[0], object_hook=decode_bytes)
+
+    def set(self, key, value):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO kv (namespace, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (self.namespace, self._key(key), json.dumps(value, default=encode_bytes), now + self.ttl if self.ttl else None, now)
+        )
+        if self.maxsize is not None:
+            # Evict least recently used entries beyond the size bound
+            cursor = conn.execute(
+                "DELETE FROM kv WHERE namespace = ? AND key IN ("
+                " SELECT key FROM kv WHERE namespace = ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.namespace, self.namespace, self.maxsize)
+            )
+            self.evictions += cursor.rowcount
+
+    def add(self, key, value):
+        """Set key only if it has no unexpired value; returns whether it was set.
+
+        A single upsert, so of several workers adding the same key at once exactly one wins.
+        """
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO kv (namespace, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (namespace, key) DO UPDATE SET"
+            " value = excluded.value, expires_at = excluded.expires_at, accessed_at = excluded.accessed_at"
+            " WHERE kv.expires_at IS NOT NULL AND kv.expires_at < ?",
+            (self.namespace, self._key(key), json.dumps(value, default=encode_bytes),
+             now + self.ttl if self.ttl else None, now, now)
+        )
+        return cursor.rowcount > 0
+
+    def delete(self, key):
+        self._connect().execute(
+            "DELETE FROM kv WHERE namespace = ? AND key = ?", (self.namespace, self._key(key))
+        )
+
+    def items(self):
+        """Return a snapshot of unexpired (key, value) pairs, least recently used first."""
+        rows = self._connect().execute(
+            "SELECT key, value FROM kv WHERE namespace = ? AND (expires_at IS NULL OR expires_at >= ?)"
+            " ORDER BY accessed_at",
+            (self.namespace, time.time())
+        ).fetchall()
+        # Untagged keys can no longer be read or written, so they are left to expire
+        return [(self._unkey(key), json.loads(value, object_hook=decode_bytes)) for key, value in rows
+                if self._unkey(key) is not None]
+
+    def expire(self):
+        """Drop expired entries and return how many were removed."""
+        cursor = self._connect().execute(
+            "DELETE FROM kv WHERE namespace = ? AND expires_at IS NOT NULL AND expires_at < ?",
+            (self.namespace, time.time())
+        )
+        return cursor.rowcount
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM kv WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+
+    @property
+    def bytes(self):
+        """Serialized size of this namespace's values on disk."""
+        return self._connect().execute(
+            "SELECT COALESCE(SUM(LENGTH(value)), 0) FROM kv WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+
+def make_store(namespace, maxsize=None, ttl=None, max_bytes=None, sizeof=None):
+    """Create a store for namespace using the configured STORE_BACKEND.
+
+    max_bytes and sizeof bound process memory, so only the memory backend uses them.
+    """
+    if STORE_BACKEND == "sqlite":
+        return SQLiteStore(STORE_PATH, namespace, maxsize, ttl)
+    return TTLCache(maxsize, ttl, max_bytes, sizeof)
+
+# UI detection verdicts, keyed by ui_key()
+ui_detection_cache = make_store("ui_detection", ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_TTL)
+# Formatted per-category results, keyed by category_key()
+category_cache = make_store("category", ANALYSIS_CACHE_SIZE * len(UX_PROMPTS), ANALYSIS_CACHE_TTL)
+# Perceptual hash and luma thumbnail of prepared uploads, keyed by image hash,
+# so a re-upload whose analysis is cached is never decoded
+image_meta_cache = make_store("image_meta", ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_TTL)
+
+def ui_key(image_hash):
+    """Cache key for an image's UI verdict under the current UI prompt."""
+    return (image_hash, UI_FINGERPRINT)
+
+def category_key(image_hash, category):
+    """Cache key for one category's result; results of older prompts or configs are never read."""
+    return (image_hash, category, CATEGORY_FINGERPRINTS[category])
+
+# Fixed cost of a session record beyond its field values: the dict, its keys and the LRU entry
+SESSION_RECORD_OVERHEAD = 512
+
+def pack_results(results):
+    """Serialize a result list to compact zlib-compressed JSON; an empty list packs to b""."""
+    if not results:
+        return b""
+    return zlib.compress(json.dumps(results, separators=(",", ":")).encode("utf-8"))
+
+def unpack_results(packed):
+    """Inverse of pack_results."""
+    if not packed:
+        return []
+    return json.loads(zlib.decompress(packed))
+
+def session_record_size(record):
+    """Approximate memory held by a session record, for the session byte budget."""
+    return SESSION_RECORD_OVERHEAD + sum(len(v) if isinstance(v, (bytes, str)) else 8 for v in record.values())
+
+# Session-specific data (image path, image hash, packed analysis, timestamp), keyed by session ID.
+# Results stay packed until GET /analyze asks for them.
+session_store = make_store("sessions", SESSION_MAX_COUNT, SESSION_TTL, SESSION_MAX_BYTES, session_record_size)
 lock = threading.Lock()  # Prevent concurrency issues
 
-# Add caching decorator for expensive operations
-def cached_function(expiry_seconds=300):
-    """Cache decorator for expensive functions."""
-    cache = {}
-    lock = threading.Lock()
-    
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            key = str(args) + str(kwargs)
-            with lock:
-                # Check if we have a cached result that hasn't expired
-                if key in cache:
-                    result, timestamp = cache[key]
-                    if time.time() - timestamp < expiry_seconds:
-                        print(f"🔄 Cache hit for {func.__name__}")
-                        return result
-            
-            # Run the function and cache the result
-            result = func(*args, **kwargs)
-            with lock:
-                cache[key] = (result, time.time())
-            return result
-        return wrapper
-    return decorator
+def get_session(session_id):
+    """Return the stored record for a session, or None. Its analysis is still packed."""
+    return session_store.get(session_id)
+
+def session_results(data):
+    """Decode the analysis results held in a session record."""
+    return unpack_results(data.get('analysis'))
+
+def update_session(session_id, **fields):
+    """Merge fields into a session record and write it back to the store.
+
+    An `analysis` result list is packed on the way in.
+    """
+    if 'analysis' in fields:
+        fields['analysis'] = pack_results(fields['analysis'])
+    with lock:
+        data = session_store.get(session_id) or {'timestamp': time.time()}
+        data.update(fields)
+        session_store.set(session_id, data)
+        return data
+
+def store_session_results(session_id, image_hash, results):
+    """Save results to a session unless it has moved on to another image since; returns whether saved."""
+    with lock:
+        data = session_store.get(session_id)
+        if data is None or data.get('image_hash') != image_hash:
+            print(f"🛑 Dropping stale results for session {session_id}")
+            return False
+        data['analysis'] = pack_results(results)
+        session_store.set(session_id, data)
+        return True
+
+# CancelTokens of each session's running analyses. Tokens live in this process
+# only; with the sqlite backend, store_session_results still stops stale writes.
+session_tokens = TTLCache(SESSION_MAX_COUNT, SESSION_TTL)
+session_tokens_lock = threading.Lock()
+
+def start_session_token(session_id, image_hash, deadline=None):
+    """Register a token for a new analysis in a session, cancelling its analyses of other images.
+
+    Analyses of the same image (e.g. /preprocess, then POST /analyze) keep
+    running so the newer request can join them.
+    """
+    token = CancelToken(image_hash, deadline)
+    with session_tokens_lock:
+        running = session_tokens.get(session_id) or []
+        superseded = [t for t in running if t.image_hash != image_hash]
+        session_tokens.set(session_id, [t for t in running if t.image_hash == image_hash] + [token])
+    for previous in superseded:
+        print(f"🛑 Newer upload in session {session_id}, cancelling analysis of {str(previous.image_hash)[:12]}")
+        previous.cancel("superseded by a newer upload")
+    return token
+
+def release_session_token(session_id, token):
+    """Forget a finished analysis' token."""
+    with session_tokens_lock:
+        running = [t for t in session_tokens.get(session_id) or [] if t is not token]
+        if running:
+            session_tokens.set(session_id, running)
+        else:
+            session_tokens.delete(session_id)
+
+# Per-request tracing and Prometheus metrics for the hot path
+TRACE_LOG_MS = float(os.getenv("TRACE_LOG_MS", 0))  # Log traces at least this slow; negative disables
+# Histogram buckets in seconds, from local stages up to slow model calls
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def format_labels(names, values):
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+class Histogram:
+    """Thread-safe Prometheus histogram with one series per tuple of label values."""
+
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # label values -> [per-bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            snapshot = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, counts, total, count in sorted(snapshot):
+            base = format_labels(self.label_names, labels)
+            prefix = base + "," if base else ""
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{base}}} {total:.6f}")
+            lines.append(f"{self.name}_count{{{base}}} {count}")
+        return lines
+
+class Counter:
+    """Thread-safe Prometheus counter with one series per tuple of label values."""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in snapshot:
+            lines.append(f"{self.name}{{{format_labels(self.label_names, labels)}}} {value}")
+        return lines
 
-def resize_image(image_path, max_size=(800, 800)):
-    """Resize image to reduce memory usage before processing."""
+request_seconds = Histogram("ux_analysis_request_seconds", "Time to answer an HTTP request.", ("method", "endpoint", "status"))
+stage_seconds = Histogram("ux_analysis_stage_seconds", "Time spent in each analysis stage.", ("stage", "category"))
+model_errors = Counter("ux_analysis_model_errors_total", "Failed model call attempts, including retried ones.", ("kind", "type"))
+
+class Trace:
+    """Stage timings for one request or job, collected from every thread serving it."""
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.started = time.perf_counter()
+        self.stages = []  # (stage, category, seconds) in completion order
+        self._lock = threading.Lock()
+
+    def add(self, stage, category, seconds):
+        with self._lock:
+            self.stages.append((stage, category, seconds))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def totals(self):
+        """Seconds per (stage, category), summed over retries, in order of first completion."""
+        totals = {}
+        with self._lock:
+            for stage, category, seconds in self.stages:
+                totals[(stage, category)] = totals.get((stage, category), 0.0) + seconds
+        return totals
+
+    def server_timing(self):
+        """Render the stage totals as a Server-Timing header for browser devtools."""
+        entries = [f"{stage}{'.' + category if category else ''};dur={seconds * 1000:.1f}"
+                   for (stage, category), seconds in self.totals().items()]
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+    def log(self):
+        elapsed_ms = self.elapsed() * 1000
+        if TRACE_LOG_MS < 0 or not self.stages or elapsed_ms < TRACE_LOG_MS:
+            return
+        breakdown = " · ".join(f"{stage}{f'[{category}]' if category else ''} {seconds * 1000:.1f}"
+                               for (stage, category), seconds in self.totals().items())
+        print(f"📊 {self.name} {elapsed_ms:.1f} ms [trace {self.id}]: {breakdown}")
+
+_trace_local = threading.local()
+
+def current_trace():
+    return getattr(_trace_local, "trace", None)
+
+def set_current_trace(trace):
+    _trace_local.trace = trace
+
+def with_trace(fn):
+    """Wrap fn so it records into the calling thread's trace when run on another thread."""
+    trace = current_trace()
+    if trace is None:
+        return fn
+    
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        previous = current_trace()
+        set_current_trace(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            set_current_trace(previous)
+    return wrapper
+
+def record_stage(stage, seconds, category=""):
+    """Add one stage timing to the metrics and to the current trace, if any."""
+    stage_seconds.observe(seconds, stage, category)
+    trace = current_trace()
+    if trace is not None:
+        trace.add(stage, category, seconds)
+
+@contextlib.contextmanager
+def timed_stage(stage, category=""):
+    """Time the enclosed block as one stage, whether or not it raises."""
+    started = time.perf_counter()
     try:
-        image = Image.open(image_path)
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        image.save(image_path)
-        print(f"📏 Resized image to max {max_size} dimensions")
-    except Exception as e:
-        print(f"❌ Error resizing image: {str(e)}")
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started, category)
 
-# Apply caching to the UI detection function
-@cached_function(expiry_seconds=600)
-def is_ui_image(image_path):
-    """Determine if the uploaded image is UI-related."""
-    # First check in-memory cache
-    if image_path in ui_detection_cache:
-        print(f"🔄 UI detection cache hit for {os.path.basename(image_path)}")
-        return ui_detection_cache[image_path]
-        
+# Cancellation and deadlines: each analysis request carries a CancelToken through the pipeline
+CANCEL_POLL_INTERVAL = 0.25  # Seconds between cancellation checks while blocked
+MAX_DEADLINE_MS = int(os.getenv("MAX_DEADLINE_MS", 10 * 60 * 1000))
+
+class AnalysisCancelled(Exception):
+    """Raised inside the pipeline once a request's CancelToken is cancelled."""
+
+class DeadlineExceeded(AnalysisCancelled):
+    """Raised when work could not finish before the request's deadline."""
+
+class CancelToken:
+    """Cancellation flag and optional deadline for one analysis request.
+
+    The pipeline checks it before queueing and before admitting each model
+    call. A call already sent to the model cannot be interrupted; its result
+    is still cached for later requests.
+    """
+
+    def __init__(self, image_hash=None, deadline=None):
+        self.image_hash = image_hash
+        self.deadline = time.monotonic() + deadline if deadline is not None else None
+        self.reason = None
+        self._cancelled = threading.Event()
+
+    def cancel(self, reason="cancelled"):
+        self.reason = reason
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def remaining(self):
+        """Seconds left before the deadline, or None without one."""
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def check(self, needed=0):
+        """Raise if cancelled, or if fewer than `needed` seconds are left before the deadline."""
+        if self.cancelled:
+            raise AnalysisCancelled(self.reason)
+        remaining = self.remaining()
+        if remaining is not None and remaining <= needed:
+            raise DeadlineExceeded(f"{max(remaining, 0):.1f}s left before the deadline, {needed:.1f}s needed")
+
+    def wait(self, seconds):
+        """Sleep up to seconds, waking early if cancelled."""
+        self._cancelled.wait(seconds)
+
+class InflightJob:
+    """A unit of work that concurrent requests for the same key can wait on.
+
+    Partial results published while the job runs can be streamed by any
+    number of waiters, each of which sees every item from the beginning.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.result = None
+        self.error = None
+        self.partial = []
+        self.started = time.time()
+        self._done = threading.Event()
+        self._cond = threading.Condition()
+
+    def run(self, func, *args):
+        """Execute func as the job's leader, then unregister and wake all waiters."""
+        result, error = None, None
+        try:
+            result = func(*args)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # Unregister before waking followers; late arrivals then hit the caches
+            self._unregister()
+            self.finish(result, error)
+
+    def abandon(self, error):
+        """Give up on a job whose leader never ran it; waiters get error.
+
+        An AnalysisCancelled error makes waiting requests run the work themselves.
+        """
+        self._unregister()
+        self.finish(None, error)
+
+    def _unregister(self):
+        with jobs_lock:
+            if inflight_jobs.get(self.key) is self:
+                del inflight_jobs[self.key]
+
+    def publish(self, item):
+        with self._cond:
+            self.partial.append(item)
+            self._cond.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self._cond:
+            self.result = result
+            self.error = error
+            self._done.set()
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """Return the job's result, or raise its error.
+
+        Raises TimeoutError if the job is still running after timeout seconds.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Job {self.key} still running after {timeout}s")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def done(self):
+        return self._done.is_set()
+
+    def stream(self, token=None):
+        """Yield published items as they arrive until the job finishes.
+
+        With a token, a waiter's own cancellation or deadline raises as in
+        CancelToken.check while it waits for the next item.
+        """
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.partial) and not self._done.is_set():
+                    if token is None:
+                        self._cond.wait()
+                        continue
+                    token.check()
+                    remaining = token.remaining()
+                    self._cond.wait(CANCEL_POLL_INTERVAL if remaining is None else min(CANCEL_POLL_INTERVAL, remaining))
+                items = self.partial[index:]
+                index = len(self.partial)
+                done = self._done.is_set()
+            yield from items
+            if done:
+                return
+
+# Registry of in-flight jobs, keyed by (kind, image hash)
+inflight_jobs = {}
+jobs_lock = threading.Lock()
+
+def wait_for_job(job, token=None, requested=None):
+    """Wait for a job started by another request, on behalf of a request holding token.
+
+    Returns the job's result, or None if the job's own request was cancelled
+    and the caller should run the work itself. If token's deadline passes
+    first, returns what the job has published so far for the `requested`
+    categories, or raises DeadlineExceeded when partial results make no sense.
+    """
+    if token is not None:
+        while not job.done():
+            try:
+                token.check()
+            except DeadlineExceeded:
+                if requested is None:
+                    raise
+                return complete_with_skipped(list(job.partial), requested)
+            remaining = token.remaining()
+            try:
+                return job.wait(CANCEL_POLL_INTERVAL if remaining is None else min(CANCEL_POLL_INTERVAL, remaining))
+            except TimeoutError:
+                continue
+            except AnalysisCancelled:
+                return None
     try:
-        image = Image.open(image_path).convert("RGB")
-        
-        # Ask Gemini if this image contains UI elements
-        response = model.generate_content([UI_DETECTION_PROMPT, image], stream=False)
-        result = response.text.strip().upper()
-        
-        # Check if the response indicates this is a UI image
-        is_ui = "YES" in result
-        
-        # Store in cache
-        ui_detection_cache[image_path] = is_ui
-        
-        print(f"🔍 UI detection for {os.path.basename(image_path)}: {'✅ UI detected' if is_ui else '❌ Not UI'}")
-        return is_ui
-    except Exception as e:
-        print(f"❌ Error during UI detection: {str(e)}")
-        # In case of errors, default to not a UI
+        return job.wait()
+    except AnalysisCancelled:
+        return None
+
+def join_or_start_job(key):
+    """Return (job, is_leader) for key; only the leader should run the work."""
+    with jobs_lock:
+        job = inflight_jobs.get(key)
+        if job is not None:
+            print(f"🔗 Joining in-flight {key[0]} job for {key[1][:12]}")
+            return job, False
+        job = InflightJob(key)
+        inflight_jobs[key] = job
+        return job, True
+
+# Shared pool for background analysis jobs, with a bounded backlog
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", 32))
+JOB_RETRY_AFTER = int(os.getenv("JOB_RETRY_AFTER", 5))  # Seconds suggested to clients on 429
+JOB_TTL = int(os.getenv("JOB_TTL", 3600))
+
+job_pool = concurrent.futures.ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="analysis-job")
+# Job records by job ID, exposed through GET /jobs/<id>
+job_store = make_store("jobs", ttl=JOB_TTL)
+analysis_jobs_lock = threading.Lock()
+jobs_pending = 0  # Queued plus running jobs on job_pool
+
+def submit_analysis_job(prepared, session_id, token=None, revision=False):
+    """Queue an analysis on the shared job pool (see analyze_with_gemini for revision).
+
+    Returns the new job record, or None when the pool's backlog is full and
+    the caller should answer with backpressure.
+    """
+    if not reserve_job_slot():
+        return None
+    record = new_job_record(session_id)
+    job_store.set(record["id"], record)
+    job_pool.submit(run_analysis_job, record, prepared, token, revision)
+    return record
+
+def submit_stream_job(job, prepared, categories=None, token=None, previous=None):
+    """Run an in-flight job's analysis on the job pool, counted like submit_analysis_job.
+
+    Returns False, abandoning the job so its waiters take over, when the
+    pool's backlog is full.
+    """
+    if not reserve_job_slot():
+        job.abandon(AnalysisCancelled("Too many pending analyses"))
         return False
+    
+    def run():
+        try:
+            job.run(run_leased_analysis, prepared, job.publish, categories, token, previous)
+        except Exception:
+            pass  # Waiters get the error from the job
+        finally:
+            release_job_slot()
+    
+    job_pool.submit(with_trace(run))
+    return True
 
-def parse_json_from_response(text):
-    """Extract JSON from the AI response with enhanced error handling."""
-    if not text or not isinstance(text, str):
-        print(f"⚠️ Invalid response text: {type(text)}")
-        return create_default_response()
-        
+def reserve_job_slot():
+    """Count one job against the pool's backlog; False, counting nothing, when it is full."""
+    global jobs_pending
+    with analysis_jobs_lock:
+        if jobs_pending >= JOB_WORKERS + JOB_QUEUE_LIMIT:
+            print(f"⚠️ Job queue full ({jobs_pending} pending), rejecting analysis")
+            return False
+        jobs_pending += 1
+        return True
+
+def release_job_slot():
+    global jobs_pending
+    with analysis_jobs_lock:
+        jobs_pending -= 1
+
+def new_job_record(session_id):
+    """Create the record GET /jobs/<id> reports for a queued analysis."""
+    return {
+        "id": uuid.uuid4().hex,
+        "status": "queued",
+        "session_id": session_id,
+        "created": time.time(),
+        "started": None,
+        "finished": None,
+        "results": None,
+        "error": None
+    }
+
+def run_analysis_job(record, prepared, token=None, revision=False):
+    """Worker body for a queued analysis job."""
+    trace = Trace(f"job {record['id']}")
+    set_current_trace(trace)
+    record["status"] = "running"
+    record["started"] = time.time()
+    job_store.set(record["id"], record)
     try:
-        # First, try to parse the entire response as JSON
-        return json.loads(text)
-    except json.JSONDecodeError:
+        print(f"🔄 Starting job {record['id']} for {prepared.filename}")
+        record["results"] = analyze_with_gemini(prepared, record["session_id"], token=token, revision=revision)
+        record["status"] = "complete"
+        print(f"✅ Job {record['id']} complete with {len(record['results'])} results")
+    except AnalysisCancelled as e:
+        print(f"🛑 Job {record['id']} cancelled: {str(e)}")
+        record["error"] = str(e)
+        record["status"] = "cancelled"
+    except Exception as e:
+        print(f"❌ Job {record['id']} failed: {str(e)}")
+        record["error"] = str(e)
+        record["status"] = "failed"
+    finally:
+        record["finished"] = time.time()
+        job_store.set(record["id"], record)
+        release_job_slot()
+        trace.log()
+        set_current_trace(None)
+
+# Global limits for Gemini calls, shared by every request in this process
+MODEL_MAX_CONCURRENCY = int(os.getenv("MODEL_MAX_CONCURRENCY", 6))
+MODEL_RATE_PER_MINUTE = float(os.getenv("MODEL_RATE_PER_MINUTE", 0))  # 0 disables the token bucket
+MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", 3))
+MODEL_BACKOFF_BASE = float(os.getenv("MODEL_BACKOFF_BASE", 1.0))  # Seconds before the first retry
+MODEL_CALL_ESTIMATE = float(os.getenv("MODEL_CALL_ESTIMATE", 8.0))  # Assumed call latency until one has been measured
+
+class TokenBucket:
+    """Blocking token bucket that admits `rate` calls per second with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take a token if one is available; otherwise return the seconds until one will be."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+class CallSlots:
+    """Concurrency slots shared by threads and event-loop tasks.
+
+    Threads block in acquire(); asyncio tasks await acquire_async(), which
+    holds no thread while it waits. A released slot goes to the longest
+    waiting caller of either kind, so the ASGI app's awaited calls and the
+    thread executor share one MODEL_MAX_CONCURRENCY budget.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._free = size
+        self._lock = threading.Lock()
+        self._waiters = deque()  # threading.Event, or (loop, future) for tasks
+
+    def acquire(self, timeout=None):
+        """Take a slot, waiting up to timeout seconds; returns whether one was taken."""
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return True
+            event = threading.Event()
+            self._waiters.append(event)
+        if event.wait(timeout):
+            return True
+        with self._lock:
+            if event in self._waiters:
+                self._waiters.remove(event)
+                return False
+        return True  # Handed over just as the wait timed out
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
         try:
-            # If that fails, try to find JSON within markdown code blocks
-            json_match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', text)
-            if json_match:
-                json_text = json_match.group(1).strip()
-                return json.loads(json_text)
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # Handed over as the task was cancelled; a cancelled future is passed on by _grant
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:
+                    continue  # Its event loop has closed
+            self._free += 1
+
+    def _grant(self, future):
+        if future.done():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def in_use(self):
+        with self._lock:
+            return self.size - self._free
+
+def is_rate_limit_error(error):
+    """Return True for quota/429 errors from the Gemini API."""
+    if getattr(error, "code", None) == 429 or type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    message = str(error).lower()
+    return "429" in message or "quota" in message or "rate limit" in message
+
+class ModelCallExecutor:
+    """Process-wide executor that admits every Gemini call through one global limiter.
+
+    Concurrency is capped by CallSlots (so calls made directly on request
+    threads, and the ASGI app's awaited calls, count too) and optionally by a
+    token bucket, both shared with asgi.AsyncModelLimiter. Rate-limit errors are
+    retried with full-jitter exponential backoff. A moving average of each
+    category's call latency decides whether a call can still finish before
+    its request's deadline.
+    """
+
+    def __init__(self, max_concurrency, rate_per_minute=0, max_retries=3, backoff_base=1.0):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency * 2, thread_name_prefix="model-call")
+        self.slots = CallSlots(max_concurrency)
+        self.bucket = TokenBucket(rate_per_minute / 60.0, max(1, max_concurrency)) if rate_per_minute > 0 else None
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self._latency = {}  # Category -> moving average of call seconds
+
+    def _count(self, field, delta):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + delta)
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn on the shared pool, under the caller's trace, and return its future."""
+        return self._pool.submit(with_trace(fn), *args, **kwargs)
+
+    def expected_seconds(self, category=""):
+        """Typical latency of a call for category, for deadline decisions."""
+        return self._latency.get(category, MODEL_CALL_ESTIMATE)
+
+    def _acquire_slot(self, token):
+        if token is None:
+            self.slots.acquire()
+            return
+        while not self.slots.acquire(timeout=CANCEL_POLL_INTERVAL):
+            token.check()
+
+    def generate(self, model, parts, category="", token=None, **kwargs):
+        """Call model.generate_content once admitted by the limiter, retrying rate-limit errors.
+
+        Time waiting for admission and time in the call itself are recorded as
+        the model_queue and model_call stages for `category`. With a token,
+        raises AnalysisCancelled instead of calling once it is cancelled or the
+        call could not finish before its deadline.
+        """
+        attempt = 0
+        while True:
+            self._count("queued", 1)
+            started = time.perf_counter()
+            try:
+                if token is not None:
+                    token.check(self.expected_seconds(category))
+                if self.bucket is not None:
+                    self.bucket.acquire()
+                self._acquire_slot(token)
+            finally:
+                self._count("queued", -1)
+                record_stage("model_queue", time.perf_counter() - started, category)
             
-            # If no code block, try to find anything that looks like a JSON object
-            json_match = re.search(r'(\{[\s\S]*\})', text)
-            if json_match:
-                return json.loads(json_match.group(1))
-        except Exception as e:
-            print(f"❌ JSON extraction failed: {str(e)}")
-    
-    return create_default_response()
+            if token is not None:
+                # Time spent queued may have used up the budget
+                try:
+                    token.check(self.expected_seconds(category))
+                except AnalysisCancelled:
+                    self.slots.release()
+                    raise
+            
+            self._count("in_flight", 1)
+            self._count("calls", 1)
+            started = time.perf_counter()
+            try:
+                response = model.generate_content(parts, **kwargs)
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    previous = self._latency.get(category)
+                    self._latency[category] = elapsed if previous is None else 0.8 * previous + 0.2 * elapsed
+                return response
+            except Exception as e:
+                rate_limited = is_rate_limit_error(e)
+                model_errors.inc("rate_limit" if rate_limited else "error", type(e).__name__)
+                if not rate_limited or attempt >= self.max_retries:
+                    self._count("errors", 1)
+                    raise
+                error = e
+            finally:
+                record_stage("model_call", time.perf_counter() - started, category)
+                self._count("in_flight", -1)
+                self.slots.release()
+            
+            # Back off outside the concurrency slot so other calls can proceed
+            delay = random.uniform(0, self.backoff_base * (2 ** attempt))
+            attempt += 1
+            self._count("retries", 1)
+            print(f"⏳ Rate limited ({str(error)[:80]}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+            if token is not None:
+                token.wait(delay)
+            else:
+                time.sleep(delay)
 
-def create_default_response():
-    """Create a default response structure for fallback scenarios."""
-    print(f"⚠️ Using default fallback JSON structure.")
-    return {
-        "issues": [
-            {
-                "title": "Analysis Formatting Error",
-                "description": "The AI provided analysis but in an unstructured format. Please try again.",
-                "severity": "medium"
+    def stats(self):
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "slots_in_use": self.slots.in_use(),
+                "queue_depth": self.queued,
+                "in_flight": self.in_flight,
+                "calls": self.calls,
+                "retries": self.retries,
+                "errors": self.errors,
+                "expected_seconds": {category: round(seconds, 3) for category, seconds in self._latency.items()}
+            }
+
+model_executor = ModelCallExecutor(MODEL_MAX_CONCURRENCY, MODEL_RATE_PER_MINUTE, MODEL_MAX_RETRIES, MODEL_BACKOFF_BASE)
+
+def call_model(parts, category="", token=None, **kwargs):
+    """Generate content with the shared model through the global limiter."""
+    return model_executor.generate(model, parts, category, token, **kwargs)
+
+def busy_response(body):
+    """Build a 429 response telling the client when to retry."""
+    response = make_response(jsonify(body), 429)
+    response.headers["Retry-After"] = str(JOB_RETRY_AFTER)
+    return response
+
+def run_coalesced(key, func, *args, token=None):
+    """Run func once per key; concurrent callers with the same key share its result.
+
+    If the caller running func is cancelled, a waiting caller runs it again itself.
+    """
+    while True:
+        job, is_leader = join_or_start_job(key)
+        if is_leader:
+            return job.run(func, *args)
+        result = wait_for_job(job, token)
+        if result is not None:
+            return result
+
+# Near-duplicate detection: uploads whose 64-bit dHash is within this Hamming
+# distance of an analyzed image reuse its results (0 disables the lookup)
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 5))
+PHASH_INDEX_SIZE = int(os.getenv("PHASH_INDEX_SIZE", 100000))
+# A 9x8 hash ignores shape, so a match must also have an aspect ratio within this
+# relative difference (and the same tiling), or a tall capture could reuse a screen's results
+PHASH_MAX_ASPECT_DIFF = float(os.getenv("PHASH_MAX_ASPECT_DIFF", 0.05))
+
+def compute_dhash(image, hash_size=8):
+    """Return the difference hash of a PIL image as a hash_size**2-bit integer."""
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+class HashIndex:
+    """Multi-index hashing over fixed-width perceptual hashes.
+
+    Each hash is split into max_distance + 1 disjoint chunks. By the pigeonhole
+    principle, any hash within max_distance bits of a query matches it exactly
+    in at least one chunk. A lookup therefore only compares hashes from those
+    few exact-match buckets instead of scanning the whole index.
+    """
+
+    def __init__(self, max_distance, bits=64, maxsize=None):
+        self.max_distance = max_distance
+        self.maxsize = maxsize
+        chunks = max_distance + 1
+        widths = [bits // chunks + (1 if i < bits % chunks else 0) for i in range(chunks)]
+        self._chunks = []
+        shift = bits
+        for width in widths:
+            shift -= width
+            self._chunks.append((shift, (1 << width) - 1))
+        self._buckets = [{} for _ in self._chunks]
+        self._entries = OrderedDict()  # hash -> key, oldest first
+        self._lock = threading.Lock()
+
+    def _bucket_keys(self, value):
+        return [(value >> shift) & mask for shift, mask in self._chunks]
+
+    def add(self, value, key):
+        with self._lock:
+            if value in self._entries:
+                self._entries[value] = key
+                self._entries.move_to_end(value)
+                return
+            self._entries[value] = key
+            for bucket, chunk in zip(self._buckets, self._bucket_keys(value)):
+                bucket.setdefault(chunk, set()).add(value)
+            # Evict the oldest hashes beyond the size bound
+            while self.maxsize is not None and len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, value):
+        del self._entries[value]
+        for bucket, chunk in zip(self._buckets, self._bucket_keys(value)):
+            members = bucket.get(chunk)
+            if members is not None:
+                members.discard(value)
+                if not members:
+                    del bucket[chunk]
+
+    def find(self, value, accept=None):
+        """Return (key, distance) of the closest hash within max_distance, or None.
+
+        If accept is given, only keys for which accept(key) is true can match.
+        """
+        best = None
+        with self._lock:
+            seen = set()
+            for bucket, chunk in zip(self._buckets, self._bucket_keys(value)):
+                for candidate in bucket.get(chunk, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    distance = (candidate ^ value).bit_count()
+                    if distance > self.max_distance or (best is not None and distance >= best[1]):
+                        continue
+                    key = self._entries[candidate]
+                    if accept is None or accept(key):
+                        best = (key, distance)
+        return best
+
+    def __len__(self):
+        return len(self._entries)
+
+phash_index = HashIndex(max(PHASH_MAX_DISTANCE, 0), maxsize=PHASH_INDEX_SIZE)
+
+# Longest edges handed to the model, and whether raw uploads are also kept on disk
+MAX_IMAGE_SIZE = (800, 800)
+SAVE_UPLOADS = os.getenv("SAVE_UPLOADS", "true").lower() in ("1", "true", "yes")
+
+# Upload ingestion: uploads are read in chunks and refused as soon as they grow past
+# MAX_UPLOAD_BYTES, don't start like a supported image, or declare more than
+# MAX_IMAGE_PIXELS in their header (a decompression bomb), before anything is decoded
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 50_000_000))
+# Also guards batch, zip and saved images
+Image.on_load(lambda module: setattr(module, "MAX_IMAGE_PIXELS", MAX_IMAGE_PIXELS))
+UPLOAD_CHUNK_BYTES = 64 * 1024
+# JPEG dimensions come after any EXIF/ICC blocks, so the header may need more than one chunk
+UPLOAD_HEADER_BYTES = 512 * 1024
+# Multipart framing and form fields around the image itself
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+# Leading bytes of each accepted format, by Pillow format name (WebP is RIFF....WEBP)
+IMAGE_SIGNATURES = {
+    "PNG": (b"\x89PNG\r\n\x1a\n",),
+    "JPEG": (b"\xff\xd8\xff",),
+    "GIF": (b"GIF87a", b"GIF89a"),
+    "BMP": (b"BM",),
+}
+IMAGE_FORMAT_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp", "GIF": ".gif", "BMP": ".bmp"}
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD
+
+# Encoding of the image sent to the model: "auto" picks format, quality and size per
+# image from its content; "source" keeps PNG uploads as PNG and sends the rest as JPEG;
+# any other name forces that encoding for every image
+IMAGE_ENCODINGS = ("auto", "source", "png", "png-palette", "jpeg", "webp")
+IMAGE_ENCODING = os.getenv("IMAGE_ENCODING", "auto").lower()
+if IMAGE_ENCODING not in IMAGE_ENCODINGS:
+    raise ValueError(f"❌ ERROR: IMAGE_ENCODING must be one of {', '.join(IMAGE_ENCODINGS)}")
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", 90))
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", 85))
+PHOTO_MAX_SIZE = (512, 512)  # Photos only have to be recognized as not UI
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", 80))
+PALETTE_MAX_COLORS = 32  # Screenshots whose dominant palette is at most this small use png-palette
+
+@functools.cache
+def webp_supported():
+    """Whether this Pillow build can encode WebP (checked on first use, like Pillow's import)."""
+    from PIL import features
+    return features.check("webp")
+
+# Tall full-page captures (height at least TILE_MIN_ASPECT times the width) are also cut
+# into overlapping viewport-shaped tiles, analyzed in parallel with one call per tile and merged (0 disables)
+TILE_MIN_ASPECT = float(os.getenv("TILE_MIN_ASPECT", 2.5))
+TILE_ASPECT = 0.75  # Tile height as a fraction of the page width, like a laptop viewport
+TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", 0.15))
+TILE_MAX_TILES = int(os.getenv("TILE_MAX_TILES", 8))
+DUPLICATE_TITLE_SIMILARITY = 0.85  # Titles of one type this similar (e.g. from overlapping tiles) are the same finding
+TILE_PROMPT = """
+
+This image is part {index} of {count} of a tall full-page screenshot, cut from top to bottom
+with some overlap. Only report what is visible in this part, and ignore the cut edges.
+"""
+# One call per tile covers every category; the whole page has already been checked for UI
+TILE_COMBINED_PROMPT = """
+Analyze this part of a user interface across the following categories:
+- "visual": visual design consistency. Consider color palette, typography, spacing, and alignment.
+- "ux-laws": UX laws and principles such as Fitts's Law, Hick's Law, and Jakob's Law. Do not include gestalt principles.
+- "cognitive": cognitive load. Identify areas that might be overwhelming or confusing for users.
+- "psychological": psychological effects such as color psychology, visual hierarchy, and emotional response.
+- "gestalt": Gestalt principles (proximity, similarity, continuity, closure, etc.).
+
+Format your response as a structured JSON object with the following format:
+{
+  "categories": {
+    "<category key>": {
+      "issues": [
+        {
+          "title": "Brief issue title",
+          "description": "Detailed explanation of the issue",
+          "severity": "high | medium | low"
+        }
+      ],
+      "recommendations": [
+        {
+          "title": "Brief recommendation title",
+          "description": "Detailed explanation of the recommendation",
+          "type": "improvement | fix | enhancement"
+        }
+      ]
+    }
+  }
+}
+
+Use exactly the category keys listed above and include up to 5 specific, actionable issues and recommendations for each.
+An empty list is fine for a category with nothing to report in this part.
+
+YOU MUST RETURN A VALID JSON OBJECT. DO NOT INCLUDE ANY EXPLANATION TEXT BEFORE OR AFTER THE JSON.
+"""
+
+class PreparedImage:
+    """An upload decoded once, downsized and encoded into one shared, read-only buffer.
+
+    `part` is passed straight to every model call, so the SDK never has to
+    re-encode a PIL image per call. `features` holds the content statistics
+    the encoding was chosen from, when computed, for the UI pre-filter to reuse.
+    `tiles` holds a PreparedImage per viewport-sized slice of a tall capture,
+    `luma` a grayscale thumbnail that later versions are diffed against and
+    `source_size` the (width, height) of the upload before it was downsized.
+    """
+
+    # Fields a deferred() image only prepares when first read
+    DEFERRED_FIELDS = ("data", "mime_type", "size", "encoding", "features", "tiles")
+
+    def __init__(self, data, mime_type, size, image_hash, filename="", path=None, phash=None,
+                 encoding=None, features=None, tiles=None, luma=None, source_size=None):
+        self.data = data
+        self.mime_type = mime_type
+        self.size = size
+        self.hash = image_hash
+        self.phash = phash
+        self.filename = filename
+        self.path = path
+        self.encoding = encoding
+        self.features = features
+        self.tiles = tiles or []
+        self.luma = luma
+        self.source_size = source_size
+
+    @classmethod
+    def deferred(cls, raw, filename, image_hash, phash, luma, source_size=None, tall=True):
+        """An upload whose analysis is already cached, prepared only if its pixels are read.
+
+        It carries what a cached analysis uses (hash, phash, luma and source size); raw is
+        decoded, resized and encoded on first access to a DEFERRED_FIELDS
+        field. A capture known not to be tall has no tiles to prepare.
+        """
+        prepared = cls.__new__(cls)
+        prepared.__dict__.update(hash=image_hash, filename=filename, path=None, phash=phash, luma=luma,
+                                 source_size=source_size, _raw=raw, _lock=threading.Lock())
+        if not tall:
+            prepared.tiles = []
+        return prepared
+
+    def __getattr__(self, name):
+        # Only reached for a field a deferred() image has not prepared yet
+        if name not in self.DEFERRED_FIELDS or "_raw" not in self.__dict__:
+            raise AttributeError(name)
+        with self._lock:
+            if name not in self.__dict__:
+                print(f"📏 Preparing cached upload {self.filename or self.hash[:12]} for its {name}")
+                loaded = prepare_image(self._raw, self.filename, image_hash=self.hash)
+                for field in self.DEFERRED_FIELDS:
+                    self.__dict__.setdefault(field, getattr(loaded, field))
+        return self.__dict__[name]
+
+    @property
+    def part(self):
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def to_image(self):
+        """Decode the downsized buffer for local (non-model) processing."""
+        return Image.open(io.BytesIO(self.data))
+
+def choose_encoding(content):
+    """Pick (encoding, quality, max_size) for an image from its content statistics.
+
+    Flat screenshots with a small palette quantize almost losslessly to an
+    8-bit PNG that keeps text edges sharp. Only images the UI pre-filter is
+    sure are photos go small as JPEG; anything else (UIs with imagery or
+    gradients) is sent at full size as WebP.
+    """
+    if content["flat_fraction"] >= 0.6 and content["palette_size"] <= PALETTE_MAX_COLORS:
+        return "png-palette", None, MAX_IMAGE_SIZE
+    if ui_prefilter(None, content)[0] is False:
+        return "jpeg", PHOTO_JPEG_QUALITY, PHOTO_MAX_SIZE
+    if webp_supported():
+        return "webp", WEBP_QUALITY, MAX_IMAGE_SIZE
+    return "jpeg", JPEG_QUALITY, MAX_IMAGE_SIZE
+
+def encode_image(image, encoding, quality=None):
+    """Encode an RGB image with one of the fixed IMAGE_ENCODINGS; returns (bytes, mime type)."""
+    buffer = io.BytesIO()
+    if encoding == "png-palette":
+        # No dithering: flat fills stay flat and compress to almost nothing
+        image.quantize(256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE).save(buffer, format="PNG")
+        return buffer.getvalue(), "image/png"
+    if encoding == "png":
+        image.save(buffer, format="PNG")
+        return buffer.getvalue(), "image/png"
+    if encoding == "webp":
+        image.save(buffer, format="WEBP", quality=quality or WEBP_QUALITY, method=4)
+        return buffer.getvalue(), "image/webp"
+    if encoding == "jpeg":
+        image.save(buffer, format="JPEG", quality=quality or JPEG_QUALITY)
+        return buffer.getvalue(), "image/jpeg"
+    raise ValueError(f"Unknown image encoding: {encoding}")
+
+def prepare_image(raw, filename="", max_size=MAX_IMAGE_SIZE, image_hash=None, encoding=None, quality=None):
+    """Decode raw upload bytes once and return a downsized, encoded PreparedImage.
+
+    encoding and quality override IMAGE_ENCODING and the configured quality
+    of a fixed encoding (e.g. for benchmarks).
+    """
+    encoding = encoding or IMAGE_ENCODING
+    if image_hash is None:
+        image_hash = hashlib.sha256(raw).hexdigest()
+    
+    with timed_stage("resize"):
+        image = Image.open(io.BytesIO(raw))
+        source_format = image.format
+        source_size = image.size
+        tall = is_tall(source_size)
+        if source_format == "JPEG" and not tall:
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale instead of full resolution
+            image.draft("RGB", max_size)
+        source = image.convert("RGB")
+        # Tiles are cut from the full-resolution page, so keep it
+        image = source.copy() if tall else source
+        # reducing_gap shrinks with a fast integer reduce() before the LANCZOS pass
+        image.thumbnail(max_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    
+    with timed_stage("encode"):
+        image, data, mime_type, label, content = encode_for_model(image, encoding, quality, source_format, max_size)
+    
+    with timed_stage("phash"):
+        phash = compute_dhash(image)
+        luma = compute_luma(image)
+    
+    tiles = []
+    if tall:
+        with timed_stage("tile"):
+            boxes = tile_boxes(source.size)
+            for index, box in enumerate(boxes):
+                tile = source.crop(box)
+                tile.thumbnail(max_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+                tile, tile_data, tile_mime, tile_label, _ = encode_for_model(tile, encoding, quality, source_format, max_size)
+                # Tiles are keyed by content, so unchanged slices of a re-upload reuse their results
+                tiles.append(PreparedImage(tile_data, tile_mime, tile.size, hashlib.sha256(tile_data).hexdigest(),
+                                           f"{filename} [tile {index + 1}/{len(boxes)}]", encoding=tile_label))
+    
+    tiled = f", {len(tiles)} tiles of {tiles[0].size[0]}x{tiles[0].size[1]}" if tiles else ""
+    print(f"📏 Prepared {filename or image_hash[:12]} at {image.size[0]}x{image.size[1]} as {label} ({len(data)} bytes{tiled})")
+    return PreparedImage(data, mime_type, image.size, image_hash, filename, phash=phash, encoding=label,
+                         features=content, tiles=tiles, luma=luma, source_size=source_size)
+
+def encode_for_model(image, encoding, quality, source_format, max_size):
+    """Resolve auto/source to a fixed encoding and encode a downsized image.
+
+    Returns (image, data, mime type, encoding label, content statistics or None);
+    the image is smaller than the one passed in if its encoding calls for it.
+    """
+    content = None
+    if encoding == "auto":
+        content = ui_prefilter_features(image)
+        encoding, quality, target = choose_encoding(content)
+        image.thumbnail((min(target[0], max_size[0]), min(target[1], max_size[1])), Image.Resampling.LANCZOS)
+    elif encoding == "source":
+        encoding = "png" if source_format == "PNG" else "jpeg"
+    data, mime_type = encode_image(image, encoding, quality)
+    label = f"{encoding} q{quality}" if quality else encoding
+    return image, data, mime_type, label, content
+
+def is_tall(size):
+    """Whether an image of this size is a full-page capture that should be tiled."""
+    width, height = size
+    return TILE_MIN_ASPECT > 0 and TILE_MAX_TILES > 1 and height >= width * TILE_MIN_ASPECT
+
+def tile_boxes(size):
+    """Crop boxes of overlapping, evenly spaced viewport-shaped tiles covering a tall image top to bottom.
+
+    Tiles are TILE_ASPECT times as tall as the image is wide and overlap by at
+    least TILE_OVERLAP of their height, so a control cut by one tile's edge is
+    whole in the next. Pages too long for TILE_MAX_TILES get taller tiles.
+    """
+    width, height = size
+    tile_height = max(1, int(width * TILE_ASPECT))
+    stride = tile_height * (1 - TILE_OVERLAP)
+    count = 1 + max(0, int(np.ceil((height - tile_height) / stride)))
+    if count > TILE_MAX_TILES:
+        count = TILE_MAX_TILES
+        tile_height = int(np.ceil(height / (1 + (count - 1) * (1 - TILE_OVERLAP))))
+    step = (height - tile_height) / (count - 1) if count > 1 else 0
+    return [(0, round(i * step), width, min(height, round(i * step) + tile_height)) for i in range(count)]
+
+def tile_prompt(prompt, index, count):
+    """A category prompt for tile `index` (0-based) of `count`."""
+    return prompt + TILE_PROMPT.format(index=index + 1, count=count)
+
+def tiles_to_analyze(prepared, categories):
+    """(index, tile) for each tile still missing more than one of categories from the cache.
+
+    Those get one TILE_COMBINED_PROMPT call each; a single missing category
+    is cheaper as its own call.
+    """
+    return [(index, tile) for index, tile in enumerate(prepared.tiles)
+            if sum(category_cache.get(category_key(tile.hash, category)) is None for category in categories) > 1]
+
+class UploadRejected(ValueError):
+    """An upload refused before decoding; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def sniff_image_format(head):
+    """The Pillow format name of an accepted image from its first bytes, or None."""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    for name, signatures in IMAGE_SIGNATURES.items():
+        if head.startswith(signatures):
+            return name
+    return None
+
+class UploadReader:
+    """Takes an upload chunk by chunk, hashing it and checking it as it arrives.
+
+    feed() raises UploadRejected as soon as the upload is over max_bytes,
+    its first bytes are not a PNG, JPEG, WebP, GIF or BMP signature, or its
+    header declares more than MAX_IMAGE_PIXELS. Once finish() returns the
+    bytes, `hash` is already their sha256, so nothing reads them twice.
+    """
+
+    def __init__(self, filename="", max_bytes=MAX_UPLOAD_BYTES):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.format = None
+        self.size = None  # (width, height) once the header has been read
+        self._buffer = bytearray()
+        self._sha256 = hashlib.sha256()
+
+    @property
+    def hash(self):
+        return self._sha256.hexdigest()
+
+    def feed(self, chunk):
+        if len(self._buffer) + len(chunk) > self.max_bytes:
+            raise UploadRejected(f"{self.filename or 'Upload'} is larger than {self.max_bytes} bytes", 413)
+        self._buffer += chunk
+        self._sha256.update(chunk)
+        if self.size is None:
+            self._check_header(final=False)
+
+    def finish(self):
+        """Return the whole upload once every chunk has been fed."""
+        if not self._buffer:
+            raise UploadRejected("Empty file")
+        if self.size is None:
+            self._check_header(final=True)
+        return bytes(self._buffer)
+
+    def _check_header(self, final):
+        head = bytes(self._buffer[:UPLOAD_HEADER_BYTES])
+        if self.format is None:
+            if len(head) < 12 and not final:
+                return
+            self.format = sniff_image_format(head)
+            if self.format is None:
+                raise UploadRejected(f"{self.filename or 'Upload'} is not a PNG, JPEG, WebP, GIF or BMP image", 415)
+        try:
+            # Opening only parses the header; no pixel data is decoded
+            with Image.open(io.BytesIO(head), formats=[self.format]) as image:
+                width, height = image.size
+        except Image.DecompressionBombError as e:
+            raise UploadRejected(f"Image is too large to decode: {str(e)}", 413)
+        except Exception:
+            if final or len(head) >= UPLOAD_HEADER_BYTES:
+                raise UploadRejected(f"{self.filename or 'Upload'} has an unreadable {self.format} header")
+            return  # Header not complete yet
+        if width * height > MAX_IMAGE_PIXELS:
+            raise UploadRejected(f"Image is {width}x{height}, more than {MAX_IMAGE_PIXELS} pixels", 413)
+        self.size = (width, height)
+
+def load_upload(file):
+    """Read an uploaded file into a PreparedImage, saving the original bytes if configured.
+
+    The stream is read in UPLOAD_CHUNK_BYTES chunks through an UploadReader.
+    Raises UploadRejected (a ValueError) for oversized, non-image or
+    decompression-bomb uploads, and ValueError if the image is unreadable.
+    """
+    reader = UploadReader(file.filename)
+    with timed_stage("upload_read"):
+        for chunk in iter(functools.partial(file.stream.read, UPLOAD_CHUNK_BYTES), b""):
+            reader.feed(chunk)
+        raw = reader.finish()
+    return prepare_upload(raw, file.filename, reader.hash, reader.format, reader.size)
+
+def prepare_upload(raw, filename, image_hash=None, image_format=None, size=None):
+    """Prepare raw upload bytes and save the original if configured; see load_upload.
+
+    size is the (width, height) from the header, if already read.
+    """
+    prepared = prepare_or_defer(raw, filename, image_hash or hashlib.sha256(raw).hexdigest(), size)
+
+    if SAVE_UPLOADS:
+        # Add timestamp to prevent overwrites; the original is never rewritten. The name is
+        # the client's, made safe, with the extension of the format actually received
+        stem, extension = os.path.splitext(secure_filename(os.path.basename(filename or "")))
+        extension = IMAGE_FORMAT_EXTENSIONS.get(image_format, extension)
+        filename = f"{int(time.time())}_{stem or 'upload'}{extension}"
+        prepared.path = os.path.join(UPLOAD_FOLDER, filename)
+        with timed_stage("upload_save"), open(prepared.path, "wb") as f:
+            f.write(raw)
+        upload_index.add(prepared.path, len(raw))
+    return prepared
+
+def prepare_or_defer(raw, filename, image_hash, size=None):
+    """Prepare raw image bytes, unless the analysis of image_hash is already cached.
+
+    A cached image is looked up by hash before anything is decoded and comes
+    back as a PreparedImage.deferred(). Raises ValueError if the image is
+    unreadable.
+    """
+    meta = image_meta_cache.get(image_hash)
+    if meta is not None and not needs_model_call(image_hash):
+        print(f"🔄 Analysis of {filename or image_hash[:12]} is cached, skipping its decode")
+        return PreparedImage.deferred(raw, filename, image_hash, meta["phash"], meta["luma"],
+                                      source_size=meta.get("source_size") or size,
+                                      tall=size is None or is_tall(size))
+    try:
+        prepared = prepare_image(raw, filename, image_hash=image_hash)
+    except Exception as e:
+        raise ValueError(f"Unreadable image: {str(e)}")
+    image_meta_cache.set(image_hash, {"phash": prepared.phash, "luma": prepared.luma,
+                                      "source_size": prepared.source_size})
+    return prepared
+
+def load_saved_image(image_path):
+    """Rebuild a PreparedImage from an upload previously kept on disk."""
+    with open(image_path, "rb") as f:
+        prepared = prepare_image(f.read(), os.path.basename(image_path))
+    prepared.path = image_path
+    return prepared
+
+# Local UI pre-filter: decides obvious screenshots and photos from image statistics
+# so only borderline images cost a UI_DETECTION_PROMPT call
+UI_PREFILTER = os.getenv("UI_PREFILTER", "true").lower() in ("1", "true", "yes")
+# Width/height ratios of common desktop, laptop and phone screens
+SCREEN_ASPECTS = (16 / 9, 16 / 10, 4 / 3, 3 / 2, 21 / 9, 9 / 16, 10 / 16, 3 / 4, 9 / 19.5, 9 / 20)
+# Horizontal (and as many vertical) bands the frame is cut into when looking for flat fills
+PREFILTER_STRIPS = 16
+
+def long_run_pixels(mask, min_len):
+    """Count pixels in, and the number of, horizontal runs of True at least min_len long."""
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    steps = np.diff(padded, axis=1)
+    starts = np.nonzero(steps == 1)[1]
+    ends = np.nonzero(steps == -1)[1]
+    lengths = ends - starts
+    long_runs = lengths[lengths >= min_len]
+    return int(long_runs.sum()), int(long_runs.size)
+
+def ui_prefilter_features(image):
+    """Compute cheap UI-vs-photo statistics on a small grayscale/RGB copy of the image."""
+    small = image.convert("RGB")
+    small.thumbnail((320, 320))
+    pixels = np.asarray(small, dtype=np.int16)
+    gray = (pixels[..., 0] * 299 + pixels[..., 1] * 587 + pixels[..., 2] * 114) // 1000
+    
+    grad_x = np.abs(np.diff(gray, axis=1))[:-1, :]
+    grad_y = np.abs(np.diff(gray, axis=0))[:, :-1]
+    magnitude = grad_x + grad_y
+    edges = magnitude > 40
+    
+    # Palette: colors quantized to 4 bits per channel
+    quantized = pixels >> 4
+    codes = (quantized[..., 0] << 8) | (quantized[..., 1] << 4) | quantized[..., 2]
+    counts = np.sort(np.bincount(codes.ravel(), minlength=4096))[::-1]
+    coverage = np.cumsum(counts) / codes.size
+    
+    # Axis-aligned structure: edge pixels lying on long horizontal or vertical runs,
+    # the borders of cards, buttons, inputs and panels
+    height, width = gray.shape
+    h_pixels, h_runs = long_run_pixels(grad_y > 40, max(8, width // 20))
+    v_pixels, v_runs = long_run_pixels((grad_x > 40).T, max(8, height // 20))
+    
+    # Graphic strips: rows or columns of the frame that are almost all one flat fill, like a
+    # nav bar, sidebar, card or page margin. A photograph has texture or shading in each one
+    still = magnitude <= 1
+    fills = codes[:-1, :-1]
+    graphic_strips = 0
+    for axis, length in ((0, still.shape[0]), (1, still.shape[1])):
+        for i in range(PREFILTER_STRIPS):
+            band = slice(i * length // PREFILTER_STRIPS, (i + 1) * length // PREFILTER_STRIPS)
+            strip = still[band] if axis == 0 else still[:, band]
+            colors = fills[band] if axis == 0 else fills[:, band]
+            if strip.size == 0:
+                continue
+            top_two = np.sort(np.bincount(colors.ravel(), minlength=4096))[-2:].sum() / colors.size
+            if min(float(strip.mean()), top_two) >= 0.5:
+                graphic_strips += 1
+    
+    aspect = image.width / image.height
+    return {
+        "edge_density": float(edges.mean()),
+        "flat_fraction": float((magnitude <= 2).mean()),
+        "top_colors": float(coverage[7]),
+        "palette_size": int(np.searchsorted(coverage, 0.9)) + 1,
+        "axis_alignment": (h_pixels + v_pixels) / max(1, int(edges.sum())),
+        "axis_lines": h_runs + v_runs,
+        "graphic_strips": graphic_strips,
+        "screen_aspect": any(abs(aspect / ratio - 1) < 0.03 for ratio in SCREEN_ASPECTS)
+    }
+
+def ui_prefilter(image, f=None):
+    """Classify obvious cases locally.
+
+    Returns (verdict, features) where verdict is True/False for confident
+    decisions and None for borderline images that need the model. Features
+    already computed for the image can be passed as f.
+    """
+    if f is None:
+        f = ui_prefilter_features(image)
+    
+    # Photographs: few flat regions, colors spread over a large palette and no strip of the
+    # frame that is a flat fill. A hero or gallery page shares the first two, but its nav
+    # bar, cards or margins show up as graphic strips, so it goes to the model instead
+    if (f["flat_fraction"] < 0.35 and f["top_colors"] < 0.5 and f["palette_size"] > 100
+            and f["graphic_strips"] == 0):
+        return False, f
+    
+    # Screenshots: mostly flat fills, a handful of dominant colors and ruled structure
+    structured = f["axis_alignment"] >= 0.08 or (f["screen_aspect"] and f["axis_lines"] >= 5)
+    if (f["flat_fraction"] >= 0.6 and f["top_colors"] >= 0.7 and f["palette_size"] <= 40
+            and f["axis_lines"] >= 3 and structured):
+        return True, f
+    
+    return None, f
+
+def prefilter_ui(prepared):
+    """Run the local pre-filter and cache a confident verdict; returns it or None."""
+    if not UI_PREFILTER:
+        return None
+    try:
+        started = time.perf_counter()
+        verdict, _ = ui_prefilter(prepared.to_image(), prepared.features)
+        elapsed = (time.perf_counter() - started) * 1000
+        record_stage("ui_prefilter", elapsed / 1000)
+    except Exception as e:
+        print(f"❌ Error in UI pre-filter: {str(e)}")
+        return None
+    
+    if verdict is None:
+        print(f"🔍 UI pre-filter undecided for {prepared.filename} ({elapsed:.1f} ms), asking Gemini")
+        return None
+    print(f"🔍 UI pre-filter for {prepared.filename}: {'✅ UI detected' if verdict else '❌ Not UI'} ({elapsed:.1f} ms)")
+    ui_detection_cache.set(ui_key(prepared.hash), verdict)
+    return verdict
+
+def is_cacheable_result(result):
+    """Only complete analyses are cached, never error or fallback placeholders."""
+    if not isinstance(result, dict) or result.get("confidence") != "High":
+        return False
+    return not any(item.get("title") in FALLBACK_TITLES for item in result.get("items", []))
+
+def is_ui_image(prepared, token=None):
+    """Determine if the uploaded image is UI-related."""
+    with timed_stage("ui_detection"):
+        # First check in-memory cache
+        cached = ui_detection_cache.get(ui_key(prepared.hash))
+        if cached is not None:
+            print(f"🔄 UI detection cache hit for {prepared.filename}")
+            return cached
+        
+        # Obvious screenshots and photos are decided locally in a few milliseconds
+        verdict = prefilter_ui(prepared)
+        if verdict is not None:
+            return verdict
+        
+        # Requests racing on the same image share a single model call
+        return run_coalesced(("ui", prepared.hash), detect_ui, prepared, token, token=token)
+
+def detect_ui(prepared, token=None):
+    """Ask Gemini whether the image is UI-related and cache the verdict."""
+    try:
+        # Ask Gemini if this image contains UI elements
+        response = call_model([UI_DETECTION_PROMPT, prepared.part], "ui-detection", token, stream=False)
+        return apply_ui_response(prepared, response.text)
+    except AnalysisCancelled:
+        raise
+    except Exception as e:
+        print(f"❌ Error during UI detection: {str(e)}")
+        # In case of errors, default to not a UI
+        return False
+
+def apply_ui_response(prepared, text):
+    """Turn a UI_DETECTION_PROMPT answer into a verdict and cache it."""
+    # Check if the response indicates this is a UI image
+    is_ui = "YES" in text.strip().upper()
+    
+    # Store in cache
+    ui_detection_cache.set(ui_key(prepared.hash), is_ui)
+    
+    print(f"🔍 UI detection for {prepared.filename}: {'✅ UI detected' if is_ui else '❌ Not UI'}")
+    return is_ui
+
+# Bounds for extract_json_object; longer or deeper output is treated as unparseable
+MAX_RESPONSE_CHARS = int(os.getenv("MAX_RESPONSE_CHARS", 500000))
+MAX_JSON_DEPTH = 64
+CLOSERS = {"{": "}", "[": "]"}
+# The scanner jumps between structural characters; both patterns match in linear time
+JSON_STRUCTURE = re.compile(r'[{}\[\]"]')
+JSON_STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)  # From after an opening quote
+JSON_OBJECT_START = re.compile(r'\{\s*["}]')  # An object opens with a key or is empty
+TRAILING_COMMA = re.compile(r'("[^"\\]*(?:\\.[^"\\]*)*")|,(\s*[}\]])', re.DOTALL)
+
+def strip_trailing_commas(text):
+    """Remove commas directly before a closing bracket, leaving strings untouched."""
+    return TRAILING_COMMA.sub(lambda m: m.group(1) or m.group(2), text)
+
+def loads_lenient(text):
+    """json.loads, retried once without trailing commas; returns None if both fail."""
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    try:
+        return json.loads(strip_trailing_commas(text))
+    except json.JSONDecodeError:
+        return None
+
+def next_json_object(text, pos):
+    """Index of the next "{" at or after pos that can open a JSON object, or -1."""
+    match = JSON_OBJECT_START.search(text, pos)
+    return match.start() if match else -1
+
+def extract_json_object(text):
+    """Recover the first JSON object in model output with a single bracket-balancing scan.
+
+    Prose and code fences around the object are skipped, and a balanced
+    candidate that fails to parse is skipped as a whole, so the scan never
+    revisits text. If the output ends mid-object (e.g. cut off at
+    max_output_tokens), it is cut back to the last complete nested value and
+    the open brackets are closed, which keeps every complete `issues` or
+    `recommendations` entry. Returns None when nothing can be recovered.
+    """
+    text = text[:MAX_RESPONSE_CHARS]
+    start = pos = next_json_object(text, 0)
+    stack = []
+    safe_point = None  # (end index, open brackets) just after the last complete nested value
+    
+    while start >= 0:
+        match = JSON_STRUCTURE.search(text, pos)
+        if match is None:
+            break
+        i, ch = match.start(), match.group()
+        
+        if ch == '"':
+            rest = JSON_STRING_REST.match(text, i + 1)
+            if rest is None:
+                break  # Cut off inside a string
+            pos = rest.end()
+            continue
+        pos = i + 1
+        
+        if ch in CLOSERS:
+            stack.append(ch)
+            if len(stack) > MAX_JSON_DEPTH:
+                return None
+            continue
+        
+        if stack and CLOSERS[stack[-1]] == ch:
+            stack.pop()
+            if stack:
+                safe_point = (pos, tuple(stack))
+                continue
+            data = loads_lenient(text[start:pos])
+            if isinstance(data, dict):
+                return data
+        
+        # A stray closer or a balanced candidate that is not JSON: try the next object
+        stack, safe_point = [], None
+        start = pos = next_json_object(text, pos)
+    
+    # Truncated: close the brackets that were open after the last complete value
+    if start >= 0 and safe_point is not None:
+        end, open_brackets = safe_point
+        data = loads_lenient(text[start:end] + "".join(CLOSERS[b] for b in reversed(open_brackets)))
+        if isinstance(data, dict):
+            print(f"🩹 Recovered truncated JSON ({len(text) - end} trailing chars dropped)")
+            return data
+    return None
+
+def parse_json_from_response(text):
+    """Extract JSON from the AI response with enhanced error handling."""
+    if not text or not isinstance(text, str):
+        print(f"⚠️ Invalid response text: {type(text)}")
+        return create_default_response()
+    
+    try:
+        # First, try to parse the entire response as JSON
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    
+    # Otherwise recover the object from prose, code fences or a truncated answer
+    data = extract_json_object(text)
+    if data is not None:
+        return data
+    
+    print(f"❌ JSON extraction failed for a {len(text)}-char response")
+    return create_default_response()
+
+def create_default_response():
+    """Create a default response structure for fallback scenarios."""
+    print(f"⚠️ Using default fallback JSON structure.")
+    return {
+        "issues": [
+            {
+                "title": "Analysis Formatting Error",
+                "description": "The AI provided analysis but in an unstructured format. Please try again.",
+                "severity": "medium"
             }
         ],
         "recommendations": [
@@ -384,172 +2352,1276 @@ def process_gemini_response(text):
     
     return cleaned_text
 
-def analyze_with_gemini(image_path, session_id):
-    """Analyze the uploaded image using Gemini AI for all UX categories."""
-    # Update session-specific data
-    session_data[session_id] = {
-        'image_path': image_path,
-        'analysis': [],
-        'timestamp': time.time()
-    }
+def analyze_with_gemini(prepared, session_id, categories=None, token=None, revision=False):
+    """Analyze the uploaded image using Gemini AI for all UX categories (or only `categories`).
+
+    With revision, the upload is a new version of the session's current
+    image, and only what changed since it is re-analyzed (see
+    run_revision_analysis). Raises AnalysisCancelled if a newer upload in
+    the session supersedes this one.
+    """
+    # Read the version being revised before the session moves on to this upload
+    previous = revision_base(session_id, prepared) if revision else None
+    if token is None:
+        token = start_session_token(session_id, prepared.hash)
+    try:
+        # Update session-specific data
+        update_session(session_id, image_path=prepared.path, image_hash=prepared.hash, luma=prepared.luma,
+                       analysis=[], timestamp=time.time())
+        
+        results = run_shared_analysis(prepared, categories, token, previous)
+        
+        # Update session data with analysis results, unless the session has moved on to another image
+        store_session_results(session_id, prepared.hash, results)
+        return results
+    finally:
+        release_session_token(session_id, token)
+
+def run_shared_analysis(prepared, categories=None, token=None, previous=None):
+    """Analyze an image, joining an in-flight analysis of the same image (e.g. one started by /preprocess).
+
+    categories restricts the analysis to those UX categories; a full
+    analysis already in flight is joined and filtered instead. If the
+    request running a joined analysis is cancelled, this one takes over.
+    previous is passed on to run_analysis. Analyses running in other worker
+    processes are joined through run_leased_analysis.
+    """
+    while True:
+        if categories is not None:
+            job = inflight_jobs.get(analysis_job_key(prepared.hash))
+            if job is not None:
+                with timed_stage("inflight_wait"):
+                    results = wait_for_job(job, token, categories)
+                if results is not None:
+                    return select_categories(results, categories)
+                continue
+        
+        job, is_leader = join_or_start_job(analysis_job_key(prepared.hash, categories))
+        if is_leader:
+            job.run(run_leased_analysis, prepared, job.publish, categories, token, previous)
+            return job.wait()
+        with timed_stage("inflight_wait"):
+            results = wait_for_job(job, token, categories or list(UX_PROMPTS))
+        if results is not None:
+            return results
+
+# With STORE_BACKEND=sqlite the worker analyzing an image holds a lease on it in the shared
+# store, so other worker processes wait for its results instead of repeating its model calls
+ANALYSIS_LEASE_TTL = float(os.getenv("ANALYSIS_LEASE_TTL", 60))  # Seconds a lease lasts without renewal
+ANALYSIS_LEASE_POLL = float(os.getenv("ANALYSIS_LEASE_POLL", 0.5))  # Seconds between checks of another worker's analysis
+# Analysis leases, keyed by analysis_job_key(image hash) -> {"owner", "started"}
+analysis_leases = make_store("analysis_leases", ttl=ANALYSIS_LEASE_TTL)
+
+def acquire_analysis_lease(image_hash):
+    """Take the lease on analyzing image_hash; returns its owner ID, or None if another worker holds it."""
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    if analysis_leases.add(analysis_job_key(image_hash), {"owner": owner, "started": time.time()}):
+        return owner
+    return None
+
+def renew_analysis_lease(image_hash, owner):
+    """Extend a lease by another ANALYSIS_LEASE_TTL, unless it has lapsed to another worker."""
+    lease = analysis_leases.get(analysis_job_key(image_hash))
+    if lease is not None and lease.get("owner") == owner:
+        analysis_leases.set(analysis_job_key(image_hash), lease)
+
+def release_analysis_lease(image_hash, owner):
+    lease = analysis_leases.get(analysis_job_key(image_hash))
+    if lease is not None and lease.get("owner") == owner:
+        analysis_leases.delete(analysis_job_key(image_hash))
+
+def leased_analysis_state(image_hash, requested):
+    """(results, cached, leased) of an analysis another worker may be running.
+
+    results is the requested categories once all are cached (or the not-UI
+    result), else None; cached holds the ones cached so far; leased is
+    whether a worker still holds the image's lease.
+    """
+    if ui_detection_cache.get(ui_key(image_hash)) is False:
+        return create_not_ui_result(), [], False
+    cached = [result for result in (category_cache.get(category_key(image_hash, category)) for category in requested)
+              if result is not None]
+    if len(cached) == len(requested):
+        return sorted(cached, key=lambda x: x.get('category', '')), cached, False
+    return None, cached, analysis_leases.get(analysis_job_key(image_hash)) is not None
+
+def wait_for_leased_analysis(image_hash, requested, token=None, on_result=None):
+    """Wait for another worker's analysis of image_hash, reading its results from the shared caches.
+
+    Returns the requested categories once all are cached, or None as soon
+    as no worker holds the lease (it finished short of them, or died) so the
+    caller can run the analysis itself. on_result is called with each
+    category as it is cached. At token's deadline, returns the cached
+    categories plus skipped placeholders; raises AnalysisCancelled if the
+    token is cancelled.
+    """
+    seen = set()
+    waiting = False
+    while True:
+        results, cached, leased = leased_analysis_state(image_hash, requested)
+        for result in results or cached:
+            if on_result is not None and result.get("category") not in seen:
+                seen.add(result.get("category"))
+                on_result(result)
+        if results is not None:
+            return results
+        if not leased:
+            return None
+        if not waiting:
+            waiting = True
+            print(f"🔗 Waiting for another worker's analysis of {image_hash[:12]}")
+        if token is None:
+            time.sleep(ANALYSIS_LEASE_POLL)
+            continue
+        try:
+            token.check()
+        except DeadlineExceeded:
+            return sorted(complete_with_skipped(cached, requested), key=lambda x: x.get('category', ''))
+        remaining = token.remaining()
+        token.wait(ANALYSIS_LEASE_POLL if remaining is None else min(ANALYSIS_LEASE_POLL, remaining))
+
+def run_leased_analysis(prepared, on_result=None, categories=None, token=None, previous=None):
+    """run_analysis, coalesced across worker processes when the stores are shared.
+
+    With STORE_BACKEND=sqlite the worker that starts an analysis holds the
+    image's lease while it runs (renewed as results come in), and the others
+    wait for its results instead. If the lease lapses first, the next waiter
+    takes it over and computes only what is still missing.
+    """
+    if STORE_BACKEND != "sqlite":
+        return run_analysis(prepared, on_result, categories, token, previous)
+    
+    requested = categories or list(UX_PROMPTS)
+    published = set()
+    owner = None
+    
+    def publish(result):
+        # A waiter that takes over re-emits what it already passed on from the cache
+        if result.get("category") in published:
+            return
+        published.add(result.get("category"))
+        if owner is not None:
+            renew_analysis_lease(prepared.hash, owner)
+        if on_result is not None:
+            on_result(result)
+    
+    while True:
+        if not needs_model_call(prepared.hash, requested):
+            return run_analysis(prepared, publish, categories, token, previous)
+        owner = acquire_analysis_lease(prepared.hash)
+        if owner is not None:
+            try:
+                return run_analysis(prepared, publish, categories, token, previous)
+            finally:
+                release_analysis_lease(prepared.hash, owner)
+        with timed_stage("inflight_wait"):
+            results = wait_for_leased_analysis(prepared.hash, requested, token, publish)
+        if results is not None:
+            return results
+
+def refresh_session_categories(session_id, data, categories, token=None):
+    """Return a session's results for categories, recomputing only the missing or failed ones.
+
+    Good results are merged back into the session so other tabs keep them.
+    """
+    image_hash = data.get('image_hash')
+    current = {r.get('category'): r for r in session_results(data) if r.get('category') in UX_PROMPTS}
+    
+    # Results cached by other requests for this image cost nothing
+    missing = []
+    for category in categories:
+        if is_cacheable_result(current.get(category)):
+            continue
+        cached = category_cache.get(category_key(image_hash, category))
+        if cached is not None:
+            current[category] = cached
+        else:
+            missing.append(category)
+    
+    if missing:
+        if ui_detection_cache.get(ui_key(image_hash)) is False:
+            return create_not_ui_result()
+        
+        job = inflight_jobs.get(analysis_job_key(image_hash))
+        results = wait_for_job(job, token, missing) if job is not None else None
+        if results is not None:
+            results = select_categories(results, missing)
+        elif data.get('image_path') and os.path.exists(data['image_path']):
+            results = run_shared_analysis(load_saved_image(data['image_path']), missing, token)
+        else:
+            results = []
+        
+        # A non-UI verdict or a failed run answers for the whole image
+        if any(r.get('category') == 'error' for r in results):
+            return results
+        current.update((r['category'], r) for r in results)
+    
+    store_session_results(session_id, image_hash, sorted(current.values(), key=lambda x: x.get('category', '')))
+    return [current[category] for category in categories if category in current]
+
+def analysis_job_key(image_hash, categories=None):
+    """In-flight job key for a full analysis, or for one subset of categories."""
+    if categories is None:
+        return ("analysis", image_hash)
+    return ("analysis", image_hash, tuple(categories))
+
+def parse_categories(value):
+    """Parse a comma-separated ?categories= value into UX_PROMPTS order.
+
+    Returns None (every category) for an empty value and raises ValueError
+    naming any unknown category.
+    """
+    if not value:
+        return None
+    requested = {c.strip() for c in value.split(",") if c.strip()}
+    unknown = requested - set(UX_PROMPTS)
+    if unknown:
+        raise ValueError(f"Unknown categories: {', '.join(sorted(unknown))}. Valid: {', '.join(UX_PROMPTS)}")
+    return [c for c in UX_PROMPTS if c in requested] or None
+
+def select_categories(results, categories):
+    """Keep the results for categories, plus any image-level error such as a non-UI verdict."""
+    return [r for r in results if r.get("category") in categories or r.get("category") == "error"]
+
+def wait_for_calls(futures, token=None):
+    """Wait for model calls submitted to the executor, checking the token while waiting.
+
+    Failed calls are ignored; callers read what they produced from the
+    caches. Calls not yet started are dropped once the token is cancelled
+    or expired, and AnalysisCancelled is raised.
+    """
+    pending = set(futures)
+    while pending:
+        _, pending = concurrent.futures.wait(pending, timeout=None if token is None else CANCEL_POLL_INTERVAL)
+        if pending and token is not None and (token.cancelled or token.expired()):
+            for future in pending:
+                future.cancel()
+            token.check()
+
+def run_analysis(prepared, on_result=None, categories=None, token=None, previous=None):
+    """Run UI detection and every UX category (or only `categories`) for one image.
+
+    on_result, if given, is called with each category result as soon as it
+    is available so callers can stream results before the slowest finishes.
+    Categories already cached are reused, so a retry only recomputes the
+    ones that are missing or failed. A tall capture is analyzed with one call
+    per tile and each category's tiles are merged.
+
+    With a token, categories that cannot finish before its deadline are not
+    scheduled and come back as "Analysis Skipped" placeholders (partial
+    results). Raises AnalysisCancelled if the token is cancelled.
+
+    previous, from revision_base, is an analyzed earlier version of the
+    image; findings outside the regions that changed are carried over from it.
+    """
+    results = []
+    skipped = set()
+    
+    def emit(result):
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
     
-    # Resize the image to reduce memory usage
-    resize_image(image_path)
+    image_hash = prepared.hash
+    requested = categories or list(UX_PROMPTS)
     
     try:
+        # A new version of an analyzed screen asks one call about what changed;
+        # anything it could not provide is fetched below as usual
+        if previous is not None and needs_model_call(image_hash, requested):
+            run_revision_analysis(prepared, previous, token)
+        
+        # In combined mode one call fills the UI verdict and category caches;
+        # anything it could not provide is fetched below as in per-category mode.
+        # A subset request only pays for the categories it is missing.
+        if ANALYSIS_MODE == "combined" and categories is None and needs_model_call(image_hash) and not prepared.tiles:
+            # An obvious photo needs no combined call at all
+            if ui_detection_cache.get(ui_key(image_hash)) is not None or prefilter_ui(prepared) is not False:
+                run_combined_analysis(prepared, token)
+        
+        # A near-identical screenshot analyzed earlier answers without any model call
+        if needs_model_call(image_hash, requested):
+            near_duplicate = find_near_duplicate(prepared, requested)
+            if near_duplicate is not None:
+                for result in near_duplicate:
+                    emit(result)
+                results.sort(key=lambda x: x.get('category', ''))
+                return results
+        
         # First, check if this is a UI-related image
-        if not is_ui_image(image_path):
-            result = [{
-                "label": "Not UI Image",
-                "confidence": "High",
-                "category": "error",
-                "items": [
-                    {
-                        "type": "issue",
-                        "title": "Non-UI Image Detected",
-                        "description": "The uploaded image does not appear to contain user interface elements. Please upload a screenshot of a website, app, or other digital interface for UX analysis.",
-                        "severity": "high"
-                    }
-                ],
-                "raw_html": None
-            }]
-            session_data[session_id]['analysis'] = result
+        if not is_ui_image(prepared, token):
+            result = create_not_ui_result()
+            remember_phash(prepared)
+            emit(result[0])
             return result
         
-        # If it's a UI image, process it
-        image = Image.open(image_path).convert("RGB")
-        results = []
+        # Reuse any category already analyzed for this exact image
+        pending_prompts = {}
+        for category in requested:
+            prompt = UX_PROMPTS[category]
+            cached = category_cache.get(category_key(image_hash, category))
+            if cached is not None:
+                print(f"🔄 Cache hit for {category} analysis")
+                emit(cached)
+            else:
+                pending_prompts[category] = prompt
         
-        # Configure Gemini for better JSON output
-        generation_config = {
-            "temperature": 0.2,  # Lower temperature for more consistent responses
-            "top_p": 0.8,
-            "top_k": 40,
-            "max_output_tokens": 2048,
-        }
+        if not pending_prompts:
+            remember_phash(prepared)
+            results.sort(key=lambda x: x.get('category', ''))
+            return results
         
-        # Use ThreadPoolExecutor for parallel processing with resource limits
-        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-            future_to_category = {}
-            
-            for category, prompt in UX_PROMPTS.items():
-                future_to_category[executor.submit(process_category, category, prompt, image, generation_config, model)] = category
+        # If it's a UI image, process it; every call shares the same encoded buffer
+        generation_config = GENERATION_CONFIG
+        
+        def fetch(category, prompt, target):
+            # Cache here, so a call that outlives its request's deadline still pays off
+            result = process_category(category, prompt, target.part, generation_config, model, token)
+            if is_cacheable_result(result):
+                category_cache.set(category_key(target.hash, category), result)
+            return result
+        
+        # A tall capture gets one call per tile covering every category; cached tiles
+        # (e.g. unchanged parts of a re-upload) are reused, and whatever is still
+        # missing afterwards is fetched per category and tile below
+        if prepared.tiles:
+            remaining = token.remaining() if token is not None else None
+            if remaining is None or remaining > model_executor.expected_seconds("combined"):
+                wait_for_calls([
+                    model_executor.submit(run_coalesced, ("tile", tile.hash), run_tile_analysis,
+                                          tile, index, len(prepared.tiles), token, token=token)
+                    for index, tile in tiles_to_analyze(prepared, pending_prompts)
+                ], token)
+        tile_results = {}
+        
+        def finish_tiles(category):
+            result = merge_tile_results(category, tile_results[category])
+            if is_cacheable_result(result):
+                category_cache.set(category_key(image_hash, category), result)
+            emit(result)
+        
+        # Fan out on the shared model-call executor so global concurrency and rate limits apply;
+        # each category is one call, and so is each category of a tile its tile call left out
+        future_to_unit = {}
+        
+        for category, prompt in pending_prompts.items():
+            # Don't start calls that can't finish before the deadline
+            if token is not None:
+                token.check()
+                remaining = token.remaining()
+                if remaining is not None and remaining <= model_executor.expected_seconds(category):
+                    skipped.add(category)
+                    continue
+            if not prepared.tiles:
+                # Overlapping requests (e.g. a full analysis and a one-tab reload) share each category's call
+                future = model_executor.submit(
+                    run_coalesced, ("category", image_hash, category),
+                    fetch, category, prompt, prepared, token=token
+                )
+                future_to_unit[future] = (category, None)
+                continue
             
-            # Collect results as they complete
-            for future in concurrent.futures.as_completed(future_to_category):
-                category = future_to_category[future]
+            tile_results[category] = [category_cache.get(category_key(tile.hash, category)) for tile in prepared.tiles]
+            for index, tile in enumerate(prepared.tiles):
+                if tile_results[category][index] is None:
+                    future = model_executor.submit(
+                        run_coalesced, ("category", tile.hash, category),
+                        fetch, category, tile_prompt(prompt, index, len(prepared.tiles)), tile, token=token
+                    )
+                    future_to_unit[future] = (category, index)
+            if all(tile_results[category]):
+                finish_tiles(category)
+        
+        # Collect results as they complete, checking the token while waiting
+        pending = set(future_to_unit)
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, timeout=None if token is None else CANCEL_POLL_INTERVAL,
+                return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                category, index = future_to_unit[future]
                 try:
                     result = future.result()
-                    results.append(result)
-                    print(f"✅ Added {category} analysis result")
+                except DeadlineExceeded:
+                    skipped.add(category)
+                    continue
+                except AnalysisCancelled:
+                    raise
                 except Exception as e:
                     print(f"🔥 Error with {category}: {str(e)}")
-                    results.append({
-                        "category": category,
-                        "label": f"{category.replace('-', ' ').title()} Design Analysis",
-                        "confidence": "Low",
-                        "items": [
-                            {
-                                "type": "issue",
-                                "title": "Processing Error",
-                                "description": f"Error during analysis: {str(e)}",
-                                "severity": "high"
-                            }
-                        ],
-                        "raw_html": None
-                    })
-        
+                    result = create_category_error(category, "Processing Error", f"Error during analysis: {str(e)}", "high")
+                if index is None:
+                    emit(result)
+                    print(f"✅ Added {category} analysis result")
+                    continue
+                tile_results[category][index] = result
+                if category not in skipped and all(tile_results[category]):
+                    finish_tiles(category)
+            if pending and token is not None and (token.cancelled or token.expired()):
+                # Calls not yet started are dropped; ones already sent finish and fill the cache
+                for future in pending:
+                    future.cancel()
+                token.check()
+
         # Make sure each category has at least one result
         categories_processed = set(item["category"] for item in results)
-        for category in UX_PROMPTS.keys():
-            if category not in categories_processed:
-                results.append({
-                    "category": category,
-                    "label": f"{category.replace('-', ' ').title()} Design Analysis",
-                    "confidence": "Low",
-                    "items": [
-                        {
-                            "type": "issue",
-                            "title": "Analysis Unavailable",
-                            "description": f"We couldn't generate {category} analysis for this image. Please try again.",
-                            "severity": "medium"
-                        }
-                    ],
-                    "raw_html": None
-                })
+        for category in requested:
+            if category in skipped:
+                emit(create_skipped_result(category))
+            elif category not in categories_processed:
+                emit(create_category_error(
+                    category, "Analysis Unavailable",
+                    f"We couldn't generate {category} analysis for this image. Please try again."
+                ))
+        
+        # Index the image for near-duplicate lookups once every category is cached
+        remember_phash(prepared)
         
         # Sort results by category for consistency
         results.sort(key=lambda x: x.get('category', ''))
         
-        # Update session data with analysis results
-        session_data[session_id]['analysis'] = results
-        
         return results
     
-    except Exception as e:
+    except DeadlineExceeded as e:
+        # Nothing more can finish in time; return what is ready
+        print(f"⏱️ Deadline reached for {prepared.filename}: {str(e)}")
+        for result in complete_with_skipped(results, requested)[len(results):]:
+            emit(result)
+        results.sort(key=lambda x: x.get('category', ''))
+        return results
+    except AnalysisCancelled as e:
+        print(f"🛑 Analysis of {prepared.filename} cancelled: {str(e)}")
+        raise
+    except Exception as e:
         print(f"❌ Global analysis error: {str(e)}")
-        error_result = [{
-            "label": "Analysis Error",
-            "confidence": "High",
-            "category": "error",
-            "items": [
-                {
-                    "type": "issue",
-                    "title": "Analysis Failed",
-                    "description": f"We encountered an error during analysis: {str(e)}",
-                    "severity": "high"
-                }
-            ],
-            "raw_html": None
-        }]
-        session_data[session_id]['analysis'] = error_result
+        error_result = create_analysis_error(e)
+        if on_result is not None:
+            on_result(error_result[0])
         return error_result
 
 
-def process_category(category, prompt, image, generation_config, model):
-    """Process a single UX category with Gemini AI."""
+def create_category_error(category, title, description, severity="medium"):
+    """Create the low-confidence placeholder returned when one category could not be analyzed."""
+    return {
+        "category": category,
+        "label": f"{category.replace('-', ' ').title()} Design Analysis",
+        "confidence": "Low",
+        "items": [
+            {
+                "type": "issue",
+                "title": title,
+                "description": description,
+                "severity": severity
+            }
+        ],
+        "raw_html": None
+    }
+
+def create_skipped_result(category):
+    """Create the placeholder for a category left out to meet the request's deadline."""
+    return create_category_error(
+        category, "Analysis Skipped",
+        f"The {category} analysis could not finish before the request deadline. Request it again to complete it.",
+        "low"
+    )
+
+def complete_with_skipped(results, requested):
+    """Return results plus a skipped placeholder for each requested category they lack."""
+    present = {r.get("category") for r in results}
+    if "error" in present:
+        return results
+    return results + [create_skipped_result(category) for category in requested if category not in present]
+
+def create_analysis_error(error):
+    """Create the result returned when an analysis failed as a whole."""
+    return [{
+        "label": "Analysis Error",
+        "confidence": "High",
+        "category": "error",
+        "items": [
+            {
+                "type": "issue",
+                "title": "Analysis Failed",
+                "description": f"We encountered an error during analysis: {str(error)}",
+                "severity": "high"
+            }
+        ],
+        "raw_html": None
+    }]
+
+def create_not_ui_result():
+    """Create the result returned for images that are not user interfaces."""
+    return [{
+        "label": "Not UI Image",
+        "confidence": "High",
+        "category": "error",
+        "items": [
+            {
+                "type": "issue",
+                "title": "Non-UI Image Detected",
+                "description": "The uploaded image does not appear to contain user interface elements. Please upload a screenshot of a website, app, or other digital interface for UX analysis.",
+                "severity": "high"
+            }
+        ],
+        "raw_html": None
+    }]
+
+def same_shape(size, other):
+    """Whether two source sizes are close enough in aspect ratio and tiling to share an analysis."""
+    (width, height), (other_width, other_height) = size, other
+    aspect, other_aspect = width / height, other_width / other_height
+    if abs(aspect / other_aspect - 1) > PHASH_MAX_ASPECT_DIFF:
+        return False
+    tiles = len(tile_boxes(size)) if is_tall(size) else 0
+    other_tiles = len(tile_boxes(other)) if is_tall(other) else 0
+    return tiles == other_tiles
+
+def remember_phash(prepared):
+    """Add a fully analyzed image, with its source size, to the near-duplicate index."""
+    if (PHASH_MAX_DISTANCE and prepared.phash is not None and prepared.source_size
+            and not needs_model_call(prepared.hash)):
+        phash_index.add(prepared.phash, (prepared.hash, tuple(prepared.source_size)))
+
+def find_near_duplicate(prepared, categories=UX_PROMPTS):
+    """Return cached results of a perceptually near-identical image of the same shape, flagged as such, or None."""
+    if not PHASH_MAX_DISTANCE or prepared.phash is None or not prepared.source_size:
+        return None
+    
+    with timed_stage("phash_lookup"):
+        match = phash_index.find(prepared.phash, accept=lambda key: same_shape(key[1], prepared.source_size))
+    if match is None:
+        return None
+    (match_hash, _), distance = match
+    if match_hash == prepared.hash:
+        return None
+    
+    verdict = ui_detection_cache.get(ui_key(match_hash))
+    if verdict is None:
+        return None
+    if verdict:
+        cached = [category_cache.get(category_key(match_hash, category)) for category in categories]
+        if any(result is None for result in cached):
+            return None
+    else:
+        cached = create_not_ui_result()
+    
+    print(f"🔄 Near-duplicate of {match_hash[:12]} (distance {distance}) for {prepared.filename}")
+    flag = {"image_hash": match_hash, "distance": distance}
+    return [dict(result, near_duplicate=flag) for result in cached]
+
+def needs_model_call(image_hash, categories=UX_PROMPTS):
+    """Return True if the UI verdict or any of the categories' results is missing from the caches."""
+    verdict = ui_detection_cache.get(ui_key(image_hash))
+    if verdict is None:
+        return True
+    if not verdict:
+        return False
+    return any(category_cache.get(category_key(image_hash, category)) is None for category in categories)
+
+def run_combined_analysis(prepared, token=None):
+    """Analyze UI detection and all UX categories with a single Gemini call.
+
+    Results are split into the per-category format and written to the caches.
+    Returns the category keys that were filled; an empty list means the caller
+    should fall back to per-category calls.
+    """
+    try:
+        print(f"🔄 Processing combined analysis...")
+        response = call_model(
+            [COMBINED_PROMPT, prepared.part],
+            "combined",
+            token,
+            stream=False,
+            generation_config=COMBINED_GENERATION_CONFIG
+        )
+        analysis_text = response.text if response and hasattr(response, 'text') else ""
+        return apply_combined_response(prepared, analysis_text)
+    except AnalysisCancelled:
+        raise
+    except Exception as e:
+        print(f"❌ Error during combined analysis: {str(e)}")
+        return []
+
+def apply_combined_response(prepared, analysis_text):
+    """Split a COMBINED_PROMPT answer into the UI verdict and category results and cache them.
+
+    Returns the category keys that were filled.
+    """
+    image_hash = prepared.hash
+    with timed_stage("json_parse", "combined"):
+        data = parse_json_from_response(analysis_text)
+    
+    if not isinstance(data.get("is_ui"), bool):
+        print(f"⚠️ Combined response missing UI verdict, falling back to per-category calls")
+        return []
+    
+    ui_detection_cache.set(ui_key(image_hash), data["is_ui"])
+    if not data["is_ui"]:
+        print(f"🔍 Combined UI detection for {prepared.filename}: ❌ Not UI")
+        return []
+    
+    filled = cache_category_answers(prepared, data.get("categories"))
+    print(f"✅ Combined analysis filled {len(filled)}/{len(UX_PROMPTS)} categories")
+    return filled
+
+def cache_category_answers(prepared, categories):
+    """Format and cache each category's answer from a {category: answer} dict; returns the filled keys."""
+    if not isinstance(categories, dict):
+        categories = {}
+    
+    filled = []
+    for category in UX_PROMPTS:
+        if not isinstance(categories.get(category), dict):
+            print(f"⚠️ Combined response missing {category}")
+            continue
+        with timed_stage("format", category):
+            result = format_response_for_client(category, categories[category])
+        if is_cacheable_result(result):
+            category_cache.set(category_key(prepared.hash, category), result)
+            filled.append(category)
+    return filled
+
+def run_tile_analysis(tile, index, count, token=None):
+    """Analyze every UX category of one tile of a tall capture with a single call.
+
+    The results are cached under the tile's hash. Returns the category keys
+    that were filled; the rest are left for per-category calls.
+    """
+    try:
+        print(f"🔄 Processing combined analysis of {tile.filename}...")
+        response = call_model(
+            [TILE_COMBINED_PROMPT + TILE_PROMPT.format(index=index + 1, count=count), tile.part],
+            "combined",
+            token,
+            stream=False,
+            generation_config=COMBINED_GENERATION_CONFIG
+        )
+        analysis_text = response.text if response and hasattr(response, 'text') else ""
+        return apply_tile_response(tile, analysis_text)
+    except AnalysisCancelled:
+        raise
+    except Exception as e:
+        print(f"❌ Error during combined analysis of {tile.filename}: {str(e)}")
+        return []
+
+def apply_tile_response(tile, analysis_text):
+    """Cache the category results from a TILE_COMBINED_PROMPT answer; returns the filled keys."""
+    with timed_stage("json_parse", "combined"):
+        data = parse_json_from_response(analysis_text)
+    filled = cache_category_answers(tile, data.get("categories"))
+    print(f"✅ Combined analysis of {tile.filename} filled {len(filled)}/{len(UX_PROMPTS)} categories")
+    return filled
+
+# Revision mode: a re-upload of a changed screen is diffed against the previous version
+# on a grayscale thumbnail, in square cells; only changed regions are sent to the model
+REVISION_GRID_SIZE = (128, 128)  # Thumbnail the diff runs on
+REVISION_CELL = 8  # Cell edge in thumbnail pixels
+REVISION_CELL_THRESHOLD = float(os.getenv("REVISION_CELL_THRESHOLD", 6))  # Mean gray-level change of a changed cell
+REVISION_MAX_CHANGED = float(os.getenv("REVISION_MAX_CHANGED", 0.5))  # Past this fraction of cells, analyze in full
+REVISION_MAX_REGIONS = 4  # More changed regions than this are sent as one
+REVISION_PROMPT = """
+The images show a new version of a user interface whose previous version was already analyzed.
+The first image is the whole new version. Each following image is one region that changed since
+the previous version: {regions}.
+
+These were the findings for the previous version, numbered per category:
+{findings}
+
+For each category above, look only at the changed regions and report:
+- "resolved": the numbers of that category's previous findings the changes fix or make obsolete
+- "issues" and "recommendations": new findings about the changed regions only
+
+Format your response as a structured JSON object with the following format:
+{{
+  "categories": {{
+    "<category key>": {{
+      "resolved": [1, 4],
+      "issues": [
+        {{
+          "title": "Brief issue title",
+          "description": "Detailed explanation of the issue",
+          "severity": "high | medium | low"
+        }}
+      ],
+      "recommendations": [
+        {{
+          "title": "Brief recommendation title",
+          "description": "Detailed explanation of the recommendation",
+          "type": "improvement | fix | enhancement"
+        }}
+      ]
+    }}
+  }}
+}}
+
+Use exactly the category keys listed above, with empty lists where nothing changed for a category.
+
+YOU MUST RETURN A VALID JSON OBJECT. DO NOT INCLUDE ANY EXPLANATION TEXT BEFORE OR AFTER THE JSON.
+"""
+
+def parse_revision(value):
+    """Whether a ?revision= value asks for revision mode."""
+    return (value or "").lower() in ("1", "true", "yes")
+
+def compute_luma(image):
+    """Return a grayscale thumbnail of a PIL image, as PNG bytes, for revision diffs."""
+    gray = image.convert("L")
+    gray.thumbnail(REVISION_GRID_SIZE, Image.Resampling.BOX)
+    buffer = io.BytesIO()
+    gray.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def changed_regions(old_luma, new_luma):
+    """Diff two luma thumbnails cell by cell and return the changed regions.
+
+    Regions are (left, top, right, bottom) fractions of the image, padded by
+    a cell so a changed control is seen whole. Returns [] when nothing
+    changed, and None when the versions can't be compared (different sizes)
+    or too much of the screen changed for a partial re-analysis to pay off.
+    """
+    old = np.asarray(Image.open(io.BytesIO(old_luma)), dtype=np.int16)
+    new = np.asarray(Image.open(io.BytesIO(new_luma)), dtype=np.int16)
+    if old.shape != new.shape:
+        return None
+    
+    # Mean absolute change per cell; edge cells are padded with "unchanged"
+    height, width = new.shape
+    rows, cols = -(-height // REVISION_CELL), -(-width // REVISION_CELL)
+    diff = np.zeros((rows * REVISION_CELL, cols * REVISION_CELL))
+    diff[:height, :width] = np.abs(new - old)
+    changed = diff.reshape(rows, REVISION_CELL, cols, REVISION_CELL).mean(axis=(1, 3)) > REVISION_CELL_THRESHOLD
+    if changed.mean() > REVISION_MAX_CHANGED:
+        return None
+    
+    # Group touching cells (8-connected) into regions
+    boxes = []
+    unvisited = set(zip(*np.nonzero(changed)))
+    while unvisited:
+        stack = [unvisited.pop()]
+        top, left, bottom, right = stack[0][0], stack[0][1], stack[0][0], stack[0][1]
+        while stack:
+            row, col = stack.pop()
+            top, left, bottom, right = min(top, row), min(left, col), max(bottom, row), max(right, col)
+            for neighbour in itertools.product((row - 1, row, row + 1), (col - 1, col, col + 1)):
+                if neighbour in unvisited:
+                    unvisited.remove(neighbour)
+                    stack.append(neighbour)
+        boxes.append((left, top, right, bottom))
+    if len(boxes) > REVISION_MAX_REGIONS:
+        boxes = [(min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))]
+    
+    return [(max(0, left - 1) / cols, max(0, top - 1) / rows, min(cols, right + 2) / cols, min(rows, bottom + 2) / rows)
+            for left, top, right, bottom in sorted((tuple(map(int, b)) for b in boxes), key=lambda b: (b[1], b[0]))]
+
+def revision_base(session_id, prepared):
+    """The analyzed version a revision upload replaces, from the session, or None if there is none to use.
+
+    Returns {"image_hash", "luma", "results"} where results maps each
+    category with a complete analysis of that version to its result.
+    """
+    data = get_session(session_id)
+    if not data or not data.get("luma") or data.get("image_hash") in (None, prepared.hash):
+        return None
+    if not needs_model_call(prepared.hash):
+        # Already analyzed in full; nothing to carry over
+        return None
+    if prepared.tiles:
+        # Unchanged tiles of a tall capture are already answered from the cache
+        return None
+    image_hash = data["image_hash"]
+    if ui_detection_cache.get(ui_key(image_hash)) is False:
+        return None
+    
+    stored = {r.get("category"): r for r in session_results(data)}
+    results = {}
+    for category in UX_PROMPTS:
+        result = category_cache.get(category_key(image_hash, category)) or stored.get(category)
+        if is_cacheable_result(result):
+            results[category] = result
+    if not results:
+        return None
+    return {"image_hash": image_hash, "luma": data["luma"], "results": results}
+
+def plan_revision(prepared, previous):
+    """Work out what a revision needs from the model.
+
+    Returns None when the upload should be analyzed in full, or (regions,
+    parts) where parts is the REVISION_PROMPT call, or None if nothing changed.
+    """
+    with timed_stage("revision_diff"):
+        regions = changed_regions(previous["luma"], prepared.luma) if prepared.luma else None
+    if regions is None:
+        print(f"🔁 {prepared.filename} changed too much since {previous['image_hash'][:12]}, analyzing in full")
+        return None
+    if not regions:
+        return regions, None
+    
+    with timed_stage("revision_crop"):
+        image = prepared.to_image().convert("RGB")
+        width, height = image.size
+        crops = []
+        for left, top, right, bottom in regions:
+            crop = image.crop((round(left * width), round(top * height), round(right * width), round(bottom * height)))
+            _, data, mime_type, _, _ = encode_for_model(crop, IMAGE_ENCODING, None, None, MAX_IMAGE_SIZE)
+            crops.append({"mime_type": mime_type, "data": data})
+    
+    described = "; ".join(
+        f"region {i + 1} spans {left:.0%}-{right:.0%} of the width and {top:.0%}-{bottom:.0%} of the height"
+        for i, (left, top, right, bottom) in enumerate(regions)
+    )
+    findings = "\n".join(
+        f'"{category}":\n' + "\n".join(
+            f"  {n}. [{item.get('type')}] {item.get('title')}: {item.get('description')}"
+            for n, item in enumerate(result["items"], 1)
+        )
+        for category, result in previous["results"].items()
+    )
+    prompt = REVISION_PROMPT.format(regions=described, findings=findings)
+    return regions, [prompt, prepared.part, *crops]
+
+def run_revision_analysis(prepared, previous, token=None):
+    """Analyze only what changed since a previous version of the image, in one Gemini call.
+
+    Findings of the previous version the model does not mark as resolved are
+    carried over and the new ones added; the results are written to the
+    caches like run_combined_analysis. Returns the category keys that were
+    filled; categories left out are analyzed in full by the caller.
+    """
+    plan = plan_revision(prepared, previous)
+    if plan is None:
+        return []
+    regions, parts = plan
+    if parts is None:
+        print(f"🔁 {prepared.filename} is unchanged since {previous['image_hash'][:12]}, carrying every finding over")
+        return carry_over_results(prepared, previous)
+    
+    try:
+        print(f"🔁 Re-analyzing {len(regions)} changed regions of {prepared.filename}...")
+        response = call_model(parts, "revision", token, stream=False, generation_config=COMBINED_GENERATION_CONFIG)
+        analysis_text = response.text if response and hasattr(response, 'text') else ""
+        return apply_revision_response(prepared, previous, analysis_text)
+    except AnalysisCancelled:
+        raise
+    except Exception as e:
+        print(f"❌ Error during revision analysis: {str(e)}")
+        return []
+
+def apply_revision_response(prepared, previous, analysis_text):
+    """Merge a REVISION_PROMPT answer into the previous findings; see revise_results."""
+    with timed_stage("json_parse", "revision"):
+        data = parse_json_from_response(analysis_text)
+    if not isinstance(data.get("categories"), dict):
+        print(f"⚠️ Revision response missing categories, falling back to a full analysis")
+        return []
+    return revise_results(prepared, previous, data["categories"])
+
+def carry_over_results(prepared, previous):
+    """Cache every previous finding for an upload that did not visibly change; returns the filled categories."""
+    return revise_results(prepared, previous, {category: {} for category in previous["results"]})
+
+def revise_results(prepared, previous, answers):
+    """Apply per-category revision answers to the previous findings and cache the results.
+
+    Previous findings not listed as resolved are kept, new ones are added
+    after them. Returns the category keys that were filled.
+    """
+    filled = []
+    for category, result in previous["results"].items():
+        answer = answers.get(category)
+        if not isinstance(answer, dict):
+            print(f"⚠️ Revision response missing {category}")
+            continue
+        resolved = {n for n in answer.get("resolved") or [] if isinstance(n, int)}
+        kept = [item for n, item in enumerate(result["items"], 1) if n not in resolved]
+        new = {key: answer[key] for key in ("issues", "recommendations") if isinstance(answer.get(key), list)}
+        added = format_response_for_client(category, new)["items"] if any(new.values()) else []
+        
+        with timed_stage("format", category):
+            revised = format_response_for_client(category, {})
+            revised.update(items=dedupe_items(kept + added), confidence="High")
+        if revised["items"] and is_cacheable_result(revised):
+            category_cache.set(category_key(prepared.hash, category), revised)
+            filled.append(category)
+        print(f"🔁 {category}: kept {len(kept)}, resolved {len(resolved)}, added {len(added)}")
+    
+    if filled:
+        # A new version of a UI is still a UI
+        ui_detection_cache.set(ui_key(prepared.hash), True)
+    print(f"✅ Revision analysis filled {len(filled)}/{len(UX_PROMPTS)} categories")
+    return filled
+
+def process_category(category, prompt, image, generation_config, model, token=None):
+    """Process a single UX category with Gemini AI.
+
+    Raises AnalysisCancelled, instead of calling the model, once token is
+    cancelled or the call could not finish before its deadline.
+    """
     try:
         # Create a safety wrapper for the category processing
         print(f"🔄 Processing {category} analysis...")
         
         # Generate content with adapted generation config
-        response = model.generate_content(
+        response = model_executor.generate(
+            model,
             [prompt, image], 
+            category,
+            token,
             stream=False,
             generation_config=generation_config
         )
         
         # Get the response text with proper error handling
         analysis_text = response.text if response and hasattr(response, 'text') else ""
-        
-        if not analysis_text:
-            print(f"⚠️ Empty response for {category}")
-            return format_response_for_client(category, create_default_response())
-        
-        # Parse JSON from response
+        return format_category_response(category, analysis_text)
+    except AnalysisCancelled:
+        raise
+    except Exception as e:
+        print(f"❌ Error processing {category}: {str(e)}")
+        return create_category_error(
+            category, "Analysis Error",
+            f"We encountered an issue analyzing this aspect of the design: {str(e)}"
+        )
+
+def format_category_response(category, analysis_text):
+    """Parse one category's model answer and format it for the client."""
+    if not analysis_text:
+        print(f"⚠️ Empty response for {category}")
+        return format_response_for_client(category, create_default_response())
+    
+    # Parse JSON from response
+    with timed_stage("json_parse", category):
         analysis_data = parse_json_from_response(analysis_text)
-        
-        # Format response for client
+    
+    # Format response for client
+    with timed_stage("format", category):
         formatted_response = format_response_for_client(category, analysis_data)
+    
+    print(f"✅ Successfully processed {category} with {len(formatted_response.get('items', []))} items")
+    return formatted_response
+
+def dedupe_items(items):
+    """Drop items whose title nearly repeats an earlier item's of the same type; keeps the first."""
+    kept, seen = [], []
+    for item in items:
+        title = re.sub(r"[^a-z0-9]+", " ", item.get("title", "").lower()).strip()
+        # Numbered titles ("Step 2", "Step 3") are never the same finding
+        key = (item.get("type"), re.findall(r"\d+", title))
+        if any(other_key == key and difflib.SequenceMatcher(None, title, other).ratio() >= DUPLICATE_TITLE_SIMILARITY
+               for other_key, other in seen):
+            continue
+        seen.append((key, title))
+        kept.append(item)
+    return kept
+
+def merge_tile_results(category, tile_results):
+    """Merge one category's per-tile results, top to bottom, into a single result.
+
+    A finding reported by several (overlapping) tiles is kept once, under its
+    first title. A tile with nothing to report adds nothing. If any tile
+    failed, the merge is marked low-confidence so it is not cached and a
+    refresh recomputes the failed tiles.
+    """
+    items = []
+    complete = True
+    for result in tile_results:
+        tile_items = result.get("items", [])
+        if not is_cacheable_result(result):
+            if [item.get("title") for item in tile_items] == ["No Analysis Results"]:
+                continue
+            complete = False
+            continue
+        items.extend(tile_items)
+    items = dedupe_items(items)
+    
+    if not items:
+        # Every tile failed (or had nothing to say): answer with the first tile's placeholder
+        return tile_results[0]
+    merged = format_response_for_client(category, {})
+    merged.update(items=items, confidence="High" if complete else "Low")
+    print(f"🧩 Merged {len(tile_results)} tiles of {category} into {len(items)} items")
+    return merged
+
+# Batch analysis: many screenshots per request through one shared, bounded pipeline
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", 50))
+BATCH_MAX_FILE_BYTES = int(os.getenv("BATCH_MAX_FILE_BYTES", MAX_UPLOAD_BYTES))
+# Whole request body of a batch, checked by Werkzeug while the form is received (and spooled to disk)
+BATCH_MAX_BODY_BYTES = int(os.getenv("BATCH_MAX_BODY_BYTES", min(BATCH_MAX_IMAGES * BATCH_MAX_FILE_BYTES, 256 * 1024 * 1024)))
+# Images analyzed at once across all batches; each one keeps several model calls queued,
+# so the model executor's concurrency limit, not the client, sets batch throughput
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", MODEL_MAX_CONCURRENCY))
+# Images of accepted batches not yet analyzed; a batch that would go past this gets a 429
+BATCH_MAX_PENDING = int(os.getenv("BATCH_MAX_PENDING", BATCH_MAX_IMAGES * 2))
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif", ".bmp")
+
+batch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch-image")
+batch_lock = threading.Lock()
+batch_pending = 0  # Images of accepted batches not yet analyzed
+
+def reserve_batch_images(count):
+    """Count a batch's images against BATCH_MAX_PENDING; False, counting nothing, when they don't fit."""
+    global batch_pending
+    with batch_lock:
+        if batch_pending + count > BATCH_MAX_PENDING:
+            print(f"⚠️ {batch_pending} batch images pending, rejecting a batch of {count}")
+            return False
+        batch_pending += count
+        return True
+
+def release_batch_images(count):
+    global batch_pending
+    with batch_lock:
+        batch_pending -= count
+
+def open_spooled(stream):
+    """An uploaded file's (seekable) stream from its start, left open for the request to close."""
+    stream.seek(0)
+    return contextlib.nullcontext(stream)
+
+def read_batch_uploads(files):
+    """Expand uploaded images and zip archives into (filename, open) entries in upload order.
+
+    open() returns a context manager for the entry's byte stream. Nothing is
+    read or inflated before it is called, so a batch only holds the images it
+    is analyzing; read_batch_entry() checks each one as it reads it. Zip members
+    are taken in name order, so a numbered flow keeps its sequence. Raises
+    ValueError for bad archives, oversized files or too many images.
+    """
+    entries = []
+    
+    def add(filename, size, read):
+        if len(entries) >= BATCH_MAX_IMAGES:
+            raise ValueError(f"Batches are limited to {BATCH_MAX_IMAGES} images")
+        if size > BATCH_MAX_FILE_BYTES:
+            raise ValueError(f"{filename} is larger than {BATCH_MAX_FILE_BYTES} bytes")
+        entries.append((os.path.basename(filename), read))
+    
+    for file in files:
+        stream = file.stream
+        head = stream.read(4)
+        size = stream.seek(0, os.SEEK_END)
+        stream.seek(0)
+        if not (file.filename.lower().endswith(".zip") or head == b"PK\x03\x04"):
+            add(file.filename, size, functools.partial(open_spooled, stream))
+            continue
+        try:
+            # Left open for the entries to read from; it goes with the request's files
+            archive = zipfile.ZipFile(stream)
+            members = sorted(
+                (m for m in archive.infolist()
+                 if not m.is_dir() and not m.filename.startswith("__MACOSX/")
+                 and m.filename.lower().endswith(IMAGE_EXTENSIONS)),
+                key=lambda m: m.filename
+            )
+            # The declared size is checked before anything is inflated
+            for member in members:
+                add(member.filename, member.file_size, functools.partial(archive.open, member))
+        except zipfile.BadZipFile as e:
+            raise ValueError(f"Unreadable archive {file.filename}: {str(e)}")
+    return entries
+
+def detach_uploads(files):
+    """Take over uploaded files' streams, which Flask closes as soon as the view returns.
+
+    A streamed response reads its batch entries afterwards; the caller
+    closes the returned streams once it is done with them.
+    """
+    streams = []
+    for file in files:
+        streams.append(file.stream)
+        file.stream = io.BytesIO()
+    return streams
+
+def read_batch_entry(filename, open_entry):
+    """Read a batch entry in chunks through an UploadReader, checked like a single upload.
+
+    Returns (bytes, reader). Raises UploadRejected as soon as the entry is
+    over BATCH_MAX_FILE_BYTES, is not a supported image or declares more than
+    MAX_IMAGE_PIXELS, before the rest of it is read or inflated.
+    """
+    reader = UploadReader(filename, max_bytes=BATCH_MAX_FILE_BYTES)
+    with open_entry() as stream:
+        for chunk in iter(functools.partial(stream.read, UPLOAD_CHUNK_BYTES), b""):
+            reader.feed(chunk)
+    return reader.finish(), reader
+
+def analyze_batch_image(raw, filename, image_hash, size=None, categories=None):
+    """Analyze one batch image on the batch pool, decoding it unless its analysis is cached.
+
+    size is the (width, height) from its header. Raises ValueError if the
+    image is unreadable.
+    """
+    prepared = prepare_or_defer(raw, filename, image_hash, size)
+    return run_shared_analysis(prepared, categories)
+
+def iter_batch(entries, categories=None):
+    """Analyze batch entries, yielding one item per entry as soon as it is ready.
+
+    Entries are read only as the batch pool can take them, at most
+    BATCH_WORKERS ahead, so the batch never holds all of its images at once.
+    Byte-identical images are decoded and analyzed once; their copies carry
+    `duplicate_of` with the index of the first one. The entries must have
+    been counted by reserve_batch_images(); each is released once its item
+    is yielded, and the rest if the batch is abandoned.
+    """
+    items = [{"index": index, "filename": filename} for index, (filename, _) in enumerate(entries)]
+    copies = {}  # image hash -> indices of later identical uploads waiting for the first
+    outcomes = {}  # image hash -> (index, outcome) of images already analyzed
+    future_to_index = {}
+    next_index = 0
+    released = 0
+    print(f"📦 Batch of {len(entries)} images")
+    
+    try:
+        while next_index < len(entries) or future_to_index:
+            # Read the next entries only while the pool has room for them
+            while next_index < len(entries) and len(future_to_index) < BATCH_WORKERS:
+                index, (filename, open_entry) = next_index, entries[next_index]
+                next_index += 1
+                item = items[index]
+                try:
+                    raw, reader = read_batch_entry(filename, open_entry)
+                except Exception as e:
+                    print(f"❌ Batch image {filename} failed: {str(e)}")
+                    if isinstance(e, UploadRejected):
+                        # The status a single POST /analyze of this file would have answered with
+                        item.update(status="error", error=str(e), code=e.status)
+                    else:
+                        item.update(status="error", error=f"Unreadable upload: {str(e)}")
+                    released += 1
+                    release_batch_images(1)
+                    yield item
+                    continue
+                image_hash = item["image_hash"] = reader.hash
+                if image_hash in outcomes:
+                    first, outcome = outcomes[image_hash]
+                    item.update(outcome, duplicate_of=first)
+                    released += 1
+                    release_batch_images(1)
+                    yield item
+                elif image_hash in copies:
+                    copies[image_hash].append(index)
+                else:
+                    copies[image_hash] = []
+                    future = batch_pool.submit(with_trace(analyze_batch_image), raw, filename, image_hash,
+                                               reader.size, categories)
+                    future_to_index[future] = index
+            
+            done, _ = concurrent.futures.wait(future_to_index, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index = future_to_index.pop(future)
+                item = items[index]
+                try:
+                    outcome = {"status": "complete", "results": future.result()}
+                except Exception as e:
+                    print(f"❌ Batch image {item['filename']} failed: {str(e)}")
+                    outcome = {"status": "error", "error": str(e)}
+                
+                item.update(outcome)
+                outcomes[item["image_hash"]] = (index, outcome)
+                waiting = copies.pop(item["image_hash"])
+                released += 1 + len(waiting)
+                release_batch_images(1 + len(waiting))
+                yield item
+                for copy_index in waiting:
+                    items[copy_index].update(outcome, duplicate_of=index)
+                    yield items[copy_index]
+    finally:
+        # A client that goes away mid-stream leaves images unanalyzed; don't start them
+        for future in future_to_index:
+            future.cancel()
+        release_batch_images(len(entries) - released)
+
+# Re-warm: after a prompt or config change, recompute the hottest images still cached under
+# old fingerprints, one image at a time and only while the model executor has spare capacity
+REWARM_TOP_N = int(os.getenv("REWARM_TOP_N", 20))
+REWARM_DELAY = float(os.getenv("REWARM_DELAY", 30))  # Seconds after startup before the first run
+REWARM_IDLE_WAIT = float(os.getenv("REWARM_IDLE_WAIT", 2))  # Seconds between checks for spare capacity
+
+rewarm_lock = threading.Lock()
+rewarm_state = {"running": False, "last_run": None, "candidates": 0, "rewarmed": 0, "skipped": 0}
+
+def find_stale_images(limit=REWARM_TOP_N):
+    """Return [(image_hash, stale categories, stale cache keys)] for the most recently used
+    images whose cached results were produced by an older prompt, config or model."""
+    stale = OrderedDict()  # image hash -> (categories, keys); iterated least recently used first
+    
+    def mark(image_hash, category, store, key):
+        categories, keys = stale.pop(image_hash, (set(), []))
+        if category is not None:
+            categories.add(category)
+        keys.append((store, key))
+        stale[image_hash] = (categories, keys)
+    
+    for key, _ in ui_detection_cache.items():
+        # Verdicts from before fingerprinting were keyed by the bare image hash
+        if isinstance(key, str):
+            mark(key, None, ui_detection_cache, key)
+        elif key[1] != UI_FINGERPRINT:
+            mark(key[0], None, ui_detection_cache, key)
+    for key, _ in category_cache.items():
+        image_hash, category = key[0], key[1]
+        if category in UX_PROMPTS and (len(key) < 3 or key[2] != CATEGORY_FINGERPRINTS[category]):
+            mark(image_hash, category, category_cache, key)
+    
+    hottest = list(stale.items())[::-1][:limit]
+    return [(image_hash, categories, keys) for image_hash, (categories, keys) in hottest]
+
+def wait_for_spare_model_capacity():
+    """Block until no model call is queued and at most half the concurrency slots are busy."""
+    while True:
+        stats = model_executor.stats()
+        if stats["queue_depth"] == 0 and stats["in_flight"] <= stats["max_concurrency"] // 2:
+            return
+        time.sleep(REWARM_IDLE_WAIT)
+
+def rewarm_stale_results(limit=REWARM_TOP_N):
+    """Recompute only the stale categories of the hottest stale images, at low priority.
+
+    Images are re-read from uploads still referenced by a session; images
+    whose upload is gone are skipped and their stale entries simply age out.
+    """
+    with rewarm_lock:
+        if rewarm_state["running"]:
+            return
+        rewarm_state.update(running=True, last_run=time.time(), candidates=0, rewarmed=0, skipped=0)
+    
+    set_current_trace(Trace("rewarm"))
+    try:
+        candidates = find_stale_images(limit)
+        rewarm_state["candidates"] = len(candidates)
+        if not candidates:
+            return
         
-        print(f"✅ Successfully processed {category} with {len(formatted_response.get('items', []))} items")
-        return formatted_response
+        print(f"♨️ Re-warming {len(candidates)} images cached under old prompts")
+        sources = {data.get('image_hash'): data.get('image_path') for _, data in session_store.items() if data.get('image_path')}
+        for image_hash, categories, keys in candidates:
+            path = sources.get(image_hash)
+            if not path or not os.path.exists(path):
+                rewarm_state["skipped"] += 1
+                continue
+            
+            wait_for_spare_model_capacity()
+            prepared = load_saved_image(path)
+            run_shared_analysis(prepared, [c for c in UX_PROMPTS if c in categories] or None)
+            for store, key in keys:
+                store.delete(key)
+            rewarm_state["rewarmed"] += 1
+        print(f"♨️ Re-warm done: {rewarm_state['rewarmed']} recomputed, {rewarm_state['skipped']} without a saved upload")
     except Exception as e:
-        print(f"❌ Error processing {category}: {str(e)}")
-        return {
-            "category": category,
-            "label": f"{category.replace('-', ' ').title()} Design Analysis",
-            "confidence": "Low",
-            "items": [
-                {
-                    "type": "issue",
-                    "title": "Analysis Error",
-                    "description": f"We encountered an issue analyzing this aspect of the design: {str(e)}",
-                    "severity": "medium"
-                }
-            ],
-            "raw_html": None
-        }
+        print(f"❌ Error during re-warm: {str(e)}")
+    finally:
+        current_trace().log()
+        set_current_trace(None)
+        with rewarm_lock:
+            rewarm_state["running"] = False
+
+def start_rewarm(delay=0):
+    """Run rewarm_stale_results on a daemon thread after delay seconds."""
+    def run():
+        time.sleep(delay)
+        rewarm_stale_results()
+    threading.Thread(target=run, name="rewarm", daemon=True).start()
 
 # Helper function to get or create a session ID
 def get_session_id():
@@ -558,6 +3630,65 @@ def get_session_id():
         return str(uuid.uuid4())
     return request.cookies.get('session_id')
 
+def request_deadline():
+    """Seconds the client allows for this request, from ?deadline_ms= or X-Deadline-Ms, or None.
+
+    Raises ValueError for a value that is not a positive number of milliseconds.
+    """
+    return parse_deadline(request.args.get("deadline_ms") or request.headers.get("X-Deadline-Ms"))
+
+def parse_deadline(value):
+    """Seconds from a deadline_ms value, or None when it is empty; see request_deadline."""
+    if not value:
+        return None
+    try:
+        deadline_ms = float(value)
+    except ValueError:
+        raise ValueError(f"Invalid deadline_ms: {value}")
+    if not 0 < deadline_ms <= MAX_DEADLINE_MS:
+        raise ValueError(f"deadline_ms must be between 0 and {MAX_DEADLINE_MS}")
+    return deadline_ms / 1000
+
+def cancelled_response(error, session_id):
+    """Build the 409 answered when a newer upload in the session cancelled this analysis."""
+    response = make_response(jsonify([{"label": "Error", "confidence": "N/A", "response": f"Analysis cancelled: {str(error)}"}]), 409)
+    response.set_cookie('session_id', session_id)
+    return response
+
+@app.before_request
+def start_request_trace():
+    g.trace = Trace(f"{request.method} {request.path}")
+    set_current_trace(g.trace)
+
+@app.after_request
+def finish_request_trace(response):
+    """Record request latency and attach the stage breakdown; streams end their own trace."""
+    trace = g.get("trace")
+    if trace is None:
+        return response
+    if not response.is_streamed:
+        end_trace(trace, response.status_code)
+        response.headers["Server-Timing"] = trace.server_timing()
+    response.headers["X-Trace-Id"] = trace.id
+    return response
+
+@app.teardown_request
+def clear_request_trace(error=None):
+    set_current_trace(None)
+
+def end_trace(trace, status):
+    """Observe the request's total latency and log its stage breakdown."""
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    request_seconds.observe(trace.elapsed(), request.method, endpoint, str(status))
+    trace.log()
+
+@app.errorhandler(413)
+def upload_too_large(error):
+    """Answer bodies over MAX_CONTENT_LENGTH, refused by Werkzeug before they are fully read."""
+    limit = request.max_content_length
+    message = f"Request body is larger than {limit} bytes" if limit else "Request body is too large"
+    return jsonify({"status": "error", "message": message}), 413
+
 @app.route("/preprocess", methods=["POST"])
 def preprocess_image():
     """Start processing the image in the background to save time later."""
@@ -575,34 +3706,112 @@ def preprocess_image():
         response.set_cookie('session_id', session_id)
         return response, 400
 
-    # Save the uploaded file
-    filename = str(int(time.time())) + "_" + file.filename  # Add timestamp to prevent overwrites
-    image_path = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(image_path)
+    # Decode the upload once (and keep the original on disk if configured)
+    try:
+        prepared = load_upload(file)
+    except ValueError as e:
+        response = make_response(jsonify({"status": "error", "message": str(e)}))
+        response.set_cookie('session_id', session_id)
+        return response, getattr(e, "status", 400)
+    revision = parse_revision(request.args.get("revision"))
     
-    # First check if the image is UI-related
-    if not is_ui_image(image_path):
+    # First check if the image is UI-related (combined mode folds this into the analysis call,
+    # and a new version of an analyzed screen is taken to be one)
+    if ANALYSIS_MODE != "combined" and not revision and not is_ui_image(prepared):
         response = make_response(jsonify({"status": "warning", "message": "The uploaded image does not appear to be UI-related. Analysis may not be relevant."}))
         response.set_cookie('session_id', session_id)
         return response, 200
     
-    # Start background processing
-    def background_processing():
-        print(f"🔄 Starting background analysis for {filename}")
-        results = analyze_with_gemini(image_path, session_id)
-        print(f"✅ Background analysis complete with {len(results)} results")
-    
-    thread = threading.Thread(target=background_processing)
-    thread.daemon = True
-    thread.start()
+    # Start background processing on the shared job pool; an older upload's job in this session is cancelled
+    token = start_session_token(session_id, prepared.hash)
+    record = submit_analysis_job(prepared, session_id, token, revision)
+    if record is None:
+        release_session_token(session_id, token)
+        response = busy_response({"status": "busy", "message": "Server is busy, preprocessing skipped"})
+        response.set_cookie('session_id', session_id)
+        return response
     
-    response = make_response(jsonify({"status": "success", "message": "Preprocessing started"}))
+    response = make_response(jsonify({"status": "success", "message": "Preprocessing started", "job_id": record["id"]}))
     response.set_cookie('session_id', session_id)
     return response, 200
 
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """Accept an upload and return a job ID immediately; poll GET /jobs/<id> for results."""
+    # Get or create session ID
+    session_id = get_session_id()
+    
+    if "image" not in request.files:
+        response = make_response(jsonify({"status": "error", "message": "No file uploaded"}))
+        response.set_cookie('session_id', session_id)
+        return response, 400
+
+    file = request.files["image"]
+    if file.filename == "":
+        response = make_response(jsonify({"status": "error", "message": "Empty file"}))
+        response.set_cookie('session_id', session_id)
+        return response, 400
+
+    # Refuse before touching disk if the backlog is already full
+    if jobs_pending >= JOB_WORKERS + JOB_QUEUE_LIMIT:
+        response = busy_response({"status": "busy", "message": "Too many pending analyses, please retry later"})
+        response.set_cookie('session_id', session_id)
+        return response
+
+    try:
+        prepared = load_upload(file)
+    except ValueError as e:
+        response = make_response(jsonify({"status": "error", "message": str(e)}))
+        response.set_cookie('session_id', session_id)
+        return response, getattr(e, "status", 400)
+    
+    token = start_session_token(session_id, prepared.hash)
+    record = submit_analysis_job(prepared, session_id, token, parse_revision(request.args.get("revision")))
+    if record is None:
+        release_session_token(session_id, token)
+        response = busy_response({"status": "busy", "message": "Too many pending analyses, please retry later"})
+        response.set_cookie('session_id', session_id)
+        return response
+    
+    response = make_response(jsonify({"job_id": record["id"], "status": record["status"], "status_url": f"/jobs/{record['id']}"}), 202)
+    response.headers["Location"] = f"/jobs/{record['id']}"
+    response.set_cookie('session_id', session_id)
+    return response
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """Return a job's status, and its results once complete."""
+    record = job_store.get(job_id)
+    if record is None:
+        return jsonify({"status": "error", "message": "Unknown job ID"}), 404
+    
+    body = {
+        "job_id": record["id"],
+        "status": record["status"],
+        "created": record["created"],
+        "started": record["started"],
+        "finished": record["finished"]
+    }
+    if record["status"] == "complete":
+        body["results"] = record["results"]
+    elif record["status"] in ("failed", "cancelled"):
+        body["error"] = record["error"]
+    elif record["status"] == "queued":
+        body["queue_depth"] = jobs_pending
+    
+    response = make_response(jsonify(body))
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    if record["status"] in ("queued", "running"):
+        response.headers["Retry-After"] = "1"
+    return response
+
 @app.route("/analyze", methods=["POST"])
 def analyze_image():
-    """Handle image uploads and analyze across all UX principles."""
+    """Handle image uploads and analyze across all UX principles.
+
+    With ?revision=1 the upload is treated as a new version of the session's
+    current image, and only the regions that changed are re-analyzed.
+    """
     # Get or create session ID
     session_id = get_session_id()
     
@@ -617,35 +3826,366 @@ def analyze_image():
         response.set_cookie('session_id', session_id)
         return response, 400
 
-    # Save with timestamp to prevent file overwrites
-    filename = str(int(time.time())) + "_" + file.filename
-    image_path = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(image_path)
+    try:
+        categories = parse_categories(request.args.get("categories"))
+        deadline = request_deadline()
+        prepared = load_upload(file)
+    except ValueError as e:
+        response = make_response(jsonify([{"label": "Error", "confidence": "N/A", "response": str(e)}]))
+        response.set_cookie('session_id', session_id)
+        return response, getattr(e, "status", 400)
 
-    results = analyze_with_gemini(image_path, session_id)
+    # Categories that can't finish before the deadline come back as skipped placeholders
+    try:
+        token = start_session_token(session_id, prepared.hash, deadline)
+        results = analyze_with_gemini(prepared, session_id, categories, token, parse_revision(request.args.get("revision")))
+    except AnalysisCancelled as e:
+        return cancelled_response(e, session_id)
     
     response = make_response(jsonify(results))
     response.headers["Access-Control-Allow-Origin"] = "*"
     response.set_cookie('session_id', session_id)
     return response
 
+def format_sse(event, data):
+    """Encode one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route("/analyze/stream", methods=["POST"])
+def analyze_image_stream():
+    """Analyze an upload and stream each category result as soon as it is ready.
+
+    Emits a `category` event per formatted result, then a `summary` event
+    carrying the full sorted result list in the same shape as POST /analyze.
+    Accepts ?categories= and ?revision= like POST /analyze.
+    """
+    # Get or create session ID
+    session_id = get_session_id()
+    
+    if "image" not in request.files:
+        response = make_response(jsonify([{"label": "Error", "confidence": "N/A", "response": "No file uploaded"}]))
+        response.set_cookie('session_id', session_id)
+        return response, 400
+
+    file = request.files["image"]
+    if file.filename == "":
+        response = make_response(jsonify([{"label": "Error", "confidence": "N/A", "response": "Empty file"}]))
+        response.set_cookie('session_id', session_id)
+        return response, 400
+
+    try:
+        categories = parse_categories(request.args.get("categories"))
+        deadline = request_deadline()
+        prepared = load_upload(file)
+    except ValueError as e:
+        response = make_response(jsonify([{"label": "Error", "confidence": "N/A", "response": str(e)}]))
+        response.set_cookie('session_id', session_id)
+        return response, getattr(e, "status", 400)
+    
+    token = start_session_token(session_id, prepared.hash, deadline)
+    previous = revision_base(session_id, prepared) if parse_revision(request.args.get("revision")) else None
+    update_session(session_id, image_path=prepared.path, image_hash=prepared.hash, luma=prepared.luma,
+                   analysis=[], timestamp=time.time())
+    started = time.time()
+    
+    # Run the pipeline off the request thread so events can be flushed as they arrive;
+    # it counts against the same backlog as /jobs
+    key = analysis_job_key(prepared.hash, categories)
+    job, is_leader = join_or_start_job(key)
+    if is_leader and not submit_stream_job(job, prepared, categories, token, previous):
+        release_session_token(session_id, token)
+        response = busy_response([{"label": "Error", "confidence": "N/A", "response": "Too many pending analyses, please retry later"}])
+        response.set_cookie('session_id', session_id)
+        return response
+    trace = g.trace
+    
+    def generate():
+        nonlocal job, is_leader
+        sent = set()
+        try:
+            # Same takeover rules as run_shared_analysis: if the request leading a joined
+            # job is cancelled, this one restarts it, and already sent categories aren't repeated
+            while True:
+                try:
+                    # A leader's pipeline checks the token itself; a follower checks it here
+                    for result in job.stream(None if is_leader else token):
+                        if result.get("category") not in sent:
+                            sent.add(result.get("category"))
+                            yield format_sse("category", result)
+                    results = job.wait()
+                    break
+                except AnalysisCancelled as e:
+                    if not is_leader and token.expired() and not token.cancelled:
+                        # Out of time while following: finish with what the job has published
+                        results = sorted(complete_with_skipped(list(job.partial), categories or list(UX_PROMPTS)),
+                                         key=lambda x: x.get('category', ''))
+                        break
+                    if is_leader or token.cancelled or token.expired():
+                        end_trace(trace, 409)
+                        yield format_sse("summary", {"status": "cancelled", "message": str(e), "elapsed": round(time.time() - started, 3)})
+                        return
+                    print(f"🔁 Joined analysis of {prepared.hash[:12]} was cancelled, taking over")
+                    job, is_leader = join_or_start_job(key)
+                    if is_leader and not submit_stream_job(job, prepared, categories, token, previous):
+                        end_trace(trace, 429)
+                        yield format_sse("summary", {"status": "busy", "message": "Too many pending analyses, please retry later",
+                                                     "elapsed": round(time.time() - started, 3)})
+                        return
+            
+            for result in results:
+                if result.get("category") not in sent:
+                    yield format_sse("category", result)
+            store_session_results(session_id, prepared.hash, results)
+            end_trace(trace, 200)
+            yield format_sse("summary", {
+                "status": "complete",
+                "count": len(results),
+                "elapsed": round(time.time() - started, 3),
+                "results": results
+            })
+        finally:
+            release_session_token(session_id, token)
+    
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # Stop proxies from buffering the stream
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.set_cookie('session_id', session_id)
+    return response
+
+@app.route("/analyze/batch", methods=["POST"])
+def analyze_batch():
+    """Analyze many screenshots, sent as repeated `images` files and/or zip archives.
+
+    Returns every image's results in upload order. With ?stream=1 (or an
+    Accept: text/event-stream header) an `image` event is sent per screenshot
+    as soon as it finishes, then a `summary` event. Each image's `results`
+    has the same shape as POST /analyze, and ?categories= works the same way.
+    An image that fails the upload checks gets status "error" and the `code`
+    POST /analyze would have answered with (400, 413 or 415). Answers 429 with
+    Retry-After while BATCH_MAX_PENDING images are pending.
+    """
+    # Get or create session ID
+    session_id = get_session_id()
+    
+    # Refuse before the body is received if the batch backlog is already full
+    if batch_pending >= BATCH_MAX_PENDING:
+        response = busy_response({"status": "busy", "message": "Too many pending batch images, please retry later"})
+        response.set_cookie('session_id', session_id)
+        return response
+    
+    # Must be raised before request.files parses the body against the single-upload limit
+    request.max_content_length = BATCH_MAX_BODY_BYTES
+    files = [f for f in request.files.getlist("images") + request.files.getlist("image") if f.filename]
+    if not files:
+        response = make_response(jsonify({"status": "error", "message": "No files uploaded"}))
+        response.set_cookie('session_id', session_id)
+        return response, 400
+    
+    try:
+        categories = parse_categories(request.args.get("categories"))
+        entries = read_batch_uploads(files)
+    except ValueError as e:
+        response = make_response(jsonify({"status": "error", "message": str(e)}))
+        response.set_cookie('session_id', session_id)
+        return response, 400
+    if not entries:
+        response = make_response(jsonify({"status": "error", "message": "No images found in upload"}))
+        response.set_cookie('session_id', session_id)
+        return response, 400
+    if not reserve_batch_images(len(entries)):
+        response = busy_response({"status": "busy", "message": "Too many pending batch images, please retry later"})
+        response.set_cookie('session_id', session_id)
+        return response
+    
+    started = time.time()
+    stream = request.args.get("stream") in ("1", "true") or "text/event-stream" in request.headers.get("Accept", "")
+    
+    if not stream:
+        images = sorted(iter_batch(entries, categories), key=lambda item: item["index"])
+        response = make_response(jsonify({
+            "status": "complete",
+            "count": len(images),
+            "unique": len({item.get("image_hash") for item in images} - {None}),
+            "elapsed": round(time.time() - started, 3),
+            "images": images
+        }))
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        response.set_cookie('session_id', session_id)
+        return response
+    
+    trace = g.trace
+    streams = detach_uploads(files)
+    
+    def generate():
+        hashes = []
+        try:
+            for item in iter_batch(entries, categories):
+                hashes.append(item.get("image_hash"))
+                yield format_sse("image", item)
+        finally:
+            for stream in streams:
+                stream.close()
+        end_trace(trace, 200)
+        yield format_sse("summary", {
+            "status": "complete",
+            "count": len(hashes),
+            "unique": len(set(hashes) - {None}),
+            "elapsed": round(time.time() - started, 3)
+        })
+    
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # Stop proxies from buffering the stream
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.set_cookie('session_id', session_id)
+    return response
+
+# Admin endpoints expose internals and can start model spend, so callers must send
+# ADMIN_TOKEN in an X-Admin-Token header; with no token configured they are disabled
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+def admin_denied(headers):
+    """Return (message, status) if `headers` don't carry the admin token, else None."""
+    if not ADMIN_TOKEN:
+        return "Admin endpoints are disabled; set ADMIN_TOKEN to enable them", 403
+    if not hmac.compare_digest(headers.get("X-Admin-Token", "").encode(), ADMIN_TOKEN.encode()):
+        return "Missing or invalid X-Admin-Token", 401
+    return None
+
+def require_admin(view):
+    """Answer 401/403 instead of running `view` unless the request carries the admin token."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        denied = admin_denied(request.headers)
+        if denied:
+            message, status = denied
+            return jsonify({"status": "error", "message": message}), status
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route("/admin/stats", methods=["GET"])
+@require_admin
+def admin_stats():
+    """Report model-call executor, job queue and cache counters."""
+    return jsonify({
+        "model_executor": model_executor.stats(),
+        "jobs": {"pending": jobs_pending, "workers": JOB_WORKERS, "queue_limit": JOB_QUEUE_LIMIT, "tracked": len(job_store)},
+        "batches": {"pending_images": batch_pending, "max_pending": BATCH_MAX_PENDING, "workers": BATCH_WORKERS},
+        "caches": {
+            "ui_detection": {"size": len(ui_detection_cache), "hits": ui_detection_cache.hits, "misses": ui_detection_cache.misses},
+            "category": {"size": len(category_cache), "hits": category_cache.hits, "misses": category_cache.misses},
+            "image_meta": {"size": len(image_meta_cache), "hits": image_meta_cache.hits, "misses": image_meta_cache.misses}
+        },
+        "sessions": {
+            "backend": STORE_BACKEND, "size": len(session_store), "max_count": SESSION_MAX_COUNT,
+            "bytes": session_store.bytes, "max_bytes": SESSION_MAX_BYTES if STORE_BACKEND == "memory" else None,
+            "evictions": session_store.evictions, "hits": session_store.hits, "misses": session_store.misses
+        },
+        "uploads": {"files": len(upload_index), "bytes": upload_index.total_bytes, "max_bytes": UPLOAD_MAX_BYTES, "removed": upload_index.removed},
+        "janitor": dict(janitor_state, interval=JANITOR_INTERVAL),
+        "near_duplicates": {"indexed": len(phash_index), "max_distance": PHASH_MAX_DISTANCE},
+        "prompts": {"ui_detection": UI_FINGERPRINT, "categories": CATEGORY_FINGERPRINTS},
+        "rewarm": dict(rewarm_state)
+    })
+
+@app.route("/admin/rewarm", methods=["POST"])
+@require_admin
+def admin_rewarm():
+    """Start a low-priority re-warm of results cached under old prompt fingerprints."""
+    if rewarm_state["running"]:
+        return jsonify({"status": "running", "rewarm": dict(rewarm_state)}), 409
+    start_rewarm()
+    return jsonify({"status": "started"}), 202
+
+def render_metric(name, help_text, metric_type, samples):
+    """Render one metric family from a dict of formatted label string -> value."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples.items():
+        lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    return lines
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Expose latency histograms, cache, executor and job metrics in the Prometheus text format."""
+    executor = model_executor.stats()
+    caches = {"ui_detection": ui_detection_cache, "category": category_cache, "image_meta": image_meta_cache}
+    cache_labels = {name: format_labels(("cache",), (name,)) for name in caches}
+    
+    lines = request_seconds.render() + stage_seconds.render() + model_errors.render()
+    lines += render_metric("ux_analysis_model_calls_total", "Model call attempts.", "counter", {"": executor["calls"]})
+    lines += render_metric("ux_analysis_model_retries_total", "Model calls retried after a rate-limit error.", "counter", {"": executor["retries"]})
+    lines += render_metric("ux_analysis_model_failures_total", "Model calls that failed after all retries.", "counter", {"": executor["errors"]})
+    lines += render_metric("ux_analysis_model_queue_depth", "Model calls waiting for the concurrency or rate limit.", "gauge", {"": executor["queue_depth"]})
+    lines += render_metric("ux_analysis_model_in_flight", "Model calls currently running.", "gauge", {"": executor["in_flight"]})
+    lines += render_metric("ux_analysis_model_max_concurrency", "Configured model call concurrency limit.", "gauge", {"": executor["max_concurrency"]})
+    lines += render_metric("ux_analysis_cache_hits_total", "Cache lookups that found an entry.", "counter",
+                           {cache_labels[name]: cache.hits for name, cache in caches.items()})
+    lines += render_metric("ux_analysis_cache_misses_total", "Cache lookups that found nothing.", "counter",
+                           {cache_labels[name]: cache.misses for name, cache in caches.items()})
+    lines += render_metric("ux_analysis_cache_hit_ratio", "Hits over lookups since start.", "gauge",
+                           {cache_labels[name]: round(cache.hits / max(1, cache.hits + cache.misses), 4) for name, cache in caches.items()})
+    lines += render_metric("ux_analysis_cache_entries", "Entries currently cached.", "gauge",
+                           {cache_labels[name]: len(cache) for name, cache in caches.items()})
+    lines += render_metric("ux_analysis_jobs_pending", "Queued plus running background jobs.", "gauge", {"": jobs_pending})
+    lines += render_metric("ux_analysis_batch_images_pending", "Images of accepted batches not yet analyzed.", "gauge", {"": batch_pending})
+    lines += render_metric("ux_analysis_upload_bytes", "Bytes of saved uploads on disk.", "gauge", {"": upload_index.total_bytes})
+    lines += render_metric("ux_analysis_sessions", "Sessions currently stored.", "gauge", {"": len(session_store)})
+    lines += render_metric("ux_analysis_session_bytes", "Bytes held by stored session records.", "gauge", {"": session_store.bytes})
+    lines += render_metric("ux_analysis_session_evictions_total", "Sessions evicted to stay within the count or byte budget.", "counter", {"": session_store.evictions})
+    lines += render_metric("ux_analysis_inflight_analyses", "Distinct images being analyzed right now.", "gauge", {"": len(inflight_jobs)})
+    lines += render_metric("ux_analysis_near_duplicates_indexed", "Images in the near-duplicate index.", "gauge", {"": len(phash_index)})
+    
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
 @app.route("/analyze", methods=["GET"])
 def get_latest_analysis():
-    """Return the most recent analysis results for this session."""
+    """Return the most recent analysis results for this session.
+
+    ?categories=gestalt,cognitive returns only those categories, recomputing
+    just the ones that are missing or failed (e.g. to load one tab on demand).
+    """
     # Get session ID from cookie (or create new one)
     session_id = get_session_id()
     
-    # Check if we have data for this session
-    if session_id in session_data and session_data[session_id].get('image_path'):
-        # If no analysis yet but we have an image path, try to generate it
-        if not session_data[session_id].get('analysis'):
-            image_path = session_data[session_id]['image_path']
-            session_data[session_id]['analysis'] = analyze_with_gemini(image_path, session_id)
-        
-        analysis_results = session_data[session_id].get('analysis', [])
-    else:
-        # New session with no data yet
-        analysis_results = []
+    try:
+        categories = parse_categories(request.args.get("categories"))
+        deadline = request_deadline()
+    except ValueError as e:
+        response = make_response(jsonify([{"label": "Error", "confidence": "N/A", "response": str(e)}]))
+        response.set_cookie('session_id', session_id)
+        return response, 400
+    
+    # Check if we have data for this session (possibly written by another worker)
+    data = get_session(session_id)
+    try:
+        if data and data.get('image_hash') and categories is not None:
+            token = CancelToken(data['image_hash'], deadline)
+            analysis_results = refresh_session_categories(session_id, data, categories, token)
+        elif data and (data.get('image_path') or data.get('image_hash')):
+            # If no analysis yet, wait for one in flight or regenerate from the saved upload
+            analysis_results = session_results(data)
+            if not analysis_results:
+                token = start_session_token(session_id, data.get('image_hash'), deadline)
+                job = inflight_jobs.get(("analysis", data.get('image_hash')))
+                if job is not None:
+                    joined = wait_for_job(job, token, list(UX_PROMPTS))
+                else:
+                    # Or for one running in another worker process, when the stores are shared
+                    joined = wait_for_leased_analysis(data.get('image_hash'), list(UX_PROMPTS), token)
+                if joined is not None:
+                    release_session_token(session_id, token)
+                    analysis_results = joined
+                    store_session_results(session_id, data.get('image_hash'), analysis_results)
+                elif data.get('image_path') and os.path.exists(data['image_path']):
+                    analysis_results = analyze_with_gemini(load_saved_image(data['image_path']), session_id, token=token)
+                else:
+                    release_session_token(session_id, token)
+        else:
+            # New session with no data yet
+            analysis_results = []
+    except AnalysisCancelled as e:
+        return cancelled_response(e, session_id)
     
     print(f"📢 Returning Analysis for session {session_id}: {len(analysis_results)} items")
     response = make_response(jsonify(analysis_results))
@@ -653,51 +4193,197 @@ def get_latest_analysis():
     response.set_cookie('session_id', session_id)
     return response
 
-# Simple cleanup function to prevent storage overflow on Render
-def cleanup_old_files():
-    """Delete files older than 1 hour to prevent storage overflow."""
-    try:
-        now = time.time()
-        for filename in os.listdir(UPLOAD_FOLDER):
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.isfile(file_path) and os.stat(file_path).st_mtime < now - 3600:
-                os.remove(file_path)
-                print(f"🧹 Cleaned up old file: {filename}")
-    except Exception as e:
-        print(f"❌ Error during cleanup: {str(e)}")
+# Background janitor: uploads, sessions, jobs and cached results expire off the request path
+JANITOR_INTERVAL = float(os.getenv("JANITOR_INTERVAL", 60))
+UPLOAD_TTL = int(os.getenv("UPLOAD_TTL", 3600))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 500 * 1024 * 1024))  # Disk quota for saved uploads
 
-# Cleanup old session data periodically as well
-def cleanup_old_sessions():
-    """Delete session data older than 1 hour."""
+class UploadIndex:
+    """Saved uploads in a min-heap by creation time, with a running byte total.
+
+    Age expiry and the disk quota both remove the oldest files first, so
+    each pass costs O(removed log n) instead of a listdir and stat of the
+    whole folder.
+    """
+
+    def __init__(self, folder, ttl, max_bytes):
+        self.folder = folder
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.removed = 0
+        self._heap = []  # (created, path, size)
+        self._lock = threading.Lock()
+
+    def scan(self):
+        """Adopt files left by earlier runs; the only full listing of the folder."""
+        for filename in os.listdir(self.folder):
+            path = os.path.join(self.folder, filename)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                self.add(path, stat.st_size, stat.st_mtime)
+
+    def add(self, path, size, created=None):
+        with self._lock:
+            heapq.heappush(self._heap, (created or time.time(), path, size))
+            self.total_bytes += size
+        # Enforce the quota right away so a burst of uploads cannot fill the disk between sweeps
+        if self.total_bytes > self.max_bytes:
+            self.expire()
+
+    def expire(self):
+        """Delete uploads past their TTL, then the oldest ones over the byte quota."""
+        cutoff = time.time() - self.ttl
+        doomed = []
+        with self._lock:
+            while self._heap and (self._heap[0][0] < cutoff or self.total_bytes > self.max_bytes):
+                _, path, size = heapq.heappop(self._heap)
+                self.total_bytes -= size
+                doomed.append(path)
+            self.removed += len(doomed)
+        for path in doomed:
+            try:
+                os.remove(path)
+                print(f"🧹 Cleaned up old file: {os.path.basename(path)}")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"❌ Error removing {path}: {str(e)}")
+        return len(doomed)
+
+    def __len__(self):
+        return len(self._heap)
+
+upload_index = UploadIndex(UPLOAD_FOLDER, UPLOAD_TTL, UPLOAD_MAX_BYTES)
+janitor_state = {"runs": 0, "last_run": None, "last_removed": {}}
+
+def run_janitor_pass():
+    """Expire every store once; each removal costs O(expired), not O(total)."""
+    removed = {
+        "uploads": upload_index.expire(),
+        "sessions": session_store.expire(),
+        "jobs": job_store.expire(),
+        "ui_detection": ui_detection_cache.expire(),
+        "category": category_cache.expire(),
+        "image_meta": image_meta_cache.expire(),
+        "analysis_leases": analysis_leases.expire()
+    }
+    janitor_state.update(runs=janitor_state["runs"] + 1, last_run=time.time(), last_removed=removed)
+    if any(removed.values()):
+        print(f"🧹 Janitor removed {', '.join(f'{count} {name}' for name, count in removed.items() if count)}")
+    return removed
+
+def janitor_loop():
+    while True:
+        time.sleep(JANITOR_INTERVAL)
+        try:
+            run_janitor_pass()
+        except Exception as e:
+            print(f"❌ Error during janitor pass: {str(e)}")
+
+# Warm-up: once the server is up, a background thread creates the model client (importing
+# the SDK), opens its connection with a token count and loads Pillow's codecs, so the
+# first request doesn't pay for them. GET /ready answers 503 until it has finished.
+WARMUP_PING = os.getenv("WARMUP_PING", "true").lower() in ("1", "true", "yes")
+warmup_state = {"status": "pending", "started": None, "finished": None, "steps": {}, "error": None}
+
+def warm_up():
+    """Load what the first request would otherwise wait for, recording each step in warmup_state."""
+    def step(name, fn):
+        started = time.perf_counter()
+        try:
+            fn()
+        finally:
+            warmup_state["steps"][name] = round(time.perf_counter() - started, 3)
+    
+    warmup_state.update(status="warming", started=time.time())
     try:
-        with lock:
-            now = time.time()
-            sessions_to_remove = []
-            for s_id, data in session_data.items():
-                if 'timestamp' not in data:
-                    data['timestamp'] = now  # Add timestamp for new sessions
-                elif data['timestamp'] < now - 3600:
-                    sessions_to_remove.append(s_id)
-            
-            for s_id in sessions_to_remove:
-                del session_data[s_id]
-                print(f"🧹 Cleaned up old session: {s_id}")
+        step("model_client", model.load)
+        if WARMUP_PING and hasattr(model.load(), "count_tokens"):
+            try:
+                step("model_connection", lambda: model.count_tokens("ping"))
+            except Exception as e:
+                # The API may just be slow to answer; real calls retry on their own
+                print(f"⚠️ Warm-up ping failed: {str(e)}")
+        step("image_modules", lambda: (Image.load(), np.load()))
+        step("image_codecs", warm_image_codecs)
+        # Log before the status flips, so anything waiting on /ready sees the line already written.
+        # Status and finish time change together, so /ready never shows one without the other
+        print(f"🔥 Warm-up finished in {sum(warmup_state['steps'].values()):.2f}s: {warmup_state['steps']}")
+        warmup_state.update(status="ready", finished=time.time())
     except Exception as e:
-        print(f"❌ Error during session cleanup: {str(e)}")
+        print(f"❌ Warm-up failed: {str(e)}")
+        warmup_state.update(status="failed", error=str(e), finished=time.time())
+
+def warm_image_codecs():
+    """Run a tiny image through every encoder, the decoder and the NumPy features once."""
+    image = Image.new("RGB", (64, 64), "white")
+    for encoding in ("png", "png-palette", "jpeg") + (("webp",) if webp_supported() else ()):
+        data, _ = encode_image(image, encoding)
+        Image.open(io.BytesIO(data)).load()
+    ui_prefilter_features(image)
+    compute_dhash(image)
+
+services_lock = threading.Lock()
+services_started = False
+
+def start_background_services():
+    """Start the janitor, the re-warm pass and the warm-up, once per process."""
+    global services_started
+    with services_lock:
+        if services_started:
+            return
+        services_started = True
+    upload_index.scan()
+    threading.Thread(target=janitor_loop, name="janitor", daemon=True).start()
+    # Fingerprints are fixed for the life of a process, so only a shared store can hold stale
+    # results; the jitter keeps workers started together from re-warming the same images at once
+    if STORE_BACKEND == "sqlite" and REWARM_TOP_N > 0:
+        start_rewarm(REWARM_DELAY + random.uniform(0, REWARM_DELAY))
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+def create_app():
+    """App factory: check the configuration, start background services and warm-up, and return the app.
+
+    Serve with `gunicorn 'app:create_app()'` (without --preload, so each
+    worker starts its own threads) or `python app.py`. Importing this module
+    does none of this, so scripts and tools import it in a fraction of the
+    time. Raises ValueError if the Gemini API key is missing.
+    """
+    if MODEL_BACKEND != "fake" and not GEMINI_API_KEY:
+        raise ValueError("❌ ERROR: Missing Gemini API Key in .env file!")
+    start_background_services()
+    return app
+
+@app.before_request
+def ensure_background_services():
+    # Servers pointed at `app:app` never call create_app
+    if not services_started:
+        start_background_services()
+
+@app.route("/ready")
+def ready():
+    """Readiness probe: 200 once warm-up has finished, 503 while warming up or if it failed.
+
+    Unlike "/", which answers as soon as the process is up, this tells a
+    load balancer when the instance can serve analyses without a cold start.
+    """
+    body = dict(warmup_state, model_loaded=model.loaded)
+    if warmup_state["status"] == "ready":
+        return jsonify(body)
+    response = make_response(jsonify(body), 503)
+    if warmup_state["status"] != "failed":
+        response.headers["Retry-After"] = "1"
+    return response
 
 @app.route("/")
 def home():
-    # Run cleanup on homepage visits
-    cleanup_old_files()
-    cleanup_old_sessions()
-    
     # Get or create session ID and set it in cookie
     session_id = get_session_id()
     
     # Initialize session data if needed
-    if session_id not in session_data:
-        with lock:
-            session_data[session_id] = {'timestamp': time.time()}
+    if get_session(session_id) is None:
+        update_session(session_id)
     
     html_response = """
     <html>
@@ -737,6 +4423,6 @@ if __name__ == "__main__":
     print(f"🚀 Flask server is starting on port {port}...")
     try:
         # For Render deployment, use 0.0.0.0 as host and disable debug mode
-        app.run(host="0.0.0.0", port=port, debug=False)
+        create_app().run(host="0.0.0.0", port=port, debug=False)
     except Exception as e:
         print(f"🔥 Error starting Flask: {e}")
\ No newline at end of file
@@ -0,0 +1,742 @@
+"""ASGI entry point that serves the analysis API with async model calls.
+
+Usage (from the backend folder):
+    pip install starlette python-multipart uvicorn
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+POST /preprocess and POST/GET /analyze are served natively on the event
+loop. Every model call is awaited (generate_content_async), the UX
+categories of an image run under asyncio.gather, and a pending analysis
+holds no thread, so one worker can keep thousands of them open. When a
+client disconnects before its answer is ready, its model calls are cancelled
+unless another request is waiting on the same work. The same goes for an
+analysis superseded by a newer upload in its session (in either serving
+mode), and deadline_ms / X-Deadline-Ms work as in app.py. All other routes ("/",
+/ready, jobs, streaming, batch, admin and metrics) are passed through to the
+Flask app in app.py, created with its create_app() factory. That app also owns the prompts, caches and session store used
+here.
+
+Starlette is only needed for this entry point; `python app.py` works
+without it. Awaited model calls share the MODEL_MAX_CONCURRENCY and
+MODEL_RATE_PER_MINUTE budget of the thread executor that serves the
+passed-through routes. With STORE_BACKEND=sqlite, store reads and writes run
+in a worker thread so they don't block the event loop.
+"""
+import asyncio
+import functools
+import os
+import random
+import time
+import uuid
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+import app as core
+
+# Background analyses started by /preprocess that may be pending at once
+ASGI_MAX_BACKGROUND = int(os.getenv("ASGI_MAX_BACKGROUND", 5000))
+
+
+async def generate_async(client, parts, **kwargs):
+    """Await one model call, in a thread if the client has no async API."""
+    if hasattr(client, "generate_content_async"):
+        return await client.generate_content_async(parts, **kwargs)
+    return await asyncio.to_thread(client.generate_content, parts, **kwargs)
+
+
+class AsyncModelLimiter:
+    """Event-loop counterpart of app.ModelCallExecutor.
+
+    Admits awaited model calls through the executor's CallSlots and token
+    bucket, so both serving modes share one concurrency and rate budget, and
+    retries rate-limit errors with full-jitter exponential backoff.
+    """
+
+    def __init__(self, executor):
+        self.max_concurrency = executor.max_concurrency
+        self.max_retries = executor.max_retries
+        self.backoff_base = executor.backoff_base
+        self._slots = executor.slots
+        self._bucket = executor.bucket
+        self.queued = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self.cancelled = 0
+
+    async def generate(self, parts, category="", **kwargs):
+        attempt = 0
+        while True:
+            self.queued += 1
+            started = time.perf_counter()
+            try:
+                if self._bucket is not None:
+                    wait = self._bucket.try_acquire()
+                    while wait:
+                        await asyncio.sleep(wait)
+                        wait = self._bucket.try_acquire()
+                await self._slots.acquire_async()
+            finally:
+                self.queued -= 1
+                core.record_stage("model_queue", time.perf_counter() - started, category)
+
+            self.in_flight += 1
+            self.calls += 1
+            started = time.perf_counter()
+            try:
+                return await generate_async(core.model, parts, **kwargs)
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+            except Exception as e:
+                rate_limited = core.is_rate_limit_error(e)
+                core.model_errors.inc("rate_limit" if rate_limited else "error", type(e).__name__)
+                if not rate_limited or attempt >= self.max_retries:
+                    self.errors += 1
+                    raise
+                error = e
+            finally:
+                core.record_stage("model_call", time.perf_counter() - started, category)
+                self.in_flight -= 1
+                self._slots.release()
+
+            delay = random.uniform(0, self.backoff_base * (2 ** attempt))
+            attempt += 1
+            self.retries += 1
+            print(f"⏳ Rate limited ({str(error)[:80]}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": self.queued,
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "retries": self.retries,
+            "errors": self.errors,
+            "cancelled": self.cancelled
+        }
+
+
+limiter = AsyncModelLimiter(core.model_executor)
+
+
+async def store_call(fn, *args, **kwargs):
+    """Call fn, which reads or writes the stores, in a worker thread if they are SQLite."""
+    if core.STORE_BACKEND == "sqlite":
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+# Work in flight on the event loop, keyed like app.inflight_jobs: key -> [task, waiter count, key]
+shared_tasks = {}
+background_tasks = set()
+disconnects = 0
+
+
+def join_shared(key, factory):
+    """Register as a waiter on the work for key, starting it with factory() if it is not in flight."""
+    entry = shared_tasks.get(key)
+    if entry is None:
+        entry = shared_tasks[key] = [asyncio.ensure_future(factory()), 0, key]
+
+        def unregister(task):
+            if shared_tasks.get(key) is entry:
+                del shared_tasks[key]
+        entry[0].add_done_callback(unregister)
+    else:
+        print(f"🔗 Joining in-flight {key[0]} task for {key[1][:12]}")
+    entry[1] += 1
+    return entry
+
+
+async def await_shared(entry):
+    """Wait for joined work; it is cancelled once every waiter has been cancelled."""
+    try:
+        return await asyncio.shield(entry[0])
+    finally:
+        entry[1] -= 1
+        if not entry[1] and not entry[0].done():
+            entry[0].cancel()
+            # Unregister now, not when the cancellation lands, so nobody joins work that is going away
+            if shared_tasks.get(entry[2]) is entry:
+                del shared_tasks[entry[2]]
+
+
+async def run_shared(key, factory=None):
+    """Await the work for key, starting it with factory() unless it is already in flight.
+
+    With factory None this only joins work in flight and returns None if
+    there is none.
+    """
+    if factory is None and key not in shared_tasks:
+        return None
+    return await await_shared(join_shared(key, factory))
+
+
+async def detect_ui_async(prepared):
+    """Async app.detect_ui."""
+    try:
+        response = await limiter.generate([core.UI_DETECTION_PROMPT, prepared.part], "ui-detection", stream=False)
+        return await store_call(core.apply_ui_response, prepared, response.text)
+    except Exception as e:
+        print(f"❌ Error during UI detection: {str(e)}")
+        return False
+
+
+async def is_ui_image_async(prepared):
+    """Async app.is_ui_image."""
+    cached = await store_call(core.ui_detection_cache.get, core.ui_key(prepared.hash))
+    if cached is not None:
+        print(f"🔄 UI detection cache hit for {prepared.filename}")
+        return cached
+
+    verdict = await asyncio.to_thread(core.prefilter_ui, prepared)
+    if verdict is not None:
+        return verdict
+
+    return await run_shared(("ui", prepared.hash), functools.partial(detect_ui_async, prepared))
+
+
+async def run_combined_async(prepared):
+    """Async app.run_combined_analysis."""
+    try:
+        print(f"🔄 Processing combined analysis...")
+        response = await limiter.generate(
+            [core.COMBINED_PROMPT, prepared.part],
+            "combined",
+            stream=False,
+            generation_config=core.COMBINED_GENERATION_CONFIG
+        )
+        analysis_text = response.text if response and hasattr(response, 'text') else ""
+        return await store_call(core.apply_combined_response, prepared, analysis_text)
+    except Exception as e:
+        print(f"❌ Error during combined analysis: {str(e)}")
+        return []
+
+
+async def run_revision_async(prepared, previous):
+    """Async app.run_revision_analysis."""
+    plan = await asyncio.to_thread(core.plan_revision, prepared, previous)
+    if plan is None:
+        return []
+    regions, parts = plan
+    if parts is None:
+        return await store_call(core.carry_over_results, prepared, previous)
+    try:
+        print(f"🔁 Re-analyzing {len(regions)} changed regions of {prepared.filename}...")
+        response = await limiter.generate(parts, "revision", stream=False, generation_config=core.COMBINED_GENERATION_CONFIG)
+        analysis_text = response.text if response and hasattr(response, 'text') else ""
+        return await store_call(core.apply_revision_response, prepared, previous, analysis_text)
+    except Exception as e:
+        print(f"❌ Error during revision analysis: {str(e)}")
+        return []
+
+
+async def run_tile_async(tile, index, count):
+    """Async app.run_tile_analysis."""
+    try:
+        print(f"🔄 Processing combined analysis of {tile.filename}...")
+        response = await limiter.generate(
+            [core.TILE_COMBINED_PROMPT + core.TILE_PROMPT.format(index=index + 1, count=count), tile.part],
+            "combined",
+            stream=False,
+            generation_config=core.COMBINED_GENERATION_CONFIG
+        )
+        analysis_text = response.text if response and hasattr(response, 'text') else ""
+        return await store_call(core.apply_tile_response, tile, analysis_text)
+    except Exception as e:
+        print(f"❌ Error during combined analysis of {tile.filename}: {str(e)}")
+        return []
+
+
+async def process_category_async(category, prepared, prompt=None):
+    """Async app.process_category; complete results are cached."""
+    try:
+        print(f"🔄 Processing {category} analysis...")
+        response = await limiter.generate(
+            [prompt or core.UX_PROMPTS[category], prepared.part],
+            category,
+            stream=False,
+            generation_config=core.GENERATION_CONFIG
+        )
+        analysis_text = response.text if response and hasattr(response, 'text') else ""
+        result = core.format_category_response(category, analysis_text)
+    except Exception as e:
+        print(f"❌ Error processing {category}: {str(e)}")
+        result = core.create_category_error(
+            category, "Analysis Error",
+            f"We encountered an issue analyzing this aspect of the design: {str(e)}"
+        )
+    if core.is_cacheable_result(result):
+        await store_call(core.category_cache.set, core.category_key(prepared.hash, category), result)
+    return result
+
+
+async def category_result_async(category, prepared, prompt=None):
+    cached = await store_call(core.category_cache.get, core.category_key(prepared.hash, category))
+    if cached is not None:
+        print(f"🔄 Cache hit for {category} analysis")
+        return cached
+    if prepared.tiles:
+        # What the tile calls in run_analysis_async left out is fetched per tile, all at once
+        count = len(prepared.tiles)
+        tile_results = await asyncio.gather(*(
+            category_result_async(category, tile, core.tile_prompt(core.UX_PROMPTS[category], index, count))
+            for index, tile in enumerate(prepared.tiles)
+        ))
+        result = core.merge_tile_results(category, tile_results)
+        if core.is_cacheable_result(result):
+            await store_call(core.category_cache.set, core.category_key(prepared.hash, category), result)
+        return result
+    return await run_shared(("category", prepared.hash, category),
+                            functools.partial(process_category_async, category, prepared, prompt))
+
+
+async def run_analysis_async(prepared, categories=None, previous=None):
+    """Async app.run_analysis: UI detection, then every requested category at once."""
+    image_hash = prepared.hash
+    requested = categories or list(core.UX_PROMPTS)
+
+    try:
+        if previous is not None and await store_call(core.needs_model_call, image_hash, requested):
+            await run_revision_async(prepared, previous)
+
+        if (core.ANALYSIS_MODE == "combined" and categories is None
+                and await store_call(core.needs_model_call, image_hash) and not prepared.tiles):
+            if (await store_call(core.ui_detection_cache.get, core.ui_key(image_hash)) is not None
+                    or await asyncio.to_thread(core.prefilter_ui, prepared) is not False):
+                await run_combined_async(prepared)
+
+        if await store_call(core.needs_model_call, image_hash, requested):
+            near_duplicate = await store_call(core.find_near_duplicate, prepared, requested)
+            if near_duplicate is not None:
+                return sorted(near_duplicate, key=lambda x: x.get('category', ''))
+
+        if not await is_ui_image_async(prepared):
+            await store_call(core.remember_phash, prepared)
+            return core.create_not_ui_result()
+
+        if prepared.tiles and await store_call(core.needs_model_call, image_hash, requested):
+            # One call per tile covers every category; see app.run_analysis
+            tiles = await store_call(core.tiles_to_analyze, prepared, requested)
+            await asyncio.gather(*(run_shared(("tile", tile.hash), functools.partial(run_tile_async, tile, index, len(prepared.tiles)))
+                                   for index, tile in tiles))
+
+        results = await asyncio.gather(*(category_result_async(category, prepared) for category in requested))
+        await store_call(core.remember_phash, prepared)
+        return sorted(results, key=lambda x: x.get('category', ''))
+    except Exception as e:
+        print(f"❌ Global analysis error: {str(e)}")
+        return core.create_analysis_error(e)
+
+
+async def wait_for_lease_async(image_hash, requested):
+    """Async app.wait_for_leased_analysis; run_with_token handles cancellation and deadlines."""
+    waiting = False
+    while True:
+        results, _, leased = await store_call(core.leased_analysis_state, image_hash, requested)
+        if results is not None or not leased:
+            return results
+        if not waiting:
+            waiting = True
+            print(f"🔗 Waiting for another worker's analysis of {image_hash[:12]}")
+        await asyncio.sleep(core.ANALYSIS_LEASE_POLL)
+
+
+async def keep_lease(image_hash, owner):
+    while True:
+        await asyncio.sleep(core.ANALYSIS_LEASE_TTL / 3)
+        await store_call(core.renew_analysis_lease, image_hash, owner)
+
+
+async def run_leased_async(prepared, categories=None, previous=None):
+    """Async app.run_leased_analysis; the lease is renewed on a timer while the analysis runs."""
+    if core.STORE_BACKEND != "sqlite":
+        return await run_analysis_async(prepared, categories, previous)
+    requested = categories or list(core.UX_PROMPTS)
+    while True:
+        if not await store_call(core.needs_model_call, prepared.hash, requested):
+            return await run_analysis_async(prepared, categories, previous)
+        owner = await store_call(core.acquire_analysis_lease, prepared.hash)
+        if owner is not None:
+            renewer = asyncio.ensure_future(keep_lease(prepared.hash, owner))
+            try:
+                return await run_analysis_async(prepared, categories, previous)
+            finally:
+                renewer.cancel()
+                await store_call(core.release_analysis_lease, prepared.hash, owner)
+        results = await wait_for_lease_async(prepared.hash, requested)
+        if results is not None:
+            return results
+
+
+async def analyze_shared(prepared, categories=None, previous=None):
+    """Async app.run_shared_analysis."""
+    if categories is not None:
+        results = await run_shared(core.analysis_job_key(prepared.hash))
+        if results is not None:
+            return core.select_categories(results, categories)
+    return await run_shared(
+        core.analysis_job_key(prepared.hash, categories),
+        functools.partial(run_leased_async, prepared, categories, previous)
+    )
+
+
+def cached_or_skipped(image_hash, categories=None):
+    """The requested categories already cached for image_hash, with a skipped placeholder for the rest."""
+    if core.ui_detection_cache.get(core.ui_key(image_hash)) is False:
+        return core.create_not_ui_result()
+    return [core.category_cache.get(core.category_key(image_hash, category)) or core.create_skipped_result(category)
+            for category in categories or core.UX_PROMPTS]
+
+
+async def run_with_token(token, coro, image_hash, categories=None):
+    """Await coro on behalf of a request holding an app.CancelToken.
+
+    Raises app.AnalysisCancelled once the token is cancelled (e.g. by a newer
+    upload in the session, from either serving mode). At the token's
+    deadline, returns the requested categories cached so far plus skipped
+    placeholders, like app.run_analysis. Either way only this request stops
+    waiting; joined work keeps running while another request waits on it.
+    """
+    work = asyncio.ensure_future(coro)
+    try:
+        while not work.done():
+            if token.cancelled:
+                raise core.AnalysisCancelled(token.reason)
+            remaining = token.remaining()
+            if remaining is not None and remaining <= 0:
+                print(f"⏱️ Deadline reached for {image_hash[:12]}, returning partial results")
+                return sorted(await store_call(cached_or_skipped, image_hash, categories), key=lambda x: x.get('category', ''))
+            await asyncio.wait({work}, timeout=core.CANCEL_POLL_INTERVAL if remaining is None
+                               else min(core.CANCEL_POLL_INTERVAL, remaining))
+        return work.result()
+    finally:
+        work.cancel()
+
+
+async def analyze_async(prepared, session_id, categories=None, revision=False, deadline=None, token=None):
+    """Async app.analyze_with_gemini; raises app.AnalysisCancelled if a newer upload supersedes it."""
+    previous = await store_call(core.revision_base, session_id, prepared) if revision else None
+    if token is None:
+        token = core.start_session_token(session_id, prepared.hash, deadline)
+    try:
+        await store_call(core.update_session, session_id, image_path=prepared.path, image_hash=prepared.hash,
+                         luma=prepared.luma, analysis=[], timestamp=time.time())
+        results = await run_with_token(token, analyze_shared(prepared, categories, previous), prepared.hash, categories)
+        await store_call(core.store_session_results, session_id, prepared.hash, results)
+        return results
+    finally:
+        core.release_session_token(session_id, token)
+
+
+async def join_analysis(image_hash):
+    """Wait for a full analysis of image_hash already in flight; None if there is none.
+
+    It may be running here, in the Flask app or, with shared stores, in another worker.
+    """
+    key = core.analysis_job_key(image_hash)
+    results = await run_shared(key)
+    if results is None:
+        job = core.inflight_jobs.get(key)
+        if job is not None:
+            results = await asyncio.to_thread(job.wait)
+        else:
+            results = await wait_for_lease_async(image_hash, list(core.UX_PROMPTS))
+    return results
+
+
+async def latest_results_async(session_id, data, deadline=None):
+    """A session's results, waiting for or rerunning its analysis if it has none yet."""
+    results = core.session_results(data)
+    if results:
+        return results
+    image_hash = data.get('image_hash')
+    token = core.start_session_token(session_id, image_hash, deadline)
+    try:
+        results = await run_with_token(token, join_analysis(image_hash), image_hash)
+        if results is not None:
+            await store_call(core.store_session_results, session_id, image_hash, results)
+            return results
+        if data.get('image_path') and os.path.exists(data['image_path']):
+            prepared = await asyncio.to_thread(core.load_saved_image, data['image_path'])
+            return await analyze_async(prepared, session_id, token=token)
+        return []
+    finally:
+        core.release_session_token(session_id, token)
+
+
+async def refresh_categories_async(session_id, data, categories):
+    """Async app.refresh_session_categories."""
+    image_hash = data.get('image_hash')
+    current = {r.get('category'): r for r in core.session_results(data) if r.get('category') in core.UX_PROMPTS}
+
+    missing = []
+    for category in categories:
+        if core.is_cacheable_result(current.get(category)):
+            continue
+        cached = await store_call(core.category_cache.get, core.category_key(image_hash, category))
+        if cached is not None:
+            current[category] = cached
+        else:
+            missing.append(category)
+
+    if missing:
+        if await store_call(core.ui_detection_cache.get, core.ui_key(image_hash)) is False:
+            return core.create_not_ui_result()
+
+        results = await join_analysis(image_hash)
+        if results is not None:
+            results = core.select_categories(results, missing)
+        elif data.get('image_path') and os.path.exists(data['image_path']):
+            prepared = await asyncio.to_thread(core.load_saved_image, data['image_path'])
+            results = await analyze_shared(prepared, missing)
+        else:
+            results = []
+
+        if any(r.get('category') == 'error' for r in results):
+            return results
+        current.update((r['category'], r) for r in results)
+
+    await store_call(core.store_session_results, session_id, image_hash,
+                     sorted(current.values(), key=lambda x: x.get('category', '')))
+    return [current[category] for category in categories if category in current]
+
+
+async def run_background_analysis(record, prepared, entry, token):
+    """Async app.run_analysis_job for analyses started by /preprocess."""
+    record["status"] = "running"
+    record["started"] = time.time()
+    await store_call(core.job_store.set, record["id"], record)
+    try:
+        print(f"🔄 Starting job {record['id']} for {prepared.filename}")
+        record["results"] = await run_with_token(token, await_shared(entry), prepared.hash)
+        await store_call(core.store_session_results, record["session_id"], prepared.hash, record["results"])
+        record["status"] = "complete"
+        print(f"✅ Job {record['id']} complete with {len(record['results'])} results")
+    except core.AnalysisCancelled as e:
+        print(f"🛑 Job {record['id']} cancelled: {str(e)}")
+        record["error"] = str(e)
+        record["status"] = "cancelled"
+    except Exception as e:
+        print(f"❌ Job {record['id']} failed: {str(e)}")
+        record["error"] = str(e)
+        record["status"] = "failed"
+    finally:
+        record["finished"] = time.time()
+        await store_call(core.job_store.set, record["id"], record)
+        core.release_session_token(record["session_id"], token)
+
+
+async def submit_background_analysis(prepared, session_id, revision=False):
+    """Start an analysis that outlives the request; None when too many are already pending."""
+    if len(background_tasks) >= ASGI_MAX_BACKGROUND:
+        print(f"⚠️ {len(background_tasks)} background analyses pending, rejecting analysis")
+        return None
+    record = core.new_job_record(session_id)
+    await store_call(core.job_store.set, record["id"], record)
+    # Register the session and the in-flight analysis before responding, so a GET /analyze right after joins it
+    previous = await store_call(core.revision_base, session_id, prepared) if revision else None
+    # Supersedes the session's analyses of other images, wherever they run
+    token = core.start_session_token(session_id, prepared.hash)
+    await store_call(core.update_session, session_id, image_path=prepared.path, image_hash=prepared.hash,
+                     luma=prepared.luma, analysis=[], timestamp=time.time())
+    entry = join_shared(core.analysis_job_key(prepared.hash), functools.partial(run_leased_async, prepared, None, previous))
+    task = asyncio.ensure_future(run_background_analysis(record, prepared, entry, token))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return record
+
+
+async def until_disconnected(request):
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def unless_disconnected(request, coro):
+    """Await coro, cancelling it if the client disconnects first (then returns None)."""
+    global disconnects
+    work = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(until_disconnected(request))
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if work.done():
+            return work.result()
+        disconnects += 1
+        print(f"🔌 Client disconnected from {request.url.path}, cancelling its analysis")
+        return None
+    finally:
+        watcher.cancel()
+        work.cancel()
+
+
+def get_session_id(request):
+    return request.cookies.get("session_id") or str(uuid.uuid4())
+
+
+def json_response(body, session_id, status_code=200, headers=None):
+    response = JSONResponse(body, status_code=status_code, headers=headers)
+    response.set_cookie('session_id', session_id)
+    return response
+
+
+def cancelled_response(error, session_id):
+    """Async app.cancelled_response: the 409 for an analysis a newer upload cancelled."""
+    return json_response([{"label": "Error", "confidence": "N/A", "response": f"Analysis cancelled: {str(error)}"}], session_id, 409)
+
+
+def request_deadline(request):
+    """Async app.request_deadline, from ?deadline_ms= or X-Deadline-Ms."""
+    return core.parse_deadline(request.query_params.get("deadline_ms") or request.headers.get("x-deadline-ms"))
+
+
+def observed(endpoint):
+    """Record a route's latency in app.request_seconds, like the Flask routes."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            started = time.perf_counter()
+            response = await handler(request)
+            core.request_seconds.observe(time.perf_counter() - started, request.method, endpoint, str(response.status_code))
+            return response
+        return wrapper
+    return decorate
+
+
+async def read_upload(request):
+    """Return the multipart "image" upload, or raise ValueError with the client-facing message.
+
+    A Content-Length over the upload limit is refused before the body is read.
+    """
+    limit = core.MAX_UPLOAD_BYTES + core.UPLOAD_FORM_OVERHEAD
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > limit:
+        raise core.UploadRejected(f"Request body is larger than {limit} bytes", 413)
+    form = await request.form()
+    file = form.get("image")
+    if file is None:
+        raise ValueError("No file uploaded")
+    if isinstance(file, str) or not file.filename:
+        raise ValueError("Empty file")
+    return file
+
+
+async def load_upload_async(file):
+    """Async app.load_upload; decoding and resizing run in a worker thread."""
+    reader = core.UploadReader(file.filename)
+    while chunk := await file.read(core.UPLOAD_CHUNK_BYTES):
+        reader.feed(chunk)
+    raw = reader.finish()
+    return await asyncio.to_thread(core.prepare_upload, raw, file.filename, reader.hash, reader.format, reader.size)
+
+
+@observed("/preprocess")
+async def preprocess_image(request):
+    """Start processing the image in the background to save time later."""
+    session_id = get_session_id(request)
+
+    try:
+        prepared = await load_upload_async(await read_upload(request))
+    except ValueError as e:
+        return json_response({"status": "error", "message": str(e)}, session_id, getattr(e, "status", 400))
+
+    revision = core.parse_revision(request.query_params.get("revision"))
+    if core.ANALYSIS_MODE != "combined" and not revision and not await is_ui_image_async(prepared):
+        return json_response({"status": "warning", "message": "The uploaded image does not appear to be UI-related. Analysis may not be relevant."}, session_id)
+
+    record = await submit_background_analysis(prepared, session_id, revision)
+    if record is None:
+        return json_response({"status": "busy", "message": "Server is busy, preprocessing skipped"}, session_id, 429,
+                             {"Retry-After": str(core.JOB_RETRY_AFTER)})
+
+    return json_response({"status": "success", "message": "Preprocessing started", "job_id": record["id"]}, session_id)
+
+
+@observed("/analyze")
+async def analyze_image(request):
+    """Handle image uploads and analyze across all UX principles."""
+    session_id = get_session_id(request)
+
+    try:
+        file = await read_upload(request)
+        categories = core.parse_categories(request.query_params.get("categories"))
+        deadline = request_deadline(request)
+        prepared = await load_upload_async(file)
+    except ValueError as e:
+        return json_response([{"label": "Error", "confidence": "N/A", "response": str(e)}], session_id,
+                             getattr(e, "status", 400))
+
+    revision = core.parse_revision(request.query_params.get("revision"))
+    try:
+        results = await unless_disconnected(request, analyze_async(prepared, session_id, categories, revision, deadline))
+    except core.AnalysisCancelled as e:
+        return cancelled_response(e, session_id)
+    if results is None:
+        return Response(status_code=499)
+    return json_response(results, session_id, headers={"Access-Control-Allow-Origin": "*"})
+
+
+@observed("/analyze")
+async def get_latest_analysis(request):
+    """Return the most recent analysis results for this session (see app.get_latest_analysis)."""
+    session_id = get_session_id(request)
+
+    try:
+        categories = core.parse_categories(request.query_params.get("categories"))
+        deadline = request_deadline(request)
+    except ValueError as e:
+        return json_response([{"label": "Error", "confidence": "N/A", "response": str(e)}], session_id, 400)
+
+    data = await store_call(core.get_session, session_id)
+    if data and data.get('image_hash') and categories is not None:
+        token = core.CancelToken(data['image_hash'], deadline)
+        work = run_with_token(token, refresh_categories_async(session_id, data, categories), data['image_hash'], categories)
+    elif data and (data.get('image_path') or data.get('image_hash')):
+        work = latest_results_async(session_id, data, deadline)
+    else:
+        work = None
+
+    try:
+        analysis_results = await unless_disconnected(request, work) if work is not None else []
+    except core.AnalysisCancelled as e:
+        return cancelled_response(e, session_id)
+    if analysis_results is None:
+        return Response(status_code=499)
+    print(f"📢 Returning Analysis for session {session_id}: {len(analysis_results)} items")
+    return json_response(analysis_results, session_id, headers={"Access-Control-Allow-Origin": "*"})
+
+
+async def asgi_stats(request):
+    """Report the event loop's model limiter and pending work; /admin/stats covers the rest."""
+    denied = core.admin_denied(request.headers)
+    if denied:
+        message, status = denied
+        return JSONResponse({"status": "error", "message": message}, status)
+    return JSONResponse({
+        "model_limiter": limiter.stats(),
+        "shared_tasks": len(shared_tasks),
+        "background_analyses": {"pending": len(background_tasks), "limit": ASGI_MAX_BACKGROUND},
+        "disconnects": disconnects
+    })
+
+
+app = Starlette(
+    routes=[
+        Route("/preprocess", preprocess_image, methods=["POST"]),
+        Route("/analyze", analyze_image, methods=["POST"]),
+        Route("/analyze", get_latest_analysis, methods=["GET"]),
+        Route("/admin/asgi", asgi_stats, methods=["GET"]),
+        Mount("/", WSGIMiddleware(core.create_app())),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])]
+)
@@ -0,0 +1,195 @@
+"""Offline throughput benchmark for the analysis API.
+
+Usage (from the backend folder):
+    python benchmark.py [--images 20] [--sessions 10] [--latency lognormal:0.2,0.3]
+                        [--mode per-category|combined] [--json results.json]
+                        [--max-p95-ms 5000]
+
+The app runs with MODEL_BACKEND=fake, so no network access or API key is
+needed. Requests go through Flask's test client, which exercises the real
+routes, caches, job pool and model-call executor. Three scenarios run:
+
+    analyze     sequential POST /analyze, one distinct image each
+    preprocess  the frontend flow: POST /preprocess, then POST /analyze of
+                the same image
+    concurrent  --sessions clients running the frontend flow at the same time
+
+Each scenario reports p50/p95/p99 latency, requests per second, model calls
+per image and peak RSS. Each scenario uses its own images, so caches only
+help where the pipeline itself should deduplicate work. --max-p95-ms makes
+the run exit non-zero when any scenario's p95 goes over the limit, for CI.
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+
+def configure_environment(args):
+    """Point the app at the fake backend before it is imported."""
+    os.environ["MODEL_BACKEND"] = "fake"
+    os.environ["FAKE_MODEL_LATENCY"] = args.latency
+    os.environ["FAKE_MODEL_ERROR_RATE"] = str(args.error_rate)
+    os.environ["FAKE_MODEL_MALFORMED_RATE"] = str(args.malformed_rate)
+    os.environ["FAKE_MODEL_SEED"] = str(args.seed)
+    os.environ["ANALYSIS_MODE"] = args.mode
+    os.environ.setdefault("SAVE_UPLOADS", "false")
+    os.environ.setdefault("STORE_BACKEND", "memory")
+    # Synthetic variants of the same fixture are near-duplicates by design
+    os.environ.setdefault("PHASH_MAX_DISTANCE", "0")
+    # The app creates its uploads folder relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="feed-bench-"))
+
+
+def make_images(fixtures_dir, count, tag):
+    """Build `count` distinct PNG uploads by stamping a unique pixel row into fixture images."""
+    from PIL import Image
+
+    sources = sorted(f for f in os.listdir(fixtures_dir) if f.lower().endswith((".png", ".jpg", ".jpeg")))
+    images = []
+    for i in range(count):
+        with Image.open(os.path.join(fixtures_dir, sources[i % len(sources)])) as source:
+            image = source.convert("RGB")
+        image.thumbnail((1280, 1280))
+        # Encode the scenario tag and index into the first pixels so every upload hashes differently
+        stamp = f"{tag}:{i}".encode()
+        for x, byte in enumerate(stamp):
+            image.putpixel((x, 0), (byte, i % 256, (i // 256) % 256))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        images.append((f"{tag}-{i}.png", buffer.getvalue()))
+    return images
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+
+
+def post_image(client, path, name, data, session_id):
+    client.set_cookie("session_id", session_id)
+    started = time.perf_counter()
+    response = client.post(path, data={"image": (io.BytesIO(data), name)}, content_type="multipart/form-data")
+    return time.perf_counter() - started, response.status_code
+
+
+def run_scenario(app, name, images, flow, sessions=1):
+    """Run `flow` over images with `sessions` concurrent clients and collect metrics."""
+    client_model = app.model
+    client_model.reset_stats()
+    latencies, failures = [], []
+    lock = threading.Lock()
+    queue = list(enumerate(images))
+
+    def worker():
+        client = app.app.test_client()
+        while True:
+            with lock:
+                if not queue:
+                    return
+                index, (filename, data) = queue.pop(0)
+            elapsed, ok = flow(client, filename, data, f"bench-{name}-{index}")
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    failures.append(filename)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    return {
+        "scenario": name,
+        "images": len(images),
+        "sessions": sessions,
+        "failures": len(failures),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "requests_per_second": round(len(images) / wall, 2),
+        "model_calls_per_image": round(client_model.calls / max(1, len(images)), 2),
+        "model_calls_by_kind": dict(client_model.calls_by_kind),
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    }
+
+
+def analyze_flow(client, filename, data, session_id):
+    elapsed, status = post_image(client, "/analyze", filename, data, session_id)
+    return elapsed, status == 200
+
+
+def preprocess_flow(client, filename, data, session_id):
+    """Frontend flow: latency covers both uploads, as the user experiences it."""
+    first, status = post_image(client, "/preprocess", filename, data, session_id)
+    if status != 200:
+        return first, False
+    second, status = post_image(client, "/analyze", filename, data, session_id)
+    return first + second, status == 200
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=20, help="images per scenario")
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent clients in the concurrent scenario")
+    parser.add_argument("--latency", default="lognormal:0.2,0.3", help="fake model latency distribution")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mode", default="per-category", choices=["per-category", "combined"])
+    parser.add_argument("--fixtures", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "images"))
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--max-p95-ms", type=float, help="exit non-zero if any scenario's p95 exceeds this")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    configure_environment(args)
+    import app
+
+    scenarios = [
+        ("analyze", analyze_flow, 1),
+        ("preprocess", preprocess_flow, 1),
+        ("concurrent", preprocess_flow, args.sessions),
+    ]
+    results = []
+    for name, flow, sessions in scenarios:
+        images = make_images(args.fixtures, args.images, name)
+        results.append(run_scenario(app, name, images, flow, sessions))
+
+    print()
+    print(f"{'scenario':<12} {'images':>6} {'fail':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>7} {'calls/img':>9} {'rss MB':>7}")
+    for r in results:
+        print(f"{r['scenario']:<12} {r['images']:>6} {r['failures']:>5} {r['p50_ms']:>9} {r['p95_ms']:>9} "
+              f"{r['p99_ms']:>9} {r['requests_per_second']:>7} {r['model_calls_per_image']:>9} {r['peak_rss_mb']:>7}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+    if args.max_p95_ms is not None:
+        slow = [r["scenario"] for r in results if r["p95_ms"] > args.max_p95_ms]
+        if slow:
+            print(f"p95 over {args.max_p95_ms} ms in: {', '.join(slow)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
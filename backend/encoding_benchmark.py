@@ -0,0 +1,165 @@
+"""Compare image encodings for model calls by payload size, encode time and result stability.
+
+Usage (from the backend folder):
+    python encoding_benchmark.py [--fixtures fixtures/images] [--settings source,png,png-palette,jpeg:90,webp:85,auto]
+                                 [--repeat 3] [--model] [--json results.json]
+
+Every fixture is prepared once per setting with prepare_image, exactly as an
+upload would be. A setting is an IMAGE_ENCODINGS name, optionally with a
+quality such as jpeg:75. For each one the report gives the bytes sent to the
+model, the best encode-stage time over --repeat runs and how far the result
+drifts from a lossless PNG of the same image:
+
+    psnr      dB against the lossless reference at the size that was sent
+    dhash     bits of perceptual hash that changed
+    prefilter whether the local UI pre-filter verdict is unchanged
+
+By default the app runs with MODEL_BACKEND=fake and no model is called.
+With --model the configured model also analyzes every encoding, and the
+report adds how many UI verdicts match the reference and the Jaccard
+overlap of the issue titles it returned for each category.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+
+def parse_setting(setting):
+    """Turn "webp:75" into ("webp", 75) and "auto" into ("auto", None)."""
+    name, _, quality = setting.partition(":")
+    return name, int(quality) if quality else None
+
+
+def psnr(reference, candidate):
+    """Peak signal-to-noise ratio of candidate against reference, both RGB PIL images."""
+    if reference.size != candidate.size:
+        reference = reference.resize(candidate.size, resample=3)
+    error = np.asarray(reference, dtype=np.float64) - np.asarray(candidate.convert("RGB"), dtype=np.float64)
+    mse = float((error ** 2).mean())
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def best_encode(app, raw, name, encoding, quality, repeat):
+    """Prepare the image `repeat` times; return the PreparedImage and the best encode-stage ms."""
+    best, prepared = float("inf"), None
+    for _ in range(repeat):
+        trace = app.Trace("encoding-benchmark")
+        app.set_current_trace(trace)
+        prepared = app.prepare_image(raw, name, encoding=encoding, quality=quality)
+        app.set_current_trace(None)
+        best = min(best, trace.totals().get(("encode", ""), 0.0))
+    return prepared, best * 1000
+
+
+def model_titles(app, prepared):
+    """Ask the model for the UI verdict and every category; returns (is_ui, {category: titles})."""
+    response = app.call_model([app.UI_DETECTION_PROMPT, prepared.part], "ui-detection", stream=False)
+    is_ui = "YES" in (response.text or "").upper()
+    titles = {}
+    for category, prompt in app.UX_PROMPTS.items():
+        response = app.call_model([prompt, prepared.part], category, generation_config=app.GENERATION_CONFIG)
+        formatted = app.format_category_response(category, response.text)
+        titles[category] = {item.get("title", "").strip().lower() for item in formatted.get("items", [])}
+    return is_ui, titles
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fixtures", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "images"))
+    parser.add_argument("--settings", default="source,png,png-palette,jpeg:90,jpeg:80,webp:85,webp:75,auto",
+                        help="comma-separated encodings, each optionally with :quality")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--model", action="store_true", help="also compare the configured model's answers")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    fixtures = os.path.abspath(args.fixtures)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    if not args.model:
+        os.environ["MODEL_BACKEND"] = "fake"
+    os.environ.setdefault("SAVE_UPLOADS", "false")
+    os.environ.setdefault("STORE_BACKEND", "memory")
+    os.environ.setdefault("TRACE_LOG_MS", "-1")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # The app creates its uploads folder, and expires files in it, relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="encoding-bench-"))
+    import app
+
+    settings = [parse_setting(s.strip()) for s in args.settings.split(",") if s.strip()]
+    for encoding, _ in settings:
+        if encoding not in app.IMAGE_ENCODINGS:
+            parser.error(f"unknown encoding {encoding!r}; choose from {', '.join(app.IMAGE_ENCODINGS)}")
+
+    files = sorted(f for f in os.listdir(fixtures) if f.lower().endswith(app.IMAGE_EXTENSIONS))
+    rows = []
+    for filename in files:
+        with open(os.path.join(fixtures, filename), "rb") as f:
+            raw = f.read()
+        # Quiet the per-image log lines so they don't swamp the table
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try:
+            reference = app.prepare_image(raw, filename, encoding="png")
+            reference_image = reference.to_image().convert("RGB")
+            reference_verdict, _ = app.ui_prefilter(reference_image)
+            reference_model = model_titles(app, reference) if args.model else None
+            for encoding, quality in settings:
+                prepared, encode_ms = best_encode(app, raw, filename, encoding, quality, args.repeat)
+                image = prepared.to_image()
+                verdict, _ = app.ui_prefilter(image)
+                row = {
+                    "file": filename,
+                    "setting": f"{encoding}:{quality}" if quality else encoding,
+                    "chosen": prepared.encoding,
+                    "size": list(prepared.size),
+                    "bytes": len(prepared.data),
+                    "encode_ms": round(encode_ms, 2),
+                    "psnr": round(psnr(reference_image, image), 2),
+                    "dhash": bin(prepared.phash ^ reference.phash).count("1"),
+                    "prefilter_same": verdict == reference_verdict,
+                }
+                if args.model:
+                    is_ui, titles = model_titles(app, prepared)
+                    row["ui_same"] = is_ui == reference_model[0]
+                    row["title_jaccard"] = round(float(np.mean(
+                        [jaccard(titles[c], reference_model[1][c]) for c in titles])), 3)
+                rows.append(row)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        print(f"{filename}: " + ", ".join(f"{r['setting']} {r['bytes'] // 1024} KB"
+                                         for r in rows if r["file"] == filename))
+
+    print()
+    header = f"{'setting':<12} {'total KB':>9} {'vs source':>9} {'encode ms':>10} {'min psnr':>9} {'max dhash':>9} {'prefilter':>9}"
+    if args.model:
+        header += f" {'ui same':>8} {'titles':>7}"
+    print(header)
+    source_bytes = sum(r["bytes"] for r in rows if r["setting"] == "source") or None
+    for setting in dict.fromkeys(r["setting"] for r in rows):
+        group = [r for r in rows if r["setting"] == setting]
+        total = sum(r["bytes"] for r in group)
+        ratio = f"{total / source_bytes:.2f}x" if source_bytes else "-"
+        line = (f"{setting:<12} {total / 1024:>9.1f} {ratio:>9} {np.mean([r['encode_ms'] for r in group]):>10.2f} "
+                f"{min(r['psnr'] for r in group):>9.1f} {max(r['dhash'] for r in group):>9} "
+                f"{sum(r['prefilter_same'] for r in group):>4}/{len(group):<4}")
+        if args.model:
+            line += (f" {sum(r['ui_same'] for r in group):>4}/{len(group):<3}"
+                     f" {np.mean([r['title_jaccard'] for r in group]):>7.2f}")
+        print(line)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""Offline stand-in for the Gemini model client.
+
+FakeModelClient implements the same generate_content(parts, ...) and
+generate_content_async(parts, ...) calls the backend makes on
+google.generativeai.GenerativeModel, so every analysis path
+can run without network access or an API key. Enable it with
+MODEL_BACKEND=fake. These environment variables configure it:
+
+    FAKE_MODEL_LATENCY         latency distribution in seconds, one of
+                               "constant:S", "uniform:LO,HI", "normal:MEAN,SD"
+                               or "lognormal:MEDIAN,SIGMA" (default lognormal:0.8,0.35)
+    FAKE_MODEL_ERROR_RATE      fraction of calls that raise a server error
+    FAKE_MODEL_RATE_LIMIT_RATE fraction of calls that raise a 429
+    FAKE_MODEL_MALFORMED_RATE  fraction of JSON answers that come back malformed
+    FAKE_MODEL_NOT_UI_RATE     fraction of images the fake classifies as not UI
+    FAKE_MODEL_SEED            seed for all of the above
+
+Outcomes are drawn from a generator seeded by (seed, prompt, image bytes,
+call number for that pair). A run is therefore reproducible however its
+calls interleave across threads.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+CATEGORIES = ["visual", "ux-laws", "cognitive", "psychological", "gestalt"]
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModelError(Exception):
+    """Stands in for a 5xx error from the API."""
+    code = 500
+
+
+class FakeRateLimitError(Exception):
+    """Stands in for google.api_core.exceptions.ResourceExhausted."""
+    code = 429
+
+
+def parse_latency(spec):
+    """Turn a latency spec string into a function of a random.Random returning seconds."""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v.strip()]
+    if kind == "constant":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        import math
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class FakeModelClient:
+    """Deterministic fake with configurable latency, failures and malformed output."""
+
+    def __init__(self, latency="lognormal:0.8,0.35", error_rate=0.0, rate_limit_rate=0.0,
+                 malformed_rate=0.0, not_ui_rate=0.0, seed=0):
+        self.latency_spec = latency
+        self._latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.not_ui_rate = not_ui_rate
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._attempts = {}
+        self.calls = 0
+        self.calls_by_kind = {}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            latency=os.getenv("FAKE_MODEL_LATENCY", "lognormal:0.8,0.35"),
+            error_rate=float(os.getenv("FAKE_MODEL_ERROR_RATE", 0)),
+            rate_limit_rate=float(os.getenv("FAKE_MODEL_RATE_LIMIT_RATE", 0)),
+            malformed_rate=float(os.getenv("FAKE_MODEL_MALFORMED_RATE", 0)),
+            not_ui_rate=float(os.getenv("FAKE_MODEL_NOT_UI_RATE", 0)),
+            seed=int(os.getenv("FAKE_MODEL_SEED", 0)),
+        )
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = 0
+            self.calls_by_kind = {}
+
+    @staticmethod
+    def _image_digest(parts):
+        digest = hashlib.sha256()
+        for part in parts[1:]:
+            if isinstance(part, dict) and "data" in part:
+                digest.update(part["data"])
+            elif hasattr(part, "tobytes"):
+                digest.update(part.tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _kind(prompt):
+        if "Respond with just 'YES'" in prompt:
+            return "ui-detection"
+        if '"resolved"' in prompt:
+            return "revision"
+        if '"is_ui"' in prompt:
+            return "combined"
+        if '"categories"' in prompt:
+            return "tile"
+        return "category"
+
+    def _rng(self, prompt, image_digest):
+        key = hashlib.sha256(prompt.encode()).hexdigest() + image_digest
+        with self._lock:
+            attempt = self._attempts.get(key, 0)
+            self._attempts[key] = attempt + 1
+        return random.Random(f"{self.seed}:{key}:{attempt}")
+
+    def _is_ui(self, image_digest):
+        # Fixed per image so UI detection and the combined prompt always agree
+        return random.Random(f"{self.seed}:ui:{image_digest}").random() >= self.not_ui_rate
+
+    def generate_content(self, parts, stream=False, generation_config=None):
+        call = self._start(parts)
+        time.sleep(self._latency(call[2]))
+        return self._answer(*call)
+
+    async def generate_content_async(self, parts, stream=False, generation_config=None):
+        """Same as generate_content, but waits out the latency without holding a thread."""
+        call = self._start(parts)
+        await asyncio.sleep(self._latency(call[2]))
+        return self._answer(*call)
+
+    def _start(self, parts):
+        """Count the call and return the (kind, image digest, rng) that decide its outcome."""
+        prompt = parts[0] if parts and isinstance(parts[0], str) else ""
+        kind = self._kind(prompt)
+        image_digest = self._image_digest(parts)
+        rng = self._rng(prompt, image_digest)
+        with self._lock:
+            self.calls += 1
+            self.calls_by_kind[kind] = self.calls_by_kind.get(kind, 0) + 1
+        return kind, image_digest, rng
+
+    def _answer(self, kind, image_digest, rng):
+        roll = rng.random()
+        if roll < self.rate_limit_rate:
+            raise FakeRateLimitError("429 Resource has been exhausted (e.g. check quota).")
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise FakeModelError("500 An internal error has occurred.")
+
+        if kind == "ui-detection":
+            return FakeResponse("YES" if self._is_ui(image_digest) else "NO")
+
+        if kind == "revision":
+            payload = {"categories": {category: self._revision_payload(rng, category) for category in CATEGORIES}}
+        elif kind == "combined":
+            is_ui = self._is_ui(image_digest)
+            payload = {
+                "is_ui": is_ui,
+                "categories": {category: self._category_payload(rng, category) for category in CATEGORIES} if is_ui else {}
+            }
+        elif kind == "tile":
+            payload = {"categories": {category: self._category_payload(rng, category) for category in CATEGORIES}}
+        else:
+            payload = self._category_payload(rng, "category")
+        text = json.dumps(payload, indent=2)
+
+        if rng.random() < self.malformed_rate:
+            text = self._malform(rng, text)
+        return FakeResponse(text)
+
+    @staticmethod
+    def _category_payload(rng, category):
+        issues = [
+            {
+                "title": f"Fake {category} issue {i + 1}",
+                "description": f"Synthetic description of {category} issue {i + 1} for offline runs.",
+                "severity": rng.choice(["high", "medium", "low"])
+            }
+            for i in range(rng.randint(3, 5))
+        ]
+        recommendations = [
+            {
+                "title": f"Fake {category} recommendation {i + 1}",
+                "description": f"Synthetic description of {category} recommendation {i + 1}.",
+                "type": rng.choice(["improvement", "fix", "enhancement"])
+            }
+            for i in range(rng.randint(3, 5))
+        ]
+        return {"issues": issues, "recommendations": recommendations}
+
+    @staticmethod
+    def _revision_payload(rng, category):
+        """A small delta: one or two previous findings resolved, one new issue."""
+        return {
+            "resolved": sorted(rng.sample(range(1, 7), rng.randint(1, 2))),
+            "issues": [{
+                "title": f"Fake {category} revised issue",
+                "description": f"Synthetic description of an issue in the changed {category} region.",
+                "severity": rng.choice(["high", "medium", "low"])
+            }],
+            "recommendations": []
+        }
+
+    @staticmethod
+    def _malform(rng, text):
+        """Corrupt a JSON answer in one of the ways real model output goes wrong."""
+        style = rng.choice(["truncated", "fenced-prose", "trailing-comma", "prose"])
+        if style == "truncated":
+            return text[:rng.randint(len(text) // 3, len(text) - 2)]
+        if style == "fenced-prose":
+            return f"Here is the analysis you asked for:\n```json\n{text}\n```\nLet me know if you need more."
+        if style == "trailing-comma":
+            return text.replace("}\n  ]", "},\n  ]", 1)
+        return "The design looks clean overall, but spacing and contrast could be improved."
@@ -0,0 +1,107 @@
+"""Cold-start benchmark: import time of the backend and time until it is ready to serve.
+
+Usage (from the backend folder):
+    python import_benchmark.py [--module app|asgi] [--backend fake|gemini] [--repeat 5] [--top 15]
+                               [--json results.json]
+
+Each run starts a fresh interpreter with `python -X importtime`, imports the
+module, then calls create_app() and waits for its warm-up to finish, the
+moment GET /ready turns 200. The report gives the median import and
+time-to-ready over --repeat runs, and the modules that cost the most to
+import, by cumulative time, from the -X importtime trace.
+
+With --backend gemini the warm-up imports and configures the real SDK and
+pings the API, so it needs google-generativeai, GEMINI_API_KEY and network
+access; without them it stops at "failed", which is reported too.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+RUN = """
+import json, sys, time
+sys.path.insert(0, {backend!r})
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+import app
+app.create_app()
+while app.warmup_state["status"] in ("pending", "warming"):
+    time.sleep(0.005)
+print({marker!r} + json.dumps({{"import_s": imported - started, "ready_s": time.perf_counter() - started,
+                               "status": app.warmup_state["status"], "steps": app.warmup_state["steps"]}}))
+"""
+# Prefixes the timings line; the app's background threads log to the same stdout
+MARKER = "IMPORT-BENCHMARK "
+
+
+def parse_importtime(stderr):
+    """Turn -X importtime lines into (module, self_us, cumulative_us, depth) tuples."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def run_once(module, env):
+    backend = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", RUN.format(backend=backend, module=module, marker=MARKER)],
+        env=env, capture_output=True, text=True, timeout=300,
+        # The app creates its uploads folder relative to the working directory
+        cwd=tempfile.mkdtemp(prefix="import-bench-")
+    )
+    if result.returncode != 0:
+        errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+        sys.exit(f"{module} failed to start: {errors[-1] if errors else result.returncode}")
+    lines = [line for line in result.stdout.splitlines() if line.startswith(MARKER)]
+    if not lines:
+        sys.exit(f"{module} printed no timings")
+    timings = json.loads(lines[-1][len(MARKER):])
+    return timings, parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="app", choices=["app", "asgi"])
+    parser.add_argument("--backend", default="fake", choices=["fake", "gemini"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    env = dict(os.environ, MODEL_BACKEND=args.backend, SAVE_UPLOADS="false")
+    runs, trace = [], []
+    for _ in range(args.repeat):
+        timings, trace = run_once(args.module, env)
+        runs.append(timings)
+
+    import_ms = statistics.median(r["import_s"] for r in runs) * 1000
+    ready_ms = statistics.median(r["ready_s"] for r in runs) * 1000
+    print(f"import {args.module}: {import_ms:.0f} ms median, ready after {ready_ms:.0f} ms "
+          f"({runs[-1]['status']}, warm-up steps {runs[-1]['steps']})")
+
+    # Only the direct imports of the measured modules, so nested packages aren't counted twice
+    top_level = sorted((row for row in trace if row[3] <= 1), key=lambda row: row[2], reverse=True)
+    print()
+    print(f"{'module':<36} {'self ms':>8} {'cumulative ms':>14}")
+    for name, self_us, cumulative_us, _ in top_level[:args.top]:
+        print(f"{name:<36} {self_us / 1000:>8.1f} {cumulative_us / 1000:>14.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "runs": runs,
+                       "modules": [{"module": name, "self_us": s, "cumulative_us": c} for name, s, c, _ in top_level]},
+                      f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
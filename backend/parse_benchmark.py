@@ -0,0 +1,115 @@
+"""Microbenchmark for model-response JSON parsing on large and adversarial outputs.
+
+Usage (from the backend folder):
+    python parse_benchmark.py [--size 20000] [--repeat 5] [--skip-legacy]
+
+Compares parse_json_from_response with the regex-based parser it replaced.
+For each input it reports the best time over --repeat runs and how many
+issues/recommendations each parser recovered. The legacy parser backtracks
+quadratically on some inputs, so keep --size modest unless --skip-legacy is
+given.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+
+def legacy_parse(text):
+    """The regex-based parser, kept here only as the baseline."""
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        try:
+            json_match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', text)
+            if json_match:
+                return json.loads(json_match.group(1).strip())
+            json_match = re.search(r'(\{[\s\S]*\})', text)
+            if json_match:
+                return json.loads(json_match.group(1))
+        except Exception:
+            pass
+    return None
+
+
+def analysis_json(entries):
+    """A well-formed category answer with `entries` issues and recommendations."""
+    return json.dumps({
+        "issues": [
+            {"title": f"Issue {i}", "description": "Contrast between {primary} and [secondary] text is low. " * 3, "severity": "medium"}
+            for i in range(entries)
+        ],
+        "recommendations": [
+            {"title": f"Recommendation {i}", "description": "Raise contrast to meet WCAG AA, e.g. \"#333\" on white.", "type": "improvement"}
+            for i in range(entries)
+        ]
+    }, indent=2)
+
+
+def make_inputs(size):
+    """Build adversarial inputs of roughly `size` characters each."""
+    entries = max(1, size // 500)
+    body = analysis_json(entries)
+    return {
+        "valid": body,
+        "prose-wrapped": "Sure! " + "The layout is mostly clear. " * (size // 28) + "\n```json\n" + body + "\n```\nHope this helps.",
+        "trailing-comma": body.replace('"improvement"\n    }\n  ]', '"improvement"\n    },\n  ]'),
+        "truncated": body[:int(len(body) * 0.9)],
+        "braces-in-prose": "Use {tokens} and {spacing} consistently. " * (size // 42) + body,
+        "unclosed-braces": "{ " * (size // 2),
+        "unclosed-fences": "``` " * (size // 4),
+    }
+
+
+def count_entries(data):
+    if not isinstance(data, dict):
+        return 0
+    return sum(len(data.get(key) or []) for key in ("issues", "recommendations") if isinstance(data.get(key), list))
+
+
+def best_time(fn, text, repeat):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(text)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=20000, help="approximate characters per input")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-legacy", action="store_true", help="only time the current parser")
+    args = parser.parse_args()
+
+    # Importing the app must not need an API key
+    os.environ.setdefault("MODEL_BACKEND", "fake")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+
+    def current_parse(text):
+        # Quiet the fallback warnings so they don't swamp the table
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try:
+            data = app.parse_json_from_response(text)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        return None if data.get("issues", [{}])[0].get("title") == "Analysis Formatting Error" else data
+
+    print(f"{'input':<16} {'chars':>8} {'legacy ms':>10} {'kept':>5} {'current ms':>11} {'kept':>5}")
+    for name, text in make_inputs(args.size).items():
+        if args.skip_legacy:
+            legacy = "-", "-"
+        else:
+            ms, data = best_time(legacy_parse, text, args.repeat)
+            legacy = f"{ms:.2f}", count_entries(data)
+        ms, data = best_time(current_parse, text, args.repeat)
+        print(f"{name:<16} {len(text):>8} {legacy[0]:>10} {legacy[1]:>5} {ms:>11.2f} {count_entries(data):>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Measure the local UI pre-filter against a labeled fixture set.
+
+Usage (from the backend folder):
+    python ui_prefilter_report.py [--labels fixtures/ui_labels.json] [--no-variants]
+
+Each labeled image is scored as uploaded and, unless --no-variants is given,
+as a centre crop, a heavy JPEG recompression and a half-size downscale. Those
+variants keep the label of their source. The report lists every decision and
+then summarizes how many images were decided locally, how accurate those
+decisions were, which UIs were wrongly rejected as not UI (false negatives,
+the costly mistake) and how many fall through to a Gemini call.
+"""
+import argparse
+import io
+import json
+import os
+import time
+
+from PIL import Image
+
+import app
+
+
+def variants(image):
+    """Yield (name, image) pairs for the original and its perturbed copies."""
+    yield "original", image
+    width, height = image.size
+    yield "crop", image.crop((width // 8, height // 8, width * 7 // 8, height * 7 // 8))
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=40)
+    yield "jpeg-q40", Image.open(io.BytesIO(buffer.getvalue()))
+    yield "half", image.resize((max(1, width // 2), max(1, height // 2)), Image.Resampling.BILINEAR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--labels", default=os.path.join(os.path.dirname(__file__), "fixtures", "ui_labels.json"))
+    parser.add_argument("--no-variants", action="store_true", help="score only the original files")
+    args = parser.parse_args()
+
+    with open(args.labels) as f:
+        fixture = json.load(f)
+    images_dir = os.path.join(os.path.dirname(os.path.abspath(args.labels)), fixture.get("images_dir", "."))
+
+    rows = []
+    for filename, label in sorted(fixture["labels"].items()):
+        with open(os.path.join(images_dir, filename), "rb") as f:
+            source = app.prepare_image(f.read(), filename).to_image()
+        for name, image in variants(source):
+            if args.no_variants and name != "original":
+                continue
+            started = time.perf_counter()
+            verdict, features = app.ui_prefilter(image)
+            elapsed = (time.perf_counter() - started) * 1000
+            rows.append((filename, name, label, verdict, elapsed, features))
+
+    print(f"{'image':<46} {'variant':<9} {'label':<6} {'verdict':<8} {'ms':>6}  flat  top8  palette  axis  strips")
+    for filename, name, label, verdict, elapsed, f in rows:
+        shown = "model" if verdict is None else ("UI" if verdict else "not-UI")
+        marker = "" if verdict is None or verdict == label else "  <-- wrong"
+        print(f"{filename[:46]:<46} {name:<9} {'UI' if label else 'not-UI':<6} {shown:<8} {elapsed:6.1f}"
+              f"  {f['flat_fraction']:.2f}  {f['top_colors']:.2f}  {f['palette_size']:7d}  {f['axis_alignment']:.2f}  {f['graphic_strips']:6d}{marker}")
+
+    decided = [row for row in rows if row[3] is not None]
+    correct = [row for row in decided if row[3] == row[2]]
+    timings = sorted(row[4] for row in rows)
+    print()
+    print(f"images scored:         {len(rows)} ({sum(1 for row in rows if row[2])} UI, {sum(1 for row in rows if not row[2])} not-UI)")
+    print(f"decided locally:       {len(decided)} ({len(decided) / len(rows):.0%})")
+    print(f"accuracy when decided: {len(correct)}/{len(decided)} ({len(correct) / max(1, len(decided)):.0%})")
+    # A UI decided "not UI" locally is answered "Non-UI Image Detected" with no model call
+    false_negatives = [f"{row[0]} ({row[1]})" for row in decided if row[2] and not row[3]]
+    print(f"UI rejected locally:   {len(false_negatives)}" + (f" - {', '.join(false_negatives)}" if false_negatives else ""))
+    print(f"deferred to Gemini:    {len(rows) - len(decided)}")
+    print(f"pre-filter time:       p50 {timings[len(timings) // 2]:.1f} ms, max {timings[-1]:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()